@@ -3,7 +3,6 @@ import json
 import logging
 import os
 import time
-from collections import Counter
 from copy import deepcopy
 
 from sklearn.model_selection import KFold
@@ -13,9 +12,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from pyjarowinkler import distance as jwdistance
 from utils import get_clusters, split_into_sets, fixed_split
 from common import ControllerBase
+from baseline_features import DocumentPairFeatures, FEATURE_SET_VERSION, MentionFeatures, MentionPairFeatures, \
+    PairFeatureStore, configure_feature_cache, feature_cache, use_feature_store
 
 from data import read_corpus
 
@@ -26,281 +26,56 @@ parser.add_argument("--num_epochs", type=int, default=50)
 parser.add_argument("--dataset", type=str, default="senticoref")  # {'senticoref', 'coref149'}
 parser.add_argument("--random_seed", type=int, default=13)
 parser.add_argument("--fixed_split", action="store_true")
+parser.add_argument("--batched", action="store_true",
+                    help="Update the model once per document instead of once per mention")
+parser.add_argument("--solver", type=str, default="sgd", choices=["sgd", "lbfgs"],
+                    help="Train with SGD for up to num_epochs epochs or fit on all training data at once with L-BFGS")
+parser.add_argument("--candidate_window", type=int, default=None,
+                    help="If set, string features are only computed for a window of this many preceding mentions and "
+                         "mentions sharing a content word lemma, initials or head token with the head mention")
+parser.add_argument("--prune_candidates", action="store_true",
+                    help="Limit antecedent candidates to the mentions selected by candidate_window (faster on long "
+                         "documents, but correct antecedents outside the selection can no longer be found)")
+parser.add_argument("--feature_store_dir", type=str, default=None,
+                    help="If set, pair features are precomputed into (and reused from) this directory")
+parser.add_argument("--feature_cache_mb", type=int, default=1024,
+                    help="Memory budget for cached mention and mention pair features (in MB)")
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+# Maximum number of L-BFGS iterations when training with solver="lbfgs"
+LBFGS_MAX_ITER = 100
+
 RANDOM_SEED = None
 if RANDOM_SEED:
     np.random.seed(RANDOM_SEED)
     torch.random.manual_seed(RANDOM_SEED)
 
-# Cache features for single mentions and mention pairs (useful for doing multiple epochs over data)
-# Format for single: {doc1_id: {mention_id: <features>, ...}, ...}
-_cached_MentionFeatures = {}
-# Format for pair:   {doc1_id: {(mention1_id, mention2_id): <features>, ...}, ...}
-_cached_MentionPairFeatures = {}
-
-
-class MentionFeatures:
-
-    # Useful resource for parsing the morphosyntactic properties:
-    # http://nl.ijs.si/ME/V5/msd/html/msd-sl.html#msd.categories-sl
-
-    @staticmethod
-    def for_mention(document, mention, use_cache=True):
-        # load from cache, if enabled and it exists
-        if use_cache:
-            if _cached_MentionFeatures.get(document.doc_id):
-                if _cached_MentionFeatures[document.doc_id].get(mention.mention_id):
-                    return _cached_MentionFeatures[document.doc_id][mention.mention_id]
-            else:
-                _cached_MentionFeatures[document.doc_id] = {}
-
-        # otherwise create and store to cache
-        mf = MentionFeatures(document, mention)
-        if use_cache:
-            _cached_MentionFeatures[document.doc_id][mention.mention_id] = mf
-        return mf
-
-    def __init__(self, document, mention):
-        """
-        Extract features for a given mention in the given document.
-        Note: Some mention features are actually just properties of mention's tokens
-        """
-        self.mention = mention
-        self.tokens = mention.tokens
-        self.lemmas = [token.lemma for token in mention.tokens]  # Note: if token has no lemma, it is "None"!
-
-        # Token index in which mention appears in the sentence
-        self.sentence_index = mention.tokens[0].sentence_index
-
-        # Index in which mention appears in the document (based on mentions). Example:
-        # (">Janez Novak< je svoji >ženi >Mojci<< je kupil nov >kavomat<")
-        # (  i=0                    i=1   i=2                   i=3
-        self.mention_index = None
-        for index, mention_id in enumerate(document.mentions.keys()):
-            if mention_id == mention.mention_id:
-                self.mention_index = index
-                break
-
-        # morphosyntactic description
-        self.msd_desc = self.mention.tokens[0].msd
-
-        # gender, number, main category
-        self.gender = None  # {None, 'm', 's', 'z'}
-        self.number = None  # {None, 'e', 'd', 'm'}
-        self.categories = Counter()  # {'S', 'G', 'P', 'Z', ...}
-
-        counted_categories = Counter()
-        for token in mention.tokens:
-            # Take gender of first token for which it can be determined
-            if self.gender is None:
-                if token.gender in {"m", "z", "s"}:
-                    self.gender = token.gender
-
-            # Take number of first token for which it can be determined
-            if self.number is None:
-                if token.number in {"e", "d", "m"}:
-                    self.number = token.number
-
-            # Count how many times each category appears in mention's tokens and take the most common one as the actual
-            # mention's category
-            counted_categories[token.category] += 1
-
-        self.category = counted_categories.most_common(1)[0][0]
-
-
-class MentionPairFeatures:
-
-    @staticmethod
-    def for_mentions(document, head_mention, cand_mention, use_cache=True):
-        head_id, cand_id = head_mention.mention_id, cand_mention.mention_id
-        doc_id = document.doc_id
-        # load from cache, if enabled and it exists
-        if use_cache:
-            if _cached_MentionPairFeatures.get(doc_id):
-                if _cached_MentionPairFeatures[doc_id].get((head_id, cand_id)):
-                    return _cached_MentionPairFeatures[doc_id][(head_id, cand_id)]
-            else:
-                _cached_MentionPairFeatures[doc_id] = {}
-
-        head_features = MentionFeatures.for_mention(document, head_mention)
-        cand_features = MentionFeatures.for_mention(document, cand_mention)
-
-        pair_features = [
-            MentionPairFeatures.in_same_sentence(head_features, cand_features),
-            MentionPairFeatures.str_match(head_features, cand_features),
-            MentionPairFeatures.is_same_gender(head_features, cand_features),
-            MentionPairFeatures.is_same_number(head_features, cand_features),
-            MentionPairFeatures.is_prefix(head_features, cand_features),
-            MentionPairFeatures.is_suffix(head_features, cand_features),
-            MentionPairFeatures.jaro_winkler_dist(head_features, cand_features),
-            MentionPairFeatures.is_appositive(head_features, cand_features, document),
-            MentionPairFeatures.is_alias(head_features, cand_features),
-            MentionPairFeatures.is_reflexive(head_features, cand_features),
-        ]
-
-        # add features for mention pair, constructed above, to cache
-        _cached_MentionPairFeatures[doc_id][(head_id, cand_id)] = pair_features
-        return pair_features
-
-    @staticmethod
-    def num_features():
-        return 10  # corresponds to number of features returned by `MentionPairFeatures.for_mentions(...)`
-
-    # !! Note
-    # this_feats == head_features
-    # other_feats == cand_features
-    # meaning that, if order in document is important, "other" is before "this"!
-
-    @staticmethod
-    def str_match(this_feats, other_feats):
-        """
-        True:  if neither mentions (this and other) are pronouns and mention's lemmas match
-        False: otherwise
-        """
-        return int(this_feats.category != "Z" and other_feats.category != "Z" and
-                   this_feats.mention.lemma_text() == other_feats.mention.lemma_text())
-
-    @staticmethod
-    def in_same_sentence(this_feats, other_feats):
-        """
-        True:  If mentions this and other are in the same sentence
-        False: otherwise
-        """
-        return int(this_feats.sentence_index == other_feats.sentence_index)
-
-    @staticmethod
-    def is_same_gender(this_feats, other_feats):
-        """
-        One-hot encoded vector if this and other mention:
-        [ match in gender, do not match in gender, gender can't be determined ]
-        """
-        is_same_gender = None
-        if this_feats.gender is not None and other_feats.gender is not None:
-            is_same_gender = this_feats.gender == other_feats.gender
-
-        return int(is_same_gender is True)
-
-    @staticmethod
-    def is_same_number(this_feats, other_feats):
-        """
-        One-hot encoded vector if this and other mention:
-        [ match in number, do not match in number, number can't be determined]
-        """
-        is_same_number = None
-        if this_feats.number is not None and other_feats.number is not None:
-            is_same_number = this_feats.number == other_feats.number
-
-        return int(is_same_number is True)
-
-    @staticmethod
-    def is_appositive(this_feats, other_feats, document):
-        """
-        Two mentions are assumed appositive, if:
-            - they are of NP, NN POS tag or other noun-related tag
-            - previous mention is followed by comma (i.e. ...Janez Novak, predsednik drustva...)
-        """
-        # TODO remarks: zadeva pozitivne primere vzame tudi naštevanja samostalnikov...
-        # if both mentions are nouns
-        if this_feats.category == "S" and other_feats.category == "S":
-            # if both mentions are in same sentence
-            if this_feats.sentence_index == other_feats.sentence_index:
-                # "other" mention is positioned before "this" mention. to get distance in tokens between mentions,
-                # we need distance from last token of "other" mention to first token in "this" mention
-                # TODO: could generalize by comparing this and other first token position within sentence
-                other_last_token_pos = other_feats.mention.tokens[0].position_in_sentence + len(other_feats.mention.tokens)
-                this_first_token_pos = this_feats.mention.tokens[0].position_in_sentence
-                if this_first_token_pos - other_last_token_pos == 1:
-                    # there's exactly one token betwen, check if it's a comma
-                    if document.tokens[document.sents[this_feats.sentence_index][other_last_token_pos]].raw_text == ",":
-                        return int(True)
-        return int(False)
-
-    @staticmethod
-    def is_alias(this_feats, other_feats):
-        """
-        One mention is considered an alias of another, if:
-            - word or initials match exactly, or
-            - mentions match partially (i.e. Marija Novak <-> gospa Novak)
-            - one mention is a token subset of another (i.e. Janez Novak <-> Novak)
-        """
-        # TODO remarks: initials pade pri netrivialnih primerih.
-        #               Primer: "Ministrstvo za kmetijstvo, gozdrastvo in prehrano" se inicira z "MKGIP", ne "MZK,GIP"
-        this_initials = [tok.raw_text[0] for tok in this_feats.tokens]
-        other_initials = [tok.raw_text[0] for tok in other_feats.tokens]
-        this_words = this_feats.mention.raw_text()
-        other_words = other_feats.mention.raw_text()
-
-        # mentions are equal or one is initial of another
-        if this_words == other_words or this_initials == other_initials or this_words == other_initials or this_initials == other_words:
-            return int(True)
-
-        # TODO remarks: return true on first match, which may not be specific enough (i.e. Janez Novak <-> Peter Novak
-        #               sta lahko različni omembi...)
-        for tok in this_feats.tokens:
-            if tok in other_feats.tokens:
-                return int(True)
-
-        return int(False)
-
-    @staticmethod
-    def is_prefix(this_feats, other_feats):
-        """
-        True:  if this mention is prefix of other mention (or vice versa)
-        False: otherwise
-        """
-        this_raw = this_feats.mention.raw_text()
-        other_raw = other_feats.mention.raw_text()
-        if this_raw.startswith(other_raw) or other_raw.startswith(this_raw):
-            return int(True)
-        return int(False)
-
-    @staticmethod
-    def is_suffix(this_feats, other_feats):
-        """
-        True:  if this mention is suffix of other mention (or vice versa)
-        False: otherwise
-        """
-        this_raw = this_feats.mention.raw_text()
-        other_raw = other_feats.mention.raw_text()
-        if this_raw.endswith(other_raw) or other_raw.endswith(this_raw):
-            return int(True)
-        return int(False)
-
-    @staticmethod
-    def jaro_winkler_dist(this_feats, other_feats):
-        """
-        Result is a similarity value between this and other mention according to Jaro-Winkler metric.
-        """
-        return jwdistance.get_jaro_distance(this_feats.mention.raw_text(), other_feats.mention.raw_text())
-
-    @staticmethod
-    def is_reflexive(this_feats, other_feats):
-        """
-        True:  if this mention is reflexive and distance between this and other mentions is 0 (i.e. there are no other
-               mentions between those two)
-        False: otherwise
-
-        Reflexive pronoun = povratni zaimek
-        primer: "<Nueri> se, na primer, spominjajo <svojih> prednikov...", kjer je <svojih> povratni zaimek in se nanaša
-        na omenitev takoj prej, <Nueri>
-
-        note: izjeme so lahko dobsedeni navedki v navednicah!
-        primer: ",,Prepričan <sem>, da ne bomo razočarali'', napoveduje Matjaž Brumen.", v tem primeru se <sem> nanaša
-        na naslednjo omenitev t.j. <Matjaž Brumen>, ki je dobsedni navedek "izrekel".
-        """
-        if this_feats.msd_desc.startswith("Zp") and this_feats.mention_index - other_feats.mention_index == 1:
-            return int(True)
-
-        return int(False)
-
 
 class BaselineController(ControllerBase):
-    def __init__(self, in_features, dataset_name, model_name=None, learning_rate=0.001):
+    def __init__(self, in_features, dataset_name, model_name=None, learning_rate=0.001, batched=False, solver="sgd",
+                 candidate_window=None, prune_candidates=False):
+        """ If `batched` is True, all head mentions of a document are scored in a single pass and the model is updated
+        once per document (with the sum of head losses), instead of once per head mention.
+
+        If `solver` is "lbfgs", `train()` fits the model on all training documents at once with L-BFGS instead of
+        running epochs of SGD.
+
+        If `candidate_window` is set, string features are only computed for preceding mentions inside this window or
+        sharing a content word lemma, initials or head token with the head mention (see
+        `DocumentPairFeatures.candidate_pairs()`) and are 0 for other preceding mentions. If `prune_candidates` is
+        also set, only these mentions are antecedent candidates. """
+        SUPPORTED_SOLVERS = {"sgd", "lbfgs"}
+        if solver not in SUPPORTED_SOLVERS:
+            raise ValueError(f"Unsupported solver (must be one of {SUPPORTED_SOLVERS})")
+
         self.num_features = in_features
+        self.batched = batched
+        self.solver = solver
+        self.candidate_window = candidate_window
+        self.prune_candidates = prune_candidates
 
         self.model = nn.Linear(in_features=in_features, out_features=1)
         self.model_optimizer = optim.SGD(self.model.parameters(), lr=learning_rate)
@@ -340,10 +115,26 @@ class BaselineController(ControllerBase):
                 "in_features": self.num_features,
                 "dataset_name": self.dataset_name,
                 "model_name": self.model_name,
-                "learning_rate": self.learning_rate
+                "learning_rate": self.learning_rate,
+                "batched": self.batched,
+                "solver": self.solver,
+                "candidate_window": self.candidate_window,
+                "prune_candidates": self.prune_candidates
             }, fp=f_config, indent=4)
 
         torch.save(self.model.state_dict(), os.path.join(self.path_model_dir, 'best.th'))
+        self.export_numpy(os.path.join(model_dir, "baseline.npz"))
+
+    def export_numpy(self, path):
+        """ Exports the model into a NumPy artifact, which can be used for inference without torch (see
+        `baseline_inference.BaselinePredictor`). """
+        np.savez(path,
+                 weights=self.model.weight.detach().cpu().numpy()[0],
+                 bias=self.model.bias.detach().cpu().numpy(),
+                 feature_set_version=np.array(FEATURE_SET_VERSION),
+                 # -1 = no candidate window
+                 candidate_window=np.array(self.candidate_window if self.candidate_window is not None else -1),
+                 prune_candidates=np.array(self.prune_candidates))
 
     def save_checkpoint(self):
         logging.warning("save_checkpoint() is deprecated. Use save_pretrained() instead")
@@ -354,6 +145,180 @@ class BaselineController(ControllerBase):
         self.model.load_state_dict(torch.load(path_to_model))
         self.loaded_from_file = True
 
+    def _prepare_batch(self, curr_doc):
+        """ Returns the data needed to score all head mentions of `curr_doc` at once: features, (head, candidate)
+        positions and columns of candidate pairs (see `DocumentPairFeatures`) in the padded candidate score matrix, the
+        number of candidates of each head and the mask of ground truth antecedents in the score matrix, shape
+        [num_mentions (heads), 1 + max_candidates (dummy + candidates)]. """
+        doc_features = DocumentPairFeatures.for_document(curr_doc, candidate_window=self.candidate_window,
+                                                         prune_candidates=self.prune_candidates)
+        mention_ids = doc_features.mention_ids
+        num_mentions = len(mention_ids)
+
+        mention_to_cluster_id = {}
+        for i, curr_cluster in enumerate(curr_doc.clusters):
+            for mid in curr_cluster:
+                mention_to_cluster_id[mid] = i
+        cluster_ids = np.array([mention_to_cluster_id[mid] for mid in mention_ids])
+
+        idx_heads, idx_cands = doc_features.idx_heads, doc_features.idx_cands
+        num_candidates = np.diff(doc_features.head_offsets)
+        # Candidate at k-th position of a head goes into column (1 + k), column 0 is reserved for the dummy antecedent
+        columns = 1 + np.arange(idx_heads.shape[0]) - doc_features.head_offsets[idx_heads]
+        # If there are no ground truth antecedents among candidates, the dummy antecedent is the ground truth
+        is_antecedent = np.zeros((num_mentions, 1 + int(np.max(num_candidates, initial=0))), dtype=bool)
+        is_antecedent[idx_heads, columns] = cluster_ids[idx_heads] == cluster_ids[idx_cands]
+        is_antecedent[:, 0] = np.logical_not(np.any(is_antecedent[:, 1:], axis=1))
+
+        return {
+            "mention_ids": mention_ids,
+            "features": doc_features.features,
+            "idx_heads": idx_heads,
+            "idx_cands": idx_cands,
+            "columns": columns,
+            "num_candidates": num_candidates,
+            "is_antecedent": is_antecedent
+        }
+
+    @staticmethod
+    def _ranking_loss(cand_scores, is_antecedent):
+        """ Mention-ranking loss of each head, averaged over all its ground truth antecedents. Masked candidates must
+        have a score of -inf. """
+        log_probas = torch.log_softmax(cand_scores, dim=-1)
+        return -torch.sum(log_probas.masked_fill(torch.logical_not(is_antecedent), 0.0), dim=-1) / \
+               torch.sum(is_antecedent, dim=-1)
+
+    def _train_doc_batched(self, curr_doc, eval_mode=False):
+        """ Trains/evaluates (if `eval_mode` is True) model on specific document, processing all head mentions at once.
+            Returns predictions, loss and number of examples evaluated. """
+        batch = self._prepare_batch(curr_doc)
+        mention_ids = batch["mention_ids"]
+        num_mentions = len(mention_ids)
+
+        # Padded candidate scores: [num_mentions (heads), 1 + max_candidates (dummy + candidates)]
+        # Padding columns of heads with fewer candidates are masked out with -inf
+        pair_scores = self.model(torch.from_numpy(batch["features"])).flatten()
+        cand_scores = torch.full(batch["is_antecedent"].shape, -float("inf"))
+        cand_scores[:, 0] = 0.0
+        cand_scores[torch.from_numpy(batch["idx_heads"]), torch.from_numpy(batch["columns"])] = pair_scores
+
+        # Heads without candidates (e.g. the first mention) have nothing to rank
+        has_candidates = torch.from_numpy(batch["num_candidates"] > 0)
+        num_examples = int(torch.sum(has_candidates))
+        head_losses = self._ranking_loss(cand_scores, torch.from_numpy(batch["is_antecedent"]))
+        doc_loss = torch.sum(head_losses[has_candidates])
+
+        if not eval_mode and num_examples > 0:
+            doc_loss.backward()
+            self.model_optimizer.step()
+            self.model_optimizer.zero_grad()
+
+        preds = {}
+        # Position of the k-th candidate of a head in `idx_cands` is (offset of the head + k - 1)
+        offsets = np.cumsum(batch["num_candidates"]) - batch["num_candidates"]
+        for idx_head, (head_id, curr_pred) in enumerate(zip(mention_ids, torch.argmax(cand_scores, dim=-1).tolist())):
+            antecedent_id = mention_ids[batch["idx_cands"][offsets[idx_head] + curr_pred - 1]] if curr_pred > 0 \
+                else None
+            # { antecedent: [mention(s)] } pair
+            existing_refs = preds.get(antecedent_id, [])
+            existing_refs.append(head_id)
+            preds[antecedent_id] = existing_refs
+
+        return preds, (float(doc_loss), num_examples)
+
+    def _stack_batches(self, docs):
+        """ Combines the data of all head mentions in `docs`: pair features of all documents and, for each document,
+        (padded) indices of its pairs in these features for each head, with -1 for masked candidates, along with the
+        mask of ground truth antecedents, shape [num_doc_heads, 1 + max_doc_candidates]. Candidates are only padded
+        inside a document, so a long document does not inflate the data of all other documents. """
+        all_features, doc_batches = [], []
+        num_pairs = 0
+        for curr_doc in docs:
+            if len(curr_doc.mentions) < 2:
+                continue
+
+            batch = self._prepare_batch(curr_doc)
+            # Heads without candidates (e.g. the first mention of a document) have nothing to rank
+            has_candidates = batch["num_candidates"] > 0
+            if not np.any(has_candidates):
+                continue
+
+            row_of_head = np.cumsum(has_candidates) - 1
+            pair_index = np.full((int(np.sum(has_candidates)), batch["is_antecedent"].shape[1]), -1, dtype=np.int64)
+            pair_index[row_of_head[batch["idx_heads"]], batch["columns"]] = \
+                num_pairs + np.arange(batch["features"].shape[0])
+
+            all_features.append(batch["features"])
+            doc_batches.append((torch.from_numpy(pair_index),
+                                torch.from_numpy(batch["is_antecedent"][has_candidates])))
+            num_pairs += batch["features"].shape[0]
+
+        features = np.concatenate(all_features) if len(all_features) > 0 \
+            else np.zeros((0, self.num_features), dtype=np.float32)
+        return torch.from_numpy(features), doc_batches
+
+    def _stacked_loss(self, features, doc_batches):
+        """ Returns the mean loss over all heads in a batch, created with `_stack_batches()`. """
+        pair_scores = self.model(features).flatten()
+        total_loss, num_heads = 0.0, 0
+        for pair_index, is_antecedent in doc_batches:
+            cand_scores = torch.where(pair_index >= 0, pair_scores[pair_index.clamp(min=0)],
+                                      torch.tensor(-float("inf")))
+            cand_scores = torch.cat((torch.zeros((cand_scores.shape[0], 1)), cand_scores[:, 1:]), dim=1)
+            total_loss = total_loss + torch.sum(self._ranking_loss(cand_scores, is_antecedent))
+            num_heads += is_antecedent.shape[0]
+
+        return total_loss / num_heads
+
+    def _train_full_batch(self, train_docs, dev_docs, max_iter=LBFGS_MAX_ITER):
+        """ Fits the model on all training mention pairs at once with L-BFGS. This is possible since the loss is convex
+        in the parameters of the (linear) model. Returns the validation loss. """
+        logging.info("Starting full-batch training (L-BFGS)")
+        t_start = time.time()
+
+        train_batch = self._stack_batches(train_docs)
+        dev_batch = self._stack_batches(dev_docs)
+        if len(train_batch[1]) == 0:
+            raise ValueError("Training documents contain no mentions with candidate antecedents")
+
+        optimizer = optim.LBFGS(self.model.parameters(), lr=1.0, max_iter=max_iter, line_search_fn="strong_wolfe")
+        self.train_mode()
+
+        def closure():
+            optimizer.zero_grad()
+            loss = self._stacked_loss(*train_batch)
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+
+        self.eval_mode()
+        with torch.no_grad():
+            train_loss = float(self._stacked_loss(*train_batch))
+            dev_loss = float(self._stacked_loss(*dev_batch)) if len(dev_batch[1]) > 0 else 0.0
+
+        logging.info(f"Training complete: training loss: {train_loss: .4f}, dev loss: {dev_loss: .4f} "
+                     f"[took {time.time() - t_start:.2f}s]")
+        self.save_pretrained(self.path_model_dir)
+
+        # Add model train scores to model metadata
+        with open(self.path_metadata, "a", encoding="utf-8") as f:
+            logging.info(f"Saving best validation score to {self.path_metadata}")
+            f.writelines([
+                "\n",
+                "Train model scores:\n",
+                f"Best validation set loss: {dev_loss}\n",
+            ])
+
+        return dev_loss
+
+    def train(self, epochs, train_docs, dev_docs):
+        # Note: L-BFGS always runs until convergence (or `LBFGS_MAX_ITER` iterations), so `epochs` is not used
+        if self.solver == "lbfgs":
+            return self._train_full_batch(train_docs, dev_docs)
+
+        return super().train(epochs, train_docs, dev_docs)
+
     def _train_doc(self, curr_doc, eval_mode=False):
         """ Trains/evaluates (if `eval_mode` is True) model on specific document.
             Returns predictions, loss and number of examples evaluated. """
@@ -361,6 +326,9 @@ class BaselineController(ControllerBase):
         if len(curr_doc.mentions) == 0:
             return {}, (0.0, 0)
 
+        if self.batched:
+            return self._train_doc_batched(curr_doc, eval_mode=eval_mode)
+
         cluster_sets = []
         mention_to_cluster_id = {}
         for i, curr_cluster in enumerate(curr_doc.clusters):
@@ -370,59 +338,51 @@ class BaselineController(ControllerBase):
 
         doc_loss, n_examples = 0.0, 0
         preds = {}
+        doc_features = DocumentPairFeatures.for_document(curr_doc, candidate_window=self.candidate_window,
+                                                         prune_candidates=self.prune_candidates)
 
-        for idx_head, (head_id, head_mention) in enumerate(curr_doc.mentions.items(), 1):
-            logging.debug(f"**#{idx_head} Mention '{head_id}': {head_mention}**")
+        for idx_head, (head_id, head_mention) in enumerate(curr_doc.mentions.items()):
+            logging.debug(f"**#{idx_head + 1} Mention '{head_id}': {head_mention}**")
 
             gt_antecedent_ids = cluster_sets[mention_to_cluster_id[head_id]]
 
             # Note: no features for dummy antecedent (len(`features`) is one less than `candidates`)
-            candidates, features = [None], []
-            gt_antecedents = []
-
-            # TODO: this could be improved: only consider a window of antecedent candidates, not all preceding mentions
-            for idx_candidate, (cand_id, cand_mention) in enumerate(curr_doc.mentions.items(), 1):
-                if cand_id != head_id and cand_id in gt_antecedent_ids:
-                    gt_antecedents.append(idx_candidate)
-
-                # Obtain scores for candidates and select best one as antecedent
-                if idx_candidate == idx_head:
-                    if len(features) > 0:
-                        features = torch.tensor(np.array(features, dtype=np.float32))
-
-                        cand_scores = self.model(features)
-                        cand_scores = torch.cat((torch.tensor([0.]), cand_scores.flatten())).unsqueeze(0)  # [1, #cands]
-
-                        # if no other antecedent exists for mention, then it's a first mention (GT is dummy antecedent)
-                        if len(gt_antecedents) == 0:
-                            gt_antecedents.append(0)
-
-                        curr_pred = torch.argmax(cand_scores)
-                        # (average) loss over all ground truth antecedents
-                        curr_loss = self.loss(torch.repeat_interleave(cand_scores, repeats=len(gt_antecedents), dim=0),
-                                              torch.tensor(gt_antecedents))
-
-                        doc_loss += float(curr_loss)
-                        n_examples += 1
-
-                        if not eval_mode:
-                            curr_loss.backward()
-                            self.model_optimizer.step()
-                            self.model_optimizer.zero_grad()
-                    else:
-                        # Only one candidate antecedent = first mention
-                        curr_pred = 0
-
-                    # { antecedent: [mention(s)] } pair
-                    existing_refs = preds.get(candidates[int(curr_pred)], [])
-                    existing_refs.append(head_id)
-                    preds[candidates[int(curr_pred)]] = existing_refs
-                    break
-                else:
-                    # Add current mention as candidate
-                    candidates.append(cand_id)
-                    features.append(
-                        MentionPairFeatures.for_mentions(curr_doc, head_mention, cand_mention))
+            cand_positions, features = doc_features.for_head(idx_head)
+            candidates = [None] + [doc_features.mention_ids[idx_cand] for idx_cand in cand_positions]
+            gt_antecedents = [idx_candidate for idx_candidate, cand_id in enumerate(candidates[1:], 1)
+                              if cand_id in gt_antecedent_ids]
+
+            # Obtain scores for candidates and select best one as antecedent
+            if len(features) > 0:
+                features = torch.from_numpy(features)
+
+                cand_scores = self.model(features)
+                cand_scores = torch.cat((torch.tensor([0.]), cand_scores.flatten())).unsqueeze(0)  # [1, #cands]
+
+                # if no other antecedent exists for mention, then it's a first mention (GT is dummy antecedent)
+                if len(gt_antecedents) == 0:
+                    gt_antecedents.append(0)
+
+                curr_pred = torch.argmax(cand_scores)
+                # (average) loss over all ground truth antecedents
+                curr_loss = self.loss(torch.repeat_interleave(cand_scores, repeats=len(gt_antecedents), dim=0),
+                                      torch.tensor(gt_antecedents))
+
+                doc_loss += float(curr_loss)
+                n_examples += 1
+
+                if not eval_mode:
+                    curr_loss.backward()
+                    self.model_optimizer.step()
+                    self.model_optimizer.zero_grad()
+            else:
+                # No candidates (e.g. the first mention), only the dummy antecedent
+                curr_pred = 0
+
+            # { antecedent: [mention(s)] } pair
+            existing_refs = preds.get(candidates[int(curr_pred)], [])
+            existing_refs.append(head_id)
+            preds[candidates[int(curr_pred)]] = existing_refs
 
         return preds, (doc_loss, n_examples)
 
@@ -524,14 +484,24 @@ if __name__ == "__main__":
         torch.random.manual_seed(args.random_seed)
         np.random.seed(args.random_seed)
 
+    configure_feature_cache(args)
     documents = read_corpus(args.dataset)
+    if args.feature_store_dir is not None:
+        feature_store = PairFeatureStore(args.feature_store_dir)
+        feature_store.precompute(documents, workers=(os.cpu_count() or 1), candidate_window=args.candidate_window,
+                                 prune_candidates=args.prune_candidates)
+        use_feature_store(feature_store)
 
 
     def create_model_instance(model_name, **override_kwargs):
         return BaselineController(MentionPairFeatures.num_features(),
                                   model_name=model_name,
                                   learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
-                                  dataset_name=override_kwargs.get("dataset", args.dataset))
+                                  dataset_name=override_kwargs.get("dataset", args.dataset),
+                                  batched=args.batched,
+                                  solver=args.solver,
+                                  candidate_window=args.candidate_window,
+                                  prune_candidates=args.prune_candidates)
 
     # Train model
     if args.dataset == "coref149":
@@ -618,3 +588,5 @@ if __name__ == "__main__":
         aio_model.evaluate(test_docs)
         eio_model = EachInOwnModel(model)
         eio_model.evaluate(test_docs)
+
+    logging.info(f"Feature cache: {feature_cache}")
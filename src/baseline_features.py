@@ -0,0 +1,641 @@
+""" Features of mentions and mention pairs, used by the baseline model (see `baseline.py`).
+
+This module does not depend on torch, so the features can also be computed in a lightweight inference process (see
+`baseline_inference.py`).
+"""
+import logging
+import os
+import sys
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+import msd
+import numpy as np
+from pyjarowinkler import distance as jwdistance
+
+
+class DocumentFeatureCache:
+    """ Cache of features (useful for doing multiple epochs over data), grouped by document and keyed by the document
+    fingerprint, so documents with colliding IDs or changed content never share features.
+
+    The (estimated) size of cached features is kept under `max_bytes` by evicting whole documents, least recently used
+    first. The most recently used document is never evicted, even if its features alone exceed the budget.
+    """
+    def __init__(self, max_bytes=1024 * 2 ** 20):
+        self.max_bytes = max_bytes
+        # Format: {doc1_fingerprint: {"size": <estimated bytes>, "values": {key: <features>, ...}}, ...}
+        self._documents = OrderedDict()
+        self.size = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, document, key):
+        """ Returns features, stored under `key` for `document`, or None if they are not cached. """
+        doc_entry = self._documents.get(document.fingerprint())
+        value = doc_entry["values"].get(key) if doc_entry is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._documents.move_to_end(document.fingerprint())
+        return value
+
+    def put(self, document, key, value, size=None):
+        """ Stores features `value` (of `size` bytes, estimated with `estimated_size()` if not given) under `key` for
+        `document`. """
+        size = size if size is not None else estimated_size(value)
+        doc_entry = self._documents.setdefault(document.fingerprint(), {"size": 0, "values": {}})
+        self._documents.move_to_end(document.fingerprint())
+        if key not in doc_entry["values"]:
+            doc_entry["size"] += size
+            self.size += size
+        doc_entry["values"][key] = value
+
+        while self.size > self.max_bytes and len(self._documents) > 1:
+            _, evicted_entry = self._documents.popitem(last=False)
+            self.size -= evicted_entry["size"]
+            self.evictions += 1
+
+    def clear(self):
+        self._documents.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __str__(self):
+        return f"DocumentFeatureCache({len(self._documents)} documents, {self.size / 2 ** 20:.1f}/" \
+               f"{self.max_bytes / 2 ** 20:.1f}MB, {self.hits} hits, {self.misses} misses, {self.evictions} evictions)"
+
+
+# Values inside containers that are counted by `estimated_size()` (other objects, e.g. tokens, are shared)
+_PLAIN_TYPES = (str, bytes, int, float)
+
+
+def _container_size(value):
+    """ Returns the size of `value` and, if it is a container, of the plain values (e.g. strings) inside it. """
+    if isinstance(value, dict):
+        items = chain(value.keys(), value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = value
+    else:
+        return sys.getsizeof(value)
+    return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in items if isinstance(item, _PLAIN_TYPES))
+
+
+def estimated_size(value):
+    """ Estimates the memory (in bytes) occupied by cached features `value`: `nbytes` of arrays (and objects holding
+    arrays), otherwise the size of the object, of the values it directly references and of the plain values (e.g.
+    strings) inside referenced containers. Tokens and mentions are shared with the document, so only references to
+    them are counted. """
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+
+    if isinstance(value, dict):
+        fields = chain(value.keys(), value.values())
+    elif isinstance(value, (list, tuple, set)):
+        fields = value
+    else:
+        fields = vars(value).values() if hasattr(value, "__dict__") else []
+    return sys.getsizeof(value) + sum(_container_size(field) for field in fields)
+
+
+# Bump this whenever pair features change (invalidates features in existing feature stores)
+FEATURE_SET_VERSION = 3
+# Categories of content words (noun, adjective, verb, adverb, abbreviation) in each tagset (see `Document.tagset`),
+# whose lemmas are indexed when generating candidate pairs (see `DocumentPairFeatures.candidate_pairs()`)
+CONTENT_WORD_CATEGORIES = {msd.TAGSET_SL: {"S", "P", "G", "R", "O"}, msd.TAGSET_EN: {"N", "A", "V", "R", "Y"}}
+# Positions of features comparing mention strings (string match, prefix, suffix, Jaro-Winkler similarity, alias), which
+# are only computed for pairs selected by `DocumentPairFeatures.candidate_pairs()` if a candidate window is used
+STRING_FEATURES = [1, 4, 5, 6, 8]
+# On-disk store of pair features, if used (see `use_feature_store()`)
+_feature_store = None
+
+# Cache features for single mentions (key: ("mention", mention_id)), mention pairs (key: ("pair", mention1_id,
+# mention2_id)) and all mention pairs in document (key: ("all_pairs", candidate_window, prune_candidates))
+feature_cache = DocumentFeatureCache()
+
+
+def configure_feature_cache(args):
+    """ Applies the feature cache options of the baseline parser (`--feature_cache_mb`) to the shared feature cache.
+    Call it in every entry point, after parsing the arguments. """
+    feature_cache.max_bytes = args.feature_cache_mb * 2 ** 20
+
+
+class MentionFeatures:
+
+    # Useful resource for parsing the morphosyntactic properties:
+    # http://nl.ijs.si/ME/V5/msd/html/msd-sl.html#msd.categories-sl
+
+    @staticmethod
+    def for_mention(document, mention, use_cache=True):
+        # load from cache, if enabled and it exists
+        if use_cache:
+            mf = feature_cache.get(document, ("mention", mention.mention_id))
+            if mf is not None:
+                return mf
+
+        # otherwise create and store to cache
+        mf = MentionFeatures(document, mention)
+        if use_cache:
+            feature_cache.put(document, ("mention", mention.mention_id), mf)
+        return mf
+
+    def __init__(self, document, mention):
+        """
+        Extract features for a given mention in the given document.
+        Note: Some mention features are actually just properties of mention's tokens
+        """
+        self.mention = mention
+        self.tokens = mention.tokens
+        self.lemmas = [token.lemma for token in mention.tokens]  # Note: if token has no lemma, it is "None"!
+        # Strings used in pair features, computed once per mention instead of once per pair
+        self.raw_text = mention.raw_text()
+        self.lemma_text = mention.lemma_text()
+        self.initials = [tok.raw_text[0] for tok in mention.tokens]
+        self.token_set = set(mention.tokens)
+
+        # Index of sentence in which mention appears and position of mention's first token inside it
+        self.sentence_index, self.position_in_sentence, _ = document.mention_offsets[mention.mention_id]
+
+        # Index in which mention appears in the document (based on mentions). Example:
+        # (">Janez Novak< je svoji >ženi >Mojci<< je kupil nov >kavomat<")
+        # (  i=0                    i=1   i=2                   i=3
+        self.mention_index = document.mention_positions[mention.mention_id]
+
+        # morphosyntactic description
+        self.msd_desc = self.mention.tokens[0].msd
+        self.msd_info = self.mention.tokens[0].msd_info
+
+        # gender, number, main category
+        self.gender = None  # {None, 'm', 's', 'z'}
+        self.number = None  # {None, 'e', 'd', 'm'}
+        self.categories = Counter()  # {'S', 'G', 'P', 'Z', ...}
+
+        counted_categories = Counter()
+        for token in mention.tokens:
+            # Take gender of first token for which it can be determined
+            if self.gender is None:
+                if token.gender in {"m", "z", "s"}:
+                    self.gender = token.gender
+
+            # Take number of first token for which it can be determined
+            if self.number is None:
+                if token.number in {"e", "d", "m"}:
+                    self.number = token.number
+
+            # Count how many times each category appears in mention's tokens and take the most common one as the actual
+            # mention's category
+            counted_categories[token.category] += 1
+
+        self.category = counted_categories.most_common(1)[0][0]
+
+
+class MentionPairFeatures:
+
+    @staticmethod
+    def for_mentions(document, head_mention, cand_mention, use_cache=True):
+        head_id, cand_id = head_mention.mention_id, cand_mention.mention_id
+        # load from cache, if enabled and it exists
+        if use_cache:
+            pair_features = feature_cache.get(document, ("pair", head_id, cand_id))
+            if pair_features is not None:
+                return pair_features
+
+        head_features = MentionFeatures.for_mention(document, head_mention)
+        cand_features = MentionFeatures.for_mention(document, cand_mention)
+
+        pair_features = [
+            MentionPairFeatures.in_same_sentence(head_features, cand_features),
+            MentionPairFeatures.str_match(head_features, cand_features),
+            MentionPairFeatures.is_same_gender(head_features, cand_features),
+            MentionPairFeatures.is_same_number(head_features, cand_features),
+            MentionPairFeatures.is_prefix(head_features, cand_features),
+            MentionPairFeatures.is_suffix(head_features, cand_features),
+            MentionPairFeatures.jaro_winkler_dist(head_features, cand_features),
+            MentionPairFeatures.is_appositive(head_features, cand_features, document),
+            MentionPairFeatures.is_alias(head_features, cand_features),
+            MentionPairFeatures.is_reflexive(head_features, cand_features),
+        ]
+
+        # add features for mention pair, constructed above, to cache
+        if use_cache:
+            feature_cache.put(document, ("pair", head_id, cand_id), pair_features)
+        return pair_features
+
+    @staticmethod
+    def num_features():
+        return 10  # corresponds to number of features returned by `MentionPairFeatures.for_mentions(...)`
+
+    # !! Note
+    # this_feats == head_features
+    # other_feats == cand_features
+    # meaning that, if order in document is important, "other" is before "this"!
+
+    @staticmethod
+    def str_match(this_feats, other_feats):
+        """
+        True:  if neither mentions (this and other) are pronouns and mention's lemmas match
+        False: otherwise
+        """
+        return int(this_feats.category != "Z" and other_feats.category != "Z" and
+                   this_feats.lemma_text == other_feats.lemma_text)
+
+    @staticmethod
+    def in_same_sentence(this_feats, other_feats):
+        """
+        True:  If mentions this and other are in the same sentence
+        False: otherwise
+        """
+        return int(this_feats.sentence_index == other_feats.sentence_index)
+
+    @staticmethod
+    def is_same_gender(this_feats, other_feats):
+        """
+        One-hot encoded vector if this and other mention:
+        [ match in gender, do not match in gender, gender can't be determined ]
+        """
+        is_same_gender = None
+        if this_feats.gender is not None and other_feats.gender is not None:
+            is_same_gender = this_feats.gender == other_feats.gender
+
+        return int(is_same_gender is True)
+
+    @staticmethod
+    def is_same_number(this_feats, other_feats):
+        """
+        One-hot encoded vector if this and other mention:
+        [ match in number, do not match in number, number can't be determined]
+        """
+        is_same_number = None
+        if this_feats.number is not None and other_feats.number is not None:
+            is_same_number = this_feats.number == other_feats.number
+
+        return int(is_same_number is True)
+
+    @staticmethod
+    def is_appositive(this_feats, other_feats, document):
+        """
+        Two mentions are assumed appositive, if:
+            - they are of NP, NN POS tag or other noun-related tag
+            - previous mention is followed by comma (i.e. ...Janez Novak, predsednik drustva...)
+        """
+        # TODO remarks: zadeva pozitivne primere vzame tudi naštevanja samostalnikov...
+        # if both mentions are nouns
+        if this_feats.category == "S" and other_feats.category == "S":
+            # if both mentions are in same sentence
+            if this_feats.sentence_index == other_feats.sentence_index:
+                # "other" mention is positioned before "this" mention. to get distance in tokens between mentions,
+                # we need distance from last token of "other" mention to first token in "this" mention
+                # TODO: could generalize by comparing this and other first token position within sentence
+                other_last_token_pos = other_feats.position_in_sentence + len(other_feats.tokens)
+                this_first_token_pos = this_feats.position_in_sentence
+                if this_first_token_pos - other_last_token_pos == 1:
+                    # there's exactly one token betwen, check if it's a comma
+                    if document.tokens[document.sents[this_feats.sentence_index][other_last_token_pos]].raw_text == ",":
+                        return int(True)
+        return int(False)
+
+    @staticmethod
+    def is_alias(this_feats, other_feats):
+        """
+        One mention is considered an alias of another, if:
+            - word or initials match exactly, or
+            - mentions match partially (i.e. Marija Novak <-> gospa Novak)
+            - one mention is a token subset of another (i.e. Janez Novak <-> Novak)
+        """
+        # TODO remarks: initials pade pri netrivialnih primerih.
+        #               Primer: "Ministrstvo za kmetijstvo, gozdrastvo in prehrano" se inicira z "MKGIP", ne "MZK,GIP"
+        this_initials = this_feats.initials
+        other_initials = other_feats.initials
+        this_words = this_feats.raw_text
+        other_words = other_feats.raw_text
+
+        # mentions are equal or one is initial of another
+        if this_words == other_words or this_initials == other_initials or this_words == other_initials or this_initials == other_words:
+            return int(True)
+
+        # TODO remarks: return true on first match, which may not be specific enough (i.e. Janez Novak <-> Peter Novak
+        #               sta lahko različni omembi...)
+        if not this_feats.token_set.isdisjoint(other_feats.token_set):
+            return int(True)
+
+        return int(False)
+
+    @staticmethod
+    def is_prefix(this_feats, other_feats):
+        """
+        True:  if this mention is prefix of other mention (or vice versa)
+        False: otherwise
+        """
+        this_raw = this_feats.raw_text
+        other_raw = other_feats.raw_text
+        if this_raw.startswith(other_raw) or other_raw.startswith(this_raw):
+            return int(True)
+        return int(False)
+
+    @staticmethod
+    def is_suffix(this_feats, other_feats):
+        """
+        True:  if this mention is suffix of other mention (or vice versa)
+        False: otherwise
+        """
+        this_raw = this_feats.raw_text
+        other_raw = other_feats.raw_text
+        if this_raw.endswith(other_raw) or other_raw.endswith(this_raw):
+            return int(True)
+        return int(False)
+
+    @staticmethod
+    def jaro_winkler_dist(this_feats, other_feats):
+        """
+        Result is a similarity value between this and other mention according to Jaro-Winkler metric.
+        """
+        return jwdistance.get_jaro_distance(this_feats.raw_text, other_feats.raw_text)
+
+    @staticmethod
+    def is_reflexive(this_feats, other_feats):
+        """
+        True:  if this mention is reflexive and distance between this and other mentions is 0 (i.e. there are no other
+               mentions between those two)
+        False: otherwise
+
+        Reflexive pronoun = povratni zaimek
+        primer: "<Nueri> se, na primer, spominjajo <svojih> prednikov...", kjer je <svojih> povratni zaimek in se nanaša
+        na omenitev takoj prej, <Nueri>
+
+        note: izjeme so lahko dobsedeni navedki v navednicah!
+        primer: ",,Prepričan <sem>, da ne bomo razočarali'', napoveduje Matjaž Brumen.", v tem primeru se <sem> nanaša
+        na naslednjo omenitev t.j. <Matjaž Brumen>, ki je dobsedni navedek "izrekel".
+        """
+        if this_feats.msd_info.category == "Z" and this_feats.msd_info.subtype == "p" and this_feats.mention_index - other_feats.mention_index == 1:
+            return int(True)
+
+        return int(False)
+
+
+class DocumentPairFeatures:
+    """ Features of (head, candidate) mention pairs in a document, computed at once with NumPy. The values are the
+    same as `MentionPairFeatures.for_mentions(document, head_mention, cand_mention)`.
+
+    Pairs are sorted by head and then by candidate position: candidates of the mention at position `i` are
+    `idx_cands[head_offsets[i]: head_offsets[i + 1]]` and features of these pairs are at the same positions in
+    `features`. Unless candidates are pruned, all pairs where the candidate precedes the head are kept (i.e. the packed
+    lower triangle of the [num_mentions, num_mentions, num_features] feature tensor). """
+
+    @staticmethod
+    def for_document(document, use_cache=True, candidate_window=None, prune_candidates=False):
+        """ Returns features of candidate mention pairs in `document` (see `compute()`), loading them from the
+        in-memory cache or the on-disk feature store (see `use_feature_store()`) if possible. """
+        cache_key = ("all_pairs", candidate_window, prune_candidates)
+        if use_cache:
+            doc_features = feature_cache.get(document, cache_key)
+            if doc_features is not None:
+                return doc_features
+
+        pairs = _feature_store.load(document, candidate_window, prune_candidates) \
+            if _feature_store is not None else None
+        if pairs is None:
+            pairs = DocumentPairFeatures.compute(document, candidate_window=candidate_window,
+                                                 prune_candidates=prune_candidates, use_cache=use_cache)
+            if _feature_store is not None:
+                _feature_store.save(document, pairs, candidate_window, prune_candidates)
+
+        doc_features = DocumentPairFeatures(list(document.mentions.keys()), *pairs)
+        if use_cache:
+            feature_cache.put(document, cache_key, doc_features)
+        return doc_features
+
+    def __init__(self, mention_ids, features, idx_heads, idx_cands):
+        self.mention_ids = mention_ids
+        self.features = features
+        self.idx_heads = idx_heads
+        self.idx_cands = idx_cands
+        self.head_offsets = np.searchsorted(idx_heads, np.arange(len(mention_ids) + 1))
+
+    @property
+    def nbytes(self):
+        return self.features.nbytes + self.idx_heads.nbytes + self.idx_cands.nbytes + self.head_offsets.nbytes
+
+    @staticmethod
+    def candidate_pairs(mention_feats, candidate_window, tagset=msd.TAGSET_SL):
+        """ Returns (head, candidate) positions of mention pairs which are likely to corefer, sorted by head and
+        candidate: the candidate is at most `candidate_window` mentions before the head, or both mentions share a key
+        in the inverted index of the document (a content word lemma, the initials or the head (= last) token).
+        `tagset` is the tagset of token MSD tags (see `Document.tagset`).
+
+        Only the pairs inside the window and inside the posting lists are enumerated, so the number of generated pairs
+        grows close to linearly with the number of mentions. """
+        num_mentions = len(mention_feats)
+        content_categories = CONTENT_WORD_CATEGORIES[tagset]
+
+        inverted_index = {}
+        for idx_mention, feats in enumerate(mention_feats):
+            # Function words and punctuation are shared by many unrelated mentions, so they are not indexed
+            curr_keys = {("lemma", tok.lemma) for tok in feats.tokens
+                         if tok.lemma is not None and tok.category in content_categories}
+            curr_keys.add(("initials", tuple(feats.initials)))
+            curr_keys.add(("head", feats.tokens[-1].raw_text.lower()))
+            for key in curr_keys:
+                inverted_index.setdefault(key, []).append(idx_mention)
+
+        # Pairs inside the window: candidates (head - window), ..., (head - 1) of each head
+        num_window_cands = np.minimum(np.arange(num_mentions), candidate_window)
+        window_heads = np.repeat(np.arange(num_mentions, dtype=np.int64), num_window_cands)
+        window_cands = window_heads - (1 + np.arange(window_heads.shape[0]) -
+                                       np.repeat(np.cumsum(num_window_cands) - num_window_cands, num_window_cands))
+
+        # Codes (head * num_mentions + candidate) of pairs inside the window and inside each posting list
+        pair_codes = [window_heads * num_mentions + window_cands]
+        for postings in inverted_index.values():
+            if len(postings) > 1:
+                postings = np.array(postings, dtype=np.int64)
+                posting_heads, posting_cands = np.tril_indices(len(postings), k=-1)
+                pair_codes.append(postings[posting_heads] * num_mentions + postings[posting_cands])
+
+        # np.unique() also sorts the codes, i.e. pairs by head and candidate
+        pair_codes = np.unique(np.concatenate(pair_codes))
+        return pair_codes // max(1, num_mentions), pair_codes % max(1, num_mentions)
+
+    @staticmethod
+    def compute(document, candidate_window=None, prune_candidates=False, use_cache=True):
+        """ Computes the features of candidate mention pairs in `document`. Returns the features, head positions and
+        candidate positions of pairs (see `DocumentPairFeatures`).
+
+        All mentions preceding the head are candidates. If `candidate_window` is set, the (expensive) string features
+        (see `STRING_FEATURES`) are only computed for pairs selected by `candidate_pairs()` and are 0 for other pairs.
+        If `prune_candidates` is also set, only the selected pairs are candidates, so the cost of features grows close
+        to linearly with the number of mentions, but a correct antecedent outside the selected pairs can not be found.
+        If `use_cache` is False, features of single mentions are not cached either. """
+        mention_feats = [MentionFeatures.for_mention(document, mention, use_cache=use_cache)
+                         for mention in document.mentions.values()]
+        num_mentions = len(mention_feats)
+
+        def _encode(values):
+            """ Maps (hashable) values to integer IDs, so that equal values get equal IDs. """
+            value_to_id = {}
+            return np.array([value_to_id.setdefault(value, len(value_to_id)) for value in values], dtype=np.int32)
+
+        raw_texts = [feats.raw_text for feats in mention_feats]
+        sentence_index = np.array([feats.sentence_index for feats in mention_feats], dtype=np.int32)
+        first_position = np.array([feats.position_in_sentence for feats in mention_feats], dtype=np.int32)
+        # Position right after mention, as computed in `MentionPairFeatures.is_appositive()`
+        end_position = first_position + np.array([len(feats.tokens) for feats in mention_feats], dtype=np.int32)
+        mention_index = np.array([feats.mention_index for feats in mention_feats], dtype=np.int32)
+        is_pronoun = np.array([feats.category == "Z" for feats in mention_feats], dtype=bool)
+        is_noun = np.array([feats.category == "S" for feats in mention_feats], dtype=bool)
+        is_reflexive = np.array([feats.msd_info.category == "Z" and feats.msd_info.subtype == "p"
+                                 for feats in mention_feats], dtype=bool)
+        gender_id = np.array([msd.attribute_id(feats.gender) for feats in mention_feats], dtype=np.int8)
+        number_id = np.array([msd.attribute_id(feats.number) for feats in mention_feats], dtype=np.int8)
+        lemma_id = _encode(feats.lemma_text for feats in mention_feats)
+        # Distinct mention strings (`raw_id` indexes into `unique_raw_texts`)
+        raw_id = _encode(raw_texts)
+        unique_raw_texts = list(dict.fromkeys(raw_texts))
+        initials_id = _encode(tuple(feats.initials) for feats in mention_feats)
+        # Whether the token right after mention is a comma (only checked for potential appositions)
+        followed_by_comma = np.array([end_pos < len(document.sents[sent_idx]) and
+                                      document.tokens[document.sents[sent_idx][end_pos]].raw_text == ","
+                                      for sent_idx, end_pos in zip(sentence_index.tolist(), end_position.tolist())],
+                                     dtype=bool)
+
+        # `string_pairs` selects the pairs (of `heads` and `cands`) for which the string features are computed
+        string_pairs = slice(None)
+        if candidate_window is not None and prune_candidates:
+            heads, cands = DocumentPairFeatures.candidate_pairs(mention_feats, candidate_window, document.tagset)
+        else:
+            # Row-major order of indices matches the packing of the lower triangle
+            heads, cands = np.tril_indices(num_mentions, k=-1)
+            if candidate_window is not None:
+                selected_heads, selected_cands = DocumentPairFeatures.candidate_pairs(mention_feats, candidate_window,
+                                                                                      document.tagset)
+                # Position of pair (i, j) in the packed lower triangle is i * (i - 1) / 2 + j
+                string_pairs = selected_heads * (selected_heads - 1) // 2 + selected_cands
+        features = np.zeros((heads.shape[0], MentionPairFeatures.num_features()), dtype=np.float32)
+
+        same_sentence = sentence_index[heads] == sentence_index[cands]
+        features[:, 0] = same_sentence
+        features[:, 2] = np.logical_and.reduce([gender_id[heads] != msd.NONE_ID, gender_id[cands] != msd.NONE_ID,
+                                                gender_id[heads] == gender_id[cands]])
+        features[:, 3] = np.logical_and.reduce([number_id[heads] != msd.NONE_ID, number_id[cands] != msd.NONE_ID,
+                                                number_id[heads] == number_id[cands]])
+        features[:, 7] = np.logical_and.reduce([is_noun[heads], is_noun[cands], same_sentence,
+                                                first_position[heads] - end_position[cands] == 1,
+                                                followed_by_comma[cands]])
+        features[:, 9] = np.logical_and(is_reflexive[heads], mention_index[heads] - mention_index[cands] == 1)
+
+        string_heads, string_cands = heads[string_pairs], cands[string_pairs]
+        features[string_pairs, 1] = np.logical_and.reduce([~is_pronoun[string_heads], ~is_pronoun[string_cands],
+                                                           lemma_id[string_heads] == lemma_id[string_cands]])
+
+        # Mentions sharing a token, enumerated through the mentions containing each token
+        mentions_of_token = {}
+        for idx_mention, feats in enumerate(mention_feats):
+            for tok in feats.token_set:
+                mentions_of_token.setdefault(tok.position_in_document, []).append(idx_mention)
+        sharing_codes = {idx_this * num_mentions + idx_other
+                         for curr_mentions in mentions_of_token.values()
+                         for idx_this in curr_mentions for idx_other in curr_mentions}
+        shares_token = np.isin(string_heads * num_mentions + string_cands,
+                               np.array(sorted(sharing_codes), dtype=np.int64))
+        # Note: a mention's words can never be equal to the other mention's initials (str vs list)
+        features[string_pairs, 8] = np.logical_or.reduce([raw_id[string_heads] == raw_id[string_cands],
+                                                          initials_id[string_heads] == initials_id[string_cands],
+                                                          shares_token])
+
+        # Prefix, suffix and Jaro-Winkler features are computed once per distinct pair of strings
+        pair_codes = raw_id[string_heads].astype(np.int64) * len(unique_raw_texts) + raw_id[string_cands]
+        unique_codes, pair_to_unique = np.unique(pair_codes, return_inverse=True)
+        unique_pairs = [divmod(code, len(unique_raw_texts)) for code in unique_codes.tolist()]
+        unique_pairs = [(unique_raw_texts[idx_this], unique_raw_texts[idx_other]) for idx_this, idx_other in unique_pairs]
+        unique_prefix = np.array([this_raw.startswith(other_raw) or other_raw.startswith(this_raw)
+                                  for this_raw, other_raw in unique_pairs], dtype=bool)
+        unique_suffix = np.array([this_raw.endswith(other_raw) or other_raw.endswith(this_raw)
+                                  for this_raw, other_raw in unique_pairs], dtype=bool)
+        unique_similarities = np.array([jwdistance.get_jaro_distance(this_raw, other_raw)
+                                        for this_raw, other_raw in unique_pairs], dtype=np.float32)
+        features[string_pairs, 4] = unique_prefix[pair_to_unique]
+        features[string_pairs, 5] = unique_suffix[pair_to_unique]
+        features[string_pairs, 6] = unique_similarities[pair_to_unique]
+
+        return features, heads, cands
+
+    def for_head(self, idx_head):
+        """ Returns positions of antecedent candidates of mention at position `idx_head` and features of pairs
+        between the mention and these candidates, shape [num_candidates, num_features]. """
+        start, end = self.head_offsets[idx_head], self.head_offsets[idx_head + 1]
+        return self.idx_cands[start: end], self.features[start: end]
+
+
+def _compute_pair_features(document, candidate_window=None, prune_candidates=False):
+    return DocumentPairFeatures.compute(document, candidate_window=candidate_window, prune_candidates=prune_candidates)
+
+
+class PairFeatureStore:
+    """ On-disk store of pair features, see `DocumentPairFeatures`. Features of each document are saved into
+    a compressed NumPy file, named after the document fingerprint and `FEATURE_SET_VERSION`, so they are reused across
+    CV folds and runs, and never served for documents or feature sets that have changed. """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, document, candidate_window=None, prune_candidates=False):
+        window_suffix = ""
+        if candidate_window is not None:
+            window_suffix = f"_w{candidate_window}{'p' if prune_candidates else ''}"
+        return os.path.join(self.store_dir, f"{document.fingerprint()}_v{FEATURE_SET_VERSION}{window_suffix}.npz")
+
+    def contains(self, document, candidate_window=None, prune_candidates=False):
+        return os.path.isfile(self._path(document, candidate_window, prune_candidates))
+
+    def load(self, document, candidate_window=None, prune_candidates=False):
+        """ Returns stored (features, head positions, candidate positions) of `document` or None if they are not
+        stored. """
+        path = self._path(document, candidate_window, prune_candidates)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with np.load(path) as stored:
+                return stored["features"], stored["idx_heads"], stored["idx_cands"]
+        except Exception as exc:
+            logging.warning(f"Could not read stored features at '{path}' ({exc}), ignoring them")
+            return None
+
+    def save(self, document, pairs, candidate_window=None, prune_candidates=False):
+        """ Stores (features, head positions, candidate positions) of `document`, as returned by
+        `DocumentPairFeatures.compute()`. """
+        # Write into a temporary file first, so that an interrupted write never leaves behind a corrupted file
+        path = self._path(document, candidate_window, prune_candidates)
+        tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+        features, idx_heads, idx_cands = pairs
+        np.savez_compressed(tmp_path, features=features, idx_heads=idx_heads, idx_cands=idx_cands)
+        os.replace(tmp_path, path)
+
+    def precompute(self, documents, workers=1, candidate_window=None, prune_candidates=False):
+        """ Computes and stores features of all `documents` that are not yet stored, spreading the work over a pool of
+        `workers` processes. """
+        missing_docs = [doc for doc in documents if not self.contains(doc, candidate_window, prune_candidates)]
+        windows = [candidate_window] * len(missing_docs)
+        prune_flags = [prune_candidates] * len(missing_docs)
+        logging.info(f"Precomputing pair features of {len(missing_docs)}/{len(documents)} documents "
+                     f"into '{self.store_dir}'")
+        if workers <= 1 or len(missing_docs) <= 1:
+            all_features = map(_compute_pair_features, missing_docs, windows, prune_flags)
+            for curr_doc, pairs in zip(missing_docs, all_features):
+                self.save(curr_doc, pairs, candidate_window, prune_candidates)
+        else:
+            chunksize = max(1, len(missing_docs) // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                all_features = executor.map(_compute_pair_features, missing_docs, windows, prune_flags,
+                                            chunksize=chunksize)
+                for curr_doc, pairs in zip(missing_docs, all_features):
+                    self.save(curr_doc, pairs, candidate_window, prune_candidates)
+
+
+def use_feature_store(store):
+    """ Makes `DocumentPairFeatures.for_document()` read features from (and write them into) `store`. Use None to
+    stop using a store. """
+    global _feature_store
+    _feature_store = store
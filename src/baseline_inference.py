@@ -0,0 +1,94 @@
+""" Torch-free inference with the baseline model.
+
+A trained `BaselineController` is exported into a small NumPy artifact (`BaselineController.export_numpy()`, also
+written by `save_pretrained()` as "baseline.npz"), which `BaselinePredictor` uses to reproduce the predictions of the
+controller in evaluation mode, without loading torch.
+
+Example (run from the src folder):
+$ python baseline_inference.py --model_path=baseline_model/baseline_senticoref_coref149/baseline.npz --dataset=coref149
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from baseline_features import DocumentPairFeatures, FEATURE_SET_VERSION
+from utils import get_clusters
+
+parser = argparse.ArgumentParser(description="Predict coreference clusters with an exported baseline model")
+parser.add_argument("--model_path", type=str, required=True)
+parser.add_argument("--dataset", type=str, default="coref149")
+parser.add_argument("--num_docs", type=int, default=None)
+
+
+class BaselinePredictor:
+    def __init__(self, weights, bias, candidate_window=None, prune_candidates=False):
+        # The dtype of the exported parameters is kept, so that scores match the ones of the controller
+        self.weights = np.asarray(weights)  # shape: [num_features]
+        self.bias = np.asarray(bias).reshape(())
+        self.candidate_window = candidate_window
+        self.prune_candidates = prune_candidates
+
+    @staticmethod
+    def from_file(path):
+        with np.load(path) as artifact:
+            feature_set_version = int(artifact["feature_set_version"])
+            if feature_set_version != FEATURE_SET_VERSION:
+                raise ValueError(f"Model at '{path}' was trained with feature set version {feature_set_version}, "
+                                 f"but the current version is {FEATURE_SET_VERSION}")
+
+            candidate_window = int(artifact["candidate_window"])
+            return BaselinePredictor(artifact["weights"], artifact["bias"],
+                                     candidate_window=(candidate_window if candidate_window >= 0 else None),
+                                     prune_candidates=bool(artifact["prune_candidates"]))
+
+    def predict(self, document):
+        """ Returns {antecedent: [mention(s)]} predictions, equal to the ones of `BaselineController._train_doc()` in
+        evaluation mode. """
+        if len(document.mentions) == 0:
+            return {}
+
+        # Features are not cached, so that memory use does not grow with the number of served documents
+        doc_features = DocumentPairFeatures.for_document(document, use_cache=False,
+                                                         candidate_window=self.candidate_window,
+                                                         prune_candidates=self.prune_candidates)
+        pair_scores = doc_features.features @ self.weights + self.bias
+
+        preds = {}
+        mention_ids = doc_features.mention_ids
+        for idx_head, head_id in enumerate(mention_ids):
+            start, end = doc_features.head_offsets[idx_head], doc_features.head_offsets[idx_head + 1]
+            # Dummy antecedent has a fixed score of 0
+            cand_scores = np.concatenate(([0.0], pair_scores[start: end]))
+            curr_pred = int(np.argmax(cand_scores))
+            antecedent_id = mention_ids[doc_features.idx_cands[start + curr_pred - 1]] if curr_pred > 0 else None
+
+            # { antecedent: [mention(s)] } pair
+            existing_refs = preds.get(antecedent_id, [])
+            existing_refs.append(head_id)
+            preds[antecedent_id] = existing_refs
+
+        return preds
+
+    def predict_clusters(self, document):
+        """ Returns {mention_id: assigned_cluster_id} pairs (see `utils.get_clusters()`). """
+        return get_clusters(self.predict(document))
+
+
+if __name__ == "__main__":
+    # Imported here, as the corpus readers are only needed for predicting on a corpus from the command line
+    from data import read_corpus
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    t_start = time.perf_counter()
+    predictor = BaselinePredictor.from_file(args.model_path)
+    logging.info(f"Loaded model from '{args.model_path}' in {1000 * (time.perf_counter() - t_start):.1f}ms")
+
+    # Only the first `num_docs` documents are used, so the rest are never parsed
+    documents = read_corpus(args.dataset, lazy=True)
+    for curr_doc in documents[:args.num_docs]:
+        logging.info(f"Document '{curr_doc.doc_id}': {predictor.predict_clusters(curr_doc)}")
@@ -0,0 +1,478 @@
+""" Micro-benchmarks for performance-sensitive parts of the project.
+
+Example (run from the src folder):
+$ python benchmarks.py --benchmark=senticoref_parse --num_docs=200
+$ python benchmarks.py --benchmark=corpus_memory --dataset=senticoref
+$ python benchmarks.py --benchmark=corpus_memory --dataset=senticoref --backend=columnar
+$ python benchmarks.py --benchmark=baseline_pair_features --dataset=senticoref --num_docs=20
+$ python benchmarks.py --benchmark=baseline_pair_features --dataset=senticoref --num_docs=20 --candidate_window=10
+$ python benchmarks.py --benchmark=baseline_training --dataset=senticoref --num_docs=100
+$ python benchmarks.py --benchmark=baseline_inference --dataset=senticoref --num_docs=100
+$ python benchmarks.py --benchmark=antecedent_window --dataset=senticoref
+$ python benchmarks.py --benchmark=antecedent_window --dataset=senticoref --max_antecedents=50 --max_sentence_distance=3
+$ python benchmarks.py --benchmark=pair_scorer --num_mentions=500
+$ python benchmarks.py --benchmark=coarse_to_fine --num_mentions=500
+"""
+
+import argparse
+import gc
+import logging
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+import data
+import msd
+from mention_spans import antecedent_candidates, candidate_steps
+
+parser = argparse.ArgumentParser(description="Run micro-benchmarks")
+parser.add_argument("--benchmark", type=str, required=True, choices=["senticoref_parse", "corpus_memory", "baseline_pair_features",
+                                                                    "baseline_training", "baseline_inference",
+                                                                    "antecedent_window", "pair_scorer",
+                                                                    "coarse_to_fine"])
+parser.add_argument("--num_docs", type=int, default=None, help="Limit the number of documents used in benchmark")
+parser.add_argument("--repeats", type=int, default=3)
+parser.add_argument("--dataset", type=str, default="senticoref")
+parser.add_argument("--backend", type=str, default="pickle", choices=["pickle", "columnar"],
+                    help="Corpus backend, used in the corpus_memory benchmark")
+parser.add_argument("--candidate_window", type=int, default=None,
+                    help="Candidate window of the baseline model, used in the baseline_pair_features and "
+                         "baseline_inference benchmarks")
+parser.add_argument("--max_antecedents", type=int, default=None,
+                    help="Antecedent window to measure in the antecedent_window benchmark (together with "
+                         "--max_sentence_distance), instead of the default set of windows")
+parser.add_argument("--max_sentence_distance", type=int, default=None,
+                    help="Sentence distance window to measure in the antecedent_window benchmark")
+parser.add_argument("--num_mentions", type=int, default=500,
+                    help="Number of mentions in the (synthetic) document, used in the pair_scorer and coarse_to_fine "
+                         "benchmarks")
+
+
+def _report(name, timings, unit="doc"):
+    timings = np.array(timings)
+    logging.info(f"[{name}] {len(timings)} measurements: mean={1000 * np.mean(timings):.3f}ms/{unit}, "
+                 f"median={1000 * np.median(timings):.3f}ms/{unit}, total={np.sum(timings):.3f}s")
+
+
+def _read_senticoref_doc_pandas(file_path):
+    """ Reference (pandas-based) implementation of `data.read_senticoref_doc()`, which the current parser replaced. """
+    import csv
+    from collections import OrderedDict
+
+    import pandas as pd  # imported here as it is only needed for the reference implementation
+
+    _clusters = {}
+    _curr_sent = []
+    sents = []
+    id_to_tok = {}
+    tok_to_position = {}
+    idx_sent, idx_inside_sent = 0, 0
+    mentions, clusters = {}, []
+
+    doc_id = file_path.split(os.path.sep)[-1][:-4]  # = file name without ".tsv"
+    curr_annotations = pd.read_table(file_path, comment="#", sep="\t", index_col=False, quoting=csv.QUOTE_NONE,
+                                     names=["token_index", "start_end", "token", "NamedEntity", "Polarity",
+                                            "referenceRelation", "referenceType"], keep_default_na=False)
+    curr_metadata = pd.read_table(os.path.join(data.SENTICOREF_METADATA_DIR, f"{doc_id}.tsv"), sep="\t",
+                                  index_col=False, quoting=csv.QUOTE_NONE, header=0, keep_default_na=False)
+
+    metadata = {}
+    annotation_values = curr_annotations[["token_index", "referenceRelation", "token"]].values
+    for i, (tok_id, ref_info, token) in enumerate(annotation_values):
+        if ref_info != "_":
+            for mention_info in ref_info.split("|"):
+                cluster_idx, mention_idx = list(map(int, mention_info[3:].split("-")))  # skip "*->"
+                _clusters.setdefault(cluster_idx, {}).setdefault(mention_idx, []).append(tok_id)
+
+        _curr_sent.append(tok_id)
+        tok_to_position[tok_id] = [idx_sent, idx_inside_sent]
+        id_to_tok[tok_id] = token
+        idx_inside_sent += 1
+
+        _, pos_tag, lemma = curr_metadata.iloc[i].values
+        metadata[tok_id] = (lemma, pos_tag.split(":")[1])
+
+        if token in {".", "!", "?"}:
+            idx_sent += 1
+            idx_inside_sent = 0
+            sents.append(_curr_sent)
+            _curr_sent = []
+
+    if len(_curr_sent) > 0:
+        sents.append(_curr_sent)
+
+    final_tokens = OrderedDict()
+    for index, (tok_id, tok_raw) in enumerate(id_to_tok.items()):
+        final_tokens[tok_id] = data.Token(tok_id, tok_raw, metadata[tok_id][0], metadata[tok_id][1],
+                                          tok_to_position[tok_id][0], tok_to_position[tok_id][1], index)
+
+    mention_counter = 0
+    for idx_cluster, curr_mentions in _clusters.items():
+        curr_cluster = []
+        for idx_mention, mention_tok_ids in curr_mentions.items():
+            mention_id = f"rc_{mention_counter}"
+            mentions[mention_id] = data.Mention(mention_id, [final_tokens[tok_id] for tok_id in mention_tok_ids])
+            curr_cluster.append(mention_id)
+            mention_counter += 1
+        clusters.append(curr_cluster)
+
+    return data.Document(doc_id, final_tokens, sents, data.sorted_mentions_dict(mentions), clusters,
+                         tagset=msd.TAGSET_EN)
+
+
+def benchmark_senticoref_parse(num_docs=None, repeats=3):
+    """ Compares the time needed to parse a single SentiCoref document (annotations + POS metadata) with the reference
+    (pandas-based) and the current (csv-based) parser, and checks that both produce the same documents.
+
+    Documents with a "#" inside a line are not compared: pandas treated everything after it as a comment. """
+    file_names = sorted(f for f in os.listdir(data.SENTICOREF_DIR) if f.endswith(".tsv"))[:num_docs]
+    file_paths = [os.path.join(data.SENTICOREF_DIR, f) for f in file_names]
+
+    reference_timings, timings = [], []
+    num_skipped = 0
+    for idx_repeat in range(repeats):
+        for curr_path in file_paths:
+            t_start = time.perf_counter()
+            reference_doc = _read_senticoref_doc_pandas(curr_path)
+            reference_timings.append(time.perf_counter() - t_start)
+
+            t_start = time.perf_counter()
+            doc = data.read_senticoref_doc(curr_path)
+            timings.append(time.perf_counter() - t_start)
+
+            if idx_repeat > 0:
+                continue
+
+            with open(curr_path, encoding="utf8") as f:
+                has_inline_comment = any("#" in line and not line.startswith("#") for line in f)
+            if has_inline_comment:
+                num_skipped += 1
+            elif reference_doc.fingerprint() != doc.fingerprint():
+                raise ValueError(f"Document '{doc.doc_id}' differs from the one, read with the reference parser")
+
+    logging.info(f"[senticoref_parse] {len(file_paths) - num_skipped}/{len(file_paths)} documents compared with the "
+                 f"reference parser ({num_skipped} skipped due to '#' inside a line)")
+    _report("senticoref_parse (reference, pandas)", reference_timings)
+    _report("senticoref_parse (csv)", timings)
+
+
+def benchmark_corpus_memory(dataset="senticoref", backend="pickle"):
+    """ Measures the memory, occupied by a fully parsed corpus (Python heap, as traced by `tracemalloc`).
+    For the columnar backend, only the opening of the store is measured (the memory-mapped arrays are not part of
+    the Python heap), so the store is built beforehand. """
+    if backend == "columnar":
+        data.read_corpus(dataset, workers=1, backend=backend)
+
+    gc.collect()
+    tracemalloc.start()
+    mem_start, _ = tracemalloc.get_traced_memory()
+
+    if backend == "columnar":
+        corpus = data.read_corpus(dataset, workers=1, backend=backend)
+    else:
+        corpus = data.read_corpus(dataset, use_cache=False, workers=1)
+    gc.collect()
+    mem_end, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_tokens = sum(len(doc) for doc in corpus)
+    logging.info(f"[corpus_memory] {dataset} ({backend}): {len(corpus)} documents, {num_tokens} tokens, "
+                 f"corpus size={(mem_end - mem_start) / 2 ** 20:.1f}MB "
+                 f"({(mem_end - mem_start) / max(1, num_tokens):.1f}B/token), "
+                 f"peak while reading={(mem_peak - mem_start) / 2 ** 20:.1f}MB")
+
+
+def benchmark_baseline_pair_features(dataset="senticoref", num_docs=None, repeats=3, candidate_window=None):
+    """ Compares the per-pair (`MentionPairFeatures`) and per-document (`DocumentPairFeatures`) computation of baseline
+    features on the documents with the most mentions, and checks that both produce the same values. If
+    `candidate_window` is set, the per-document computation with pruned candidates is measured and checked too, and
+    string features are checked to be computed for the pruned candidates only. """
+    import baseline  # imported here as it pulls in torch
+    from baseline_features import STRING_FEATURES
+
+    corpus = data.read_corpus(dataset, workers=1)
+    docs = sorted(corpus, key=lambda doc: len(doc.mentions), reverse=True)[:num_docs]
+
+    per_pair_timings, per_doc_timings, pruned_timings = [], [], []
+    num_pairs, num_candidate_pairs = 0, 0
+    for _ in range(repeats):
+        for curr_doc in docs:
+            mentions = list(curr_doc.mentions.values())
+
+            t_start = time.perf_counter()
+            per_pair = [baseline.MentionPairFeatures.for_mentions(curr_doc, head, cand, use_cache=False)
+                        for idx_head, head in enumerate(mentions) for cand in mentions[:idx_head]]
+            per_pair_timings.append(time.perf_counter() - t_start)
+
+            t_start = time.perf_counter()
+            per_doc = baseline.DocumentPairFeatures.for_document(curr_doc, use_cache=False)
+            per_doc_timings.append(time.perf_counter() - t_start)
+
+            expected = np.array(per_pair, dtype=np.float32).reshape((-1, baseline.MentionPairFeatures.num_features()))
+            if not np.array_equal(expected, per_doc.features):
+                raise ValueError(f"Per-document features of '{curr_doc.doc_id}' differ from per-pair features")
+
+            if candidate_window is not None:
+                t_start = time.perf_counter()
+                pruned = baseline.DocumentPairFeatures.for_document(curr_doc, use_cache=False,
+                                                                    candidate_window=candidate_window,
+                                                                    prune_candidates=True)
+                pruned_timings.append(time.perf_counter() - t_start)
+
+                # Position of pair (i, j) in the packed lower triangle is i * (i - 1) / 2 + j
+                packed_positions = pruned.idx_heads * (pruned.idx_heads - 1) // 2 + pruned.idx_cands
+                if not np.array_equal(expected[packed_positions], pruned.features):
+                    raise ValueError(f"Candidate pair features of '{curr_doc.doc_id}' differ from per-pair features")
+
+                # Without pruning, all pairs are kept, but string features of pairs that are not selected are 0
+                windowed = baseline.DocumentPairFeatures.for_document(curr_doc, use_cache=False,
+                                                                      candidate_window=candidate_window)
+                expected_windowed = expected.copy()
+                is_selected = np.zeros(expected.shape[0], dtype=bool)
+                is_selected[packed_positions] = True
+                expected_windowed[np.ix_(~is_selected, STRING_FEATURES)] = 0.0
+                if not np.array_equal(expected_windowed, windowed.features):
+                    raise ValueError(f"Windowed pair features of '{curr_doc.doc_id}' differ from per-pair features")
+                num_pairs += expected.shape[0]
+                num_candidate_pairs += pruned.features.shape[0]
+
+    logging.info(f"[baseline_pair_features] {len(docs)} documents, "
+                 f"{np.mean([len(doc.mentions) for doc in docs]):.1f} mentions/doc on average")
+    _report("baseline_pair_features (per pair)", per_pair_timings)
+    _report("baseline_pair_features (per document)", per_doc_timings)
+    if candidate_window is not None:
+        logging.info(f"[baseline_pair_features] candidate_window={candidate_window}: {num_candidate_pairs}/{num_pairs} "
+                     f"pairs are selected")
+        _report(f"baseline_pair_features (per document, candidate_window={candidate_window}, pruned)", pruned_timings)
+
+
+def benchmark_baseline_training(dataset="senticoref", num_docs=None, repeats=3):
+    """ Compares the training throughput of the baseline model, updated once per mention (default) and once per
+    document (`batched=True`). Features are computed (and cached) beforehand, so only the optimization is measured. """
+    import baseline  # imported here as it pulls in torch
+
+    corpus = data.read_corpus(dataset, workers=1)
+    docs = [doc for doc in corpus[:num_docs] if len(doc.mentions) > 0]
+    for curr_doc in docs:
+        baseline.DocumentPairFeatures.for_document(curr_doc)
+    num_heads = sum(len(doc.mentions) for doc in docs)
+
+    for batched in [False, True]:
+        controller = baseline.BaselineController(baseline.MentionPairFeatures.num_features(), dataset_name=dataset,
+                                                 model_name="benchmark_baseline_training", batched=batched)
+        controller.train_mode()
+        timings = []
+        for _ in range(repeats):
+            t_start = time.perf_counter()
+            for curr_doc in docs:
+                controller._train_doc(curr_doc)
+            timings.append(time.perf_counter() - t_start)
+
+        logging.info(f"[baseline_training] batched={batched}: {len(docs)} documents, "
+                     f"{num_heads / np.mean(timings):.1f} mentions/s")
+        _report(f"baseline_training (batched={batched})", timings, unit="epoch")
+
+
+def benchmark_baseline_inference(dataset="senticoref", num_docs=None, repeats=3, candidate_window=None):
+    """ Compares predicting with the baseline controller in evaluation mode (`BaselineController._train_doc()`) and
+    with its exported NumPy artifact (`BaselinePredictor`), and checks that both produce the same predictions. The
+    model is trained for one epoch beforehand, so that the predictions are not trivial. """
+    import tempfile
+
+    import torch  # imported here as it is not needed by other benchmarks
+    import baseline
+    from baseline_inference import BaselinePredictor
+
+    corpus = data.read_corpus(dataset, workers=1)
+    docs = [doc for doc in corpus[:num_docs] if len(doc.mentions) > 0]
+    controller = baseline.BaselineController(baseline.MentionPairFeatures.num_features(), dataset_name=dataset,
+                                             model_name="benchmark_baseline_inference",
+                                             candidate_window=candidate_window)
+    controller.train_mode()
+    for curr_doc in docs:
+        controller._train_doc(curr_doc)
+    controller.eval_mode()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        artifact_path = os.path.join(tmp_dir, "baseline.npz")
+        controller.export_numpy(artifact_path)
+        predictor = BaselinePredictor.from_file(artifact_path)
+
+    controller_timings, predictor_timings = [], []
+    for _ in range(repeats):
+        for curr_doc in docs:
+            t_start = time.perf_counter()
+            with torch.no_grad():
+                expected, _ = controller._train_doc(curr_doc, eval_mode=True)
+            controller_timings.append(time.perf_counter() - t_start)
+
+            t_start = time.perf_counter()
+            preds = predictor.predict(curr_doc)
+            predictor_timings.append(time.perf_counter() - t_start)
+
+            if preds != expected:
+                raise ValueError(f"Predictions of the NumPy artifact for '{curr_doc.doc_id}' differ from the ones of "
+                                 f"the controller")
+
+    logging.info(f"[baseline_inference] {len(docs)} documents, candidate_window={candidate_window}, "
+                 f"weights dtype: {predictor.weights.dtype}")
+    _report("baseline_inference (controller)", controller_timings)
+    _report("baseline_inference (NumPy artifact)", predictor_timings)
+
+
+def benchmark_antecedent_window(dataset="senticoref", num_docs=None,
+                                windows=((None, None), (20, None), (50, None), (100, None), (None, 1), (None, 3),
+                                         (None, 10), (50, 3))):
+    """ Measures how limiting antecedent candidates of the neural controllers (`max_antecedents`,
+    `max_sentence_distance`) reduces the number of scored mention pairs and the time needed to prepare the candidates
+    (`candidate_steps()`), and how many mentions lose all of their gold antecedents in the process (an upper bound on
+    the links that the model can still recover). """
+
+    corpus = data.read_corpus(dataset, workers=1)
+    docs = [doc for doc in corpus[:num_docs] if len(doc.mentions) > 0]
+
+    mention_to_cluster = []
+    for curr_doc in docs:
+        mention_to_cluster.append({mention_id: idx_cluster for idx_cluster, cluster in enumerate(curr_doc.clusters)
+                                   for mention_id in cluster})
+
+    for max_antecedents, max_sentence_distance in windows:
+        num_pairs, num_anaphoric, num_covered = 0, 0, 0
+        t_start = time.perf_counter()
+        for curr_doc, curr_clusters in zip(docs, mention_to_cluster):
+            mention_ids = list(curr_doc.mentions.keys())
+            for idx_head, head_id in enumerate(mention_ids):
+                candidates = antecedent_candidates(curr_doc, mention_ids, idx_head,
+                                                   max_antecedents=max_antecedents,
+                                                   max_sentence_distance=max_sentence_distance)
+                num_pairs += len(candidates)
+
+                is_anaphoric = any(curr_clusters[mention_ids[idx_cand]] == curr_clusters[head_id]
+                                   for idx_cand in range(idx_head))
+                if is_anaphoric:
+                    num_anaphoric += 1
+                    num_covered += int(any(curr_clusters[mention_ids[idx_cand]] == curr_clusters[head_id]
+                                           for idx_cand in candidates))
+        t_elapsed = time.perf_counter() - t_start
+
+        t_start = time.perf_counter()
+        for curr_doc in docs:
+            candidate_steps(curr_doc, max_antecedents=max_antecedents, max_sentence_distance=max_sentence_distance)
+        t_steps = time.perf_counter() - t_start
+
+        logging.info(f"[antecedent_window] max_antecedents={max_antecedents}, "
+                     f"max_sentence_distance={max_sentence_distance}: {num_pairs} candidate pairs "
+                     f"({num_pairs / max(1, len(docs)):.1f}/doc), gold antecedent kept for "
+                     f"{num_covered}/{num_anaphoric} anaphoric mentions "
+                     f"({100 * num_covered / max(1, num_anaphoric):.2f}%), {1000 * t_elapsed:.1f}ms, "
+                     f"candidate_steps: {1000 * t_steps / max(1, len(docs)):.3f}ms/doc")
+
+
+def benchmark_pair_scorer(num_mentions=500, num_features=768, hidden_size=150, max_span_size=10, repeats=3):
+    """ Compares scoring all (head, candidate) pairs of a synthetic document with `num_mentions` mentions using the
+    concatenated ([candidate, head, candidate * head]) and the factorized first layer of the pair scorer, and checks
+    that both produce the same scores. """
+    import torch  # imported here as it is not needed by other benchmarks
+    from common import NeuralCoreferencePairScorer
+
+    scorer = NeuralCoreferencePairScorer(num_features=num_features, hidden_size=hidden_size)
+    scorer.eval()
+    span_features = torch.randn((num_mentions, max_span_size, num_features))
+    span_mask = torch.arange(max_span_size).unsqueeze(0) < torch.randint(1, max_span_size + 1, (num_mentions, 1))
+
+    concat_timings, factorized_timings = [], []
+    with torch.no_grad():
+        for _ in range(repeats):
+            t_start = time.perf_counter()
+            span_repr = scorer.encode_spans(span_features, span_mask)
+            concat_scores = [scorer.score_pairs(span_repr[:idx_head], span_repr[idx_head: idx_head + 1])
+                             for idx_head in range(1, num_mentions)]
+            concat_timings.append(time.perf_counter() - t_start)
+
+            t_start = time.perf_counter()
+            span_repr = scorer.encode_spans(span_features, span_mask)
+            candidate_proj, head_proj = scorer.project_spans(span_repr)
+            factorized_scores = [scorer.score_pairs(span_repr[:idx_head], span_repr[idx_head: idx_head + 1],
+                                                    candidate_proj=candidate_proj[:idx_head],
+                                                    head_proj=head_proj[idx_head: idx_head + 1])
+                                 for idx_head in range(1, num_mentions)]
+            factorized_timings.append(time.perf_counter() - t_start)
+
+            if not torch.allclose(torch.cat(concat_scores), torch.cat(factorized_scores), atol=1e-4):
+                raise ValueError("Factorized pair scores differ from concatenated pair scores")
+
+    logging.info(f"[pair_scorer] {num_mentions} mentions, {num_mentions * (num_mentions - 1) // 2} pairs")
+    _report("pair_scorer (concatenated)", concat_timings)
+    _report("pair_scorer (factorized)", factorized_timings)
+
+
+def benchmark_coarse_to_fine(num_mentions=500, num_features=768, hidden_size=150, max_span_size=10, repeats=3,
+                             top_ks=(None, 100, 50, 25, 10)):
+    """ Measures the throughput of batched antecedent ranking on a synthetic document with `num_mentions` mentions,
+    with all candidates scored by the pair scorer (`top_k=None`) and with coarse-to-fine pruning at several `top_k`,
+    along with the fraction of correct antecedents kept by pruning. Mentions are assigned to random clusters and the
+    coarse scorer is not trained, so the reported recall is a lower bound for that of a trained model. """
+    import torch  # imported here as it is not needed by other benchmarks
+    from common import NeuralCoreferencePairScorer, PruningRecall, rank_antecedents_batched
+
+    scorer = NeuralCoreferencePairScorer(num_features=num_features, hidden_size=hidden_size, coarse_scorer=True)
+    scorer.eval()
+    span_features = torch.randn((num_mentions, max_span_size, num_features))
+    span_mask = torch.arange(max_span_size).unsqueeze(0) < torch.randint(1, max_span_size + 1, (num_mentions, 1))
+    # On average 5 mentions per cluster
+    cluster_ids = np.random.randint(0, max(1, num_mentions // 5), size=num_mentions)
+    steps = []
+    for idx_head in range(num_mentions):
+        correct_antecedents = (1 + np.flatnonzero(cluster_ids[:idx_head] == cluster_ids[idx_head])).tolist()
+        steps.append({"head_id": f"m{idx_head}", "idx_head": idx_head, "candidate_positions": range(idx_head),
+                      "correct_antecedents": correct_antecedents if len(correct_antecedents) > 0 else [0]})
+    cache = {
+        "mention_ids": [f"m{idx_mention}" for idx_mention in range(num_mentions)],
+        "steps": steps
+    }
+
+    with torch.no_grad():
+        for top_k in top_ks:
+            timings = []
+            pruning_recall = PruningRecall()
+            for _ in range(repeats):
+                t_start = time.perf_counter()
+                span_repr = scorer.encode_spans(span_features, span_mask)
+                candidate_proj, head_proj = scorer.project_spans(span_repr)
+                rank_antecedents_batched(scorer, cache, span_repr, candidate_proj, head_proj, top_k=top_k,
+                                         pruning_recall=pruning_recall)
+                timings.append(time.perf_counter() - t_start)
+
+            logging.info(f"[coarse_to_fine] top_k={top_k}: {num_mentions / np.mean(timings):.1f} mentions/s, "
+                         f"correct antecedents kept by pruning: {pruning_recall if top_k is not None else '100%'}")
+            _report(f"coarse_to_fine (top_k={top_k})", timings)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    if args.benchmark == "senticoref_parse":
+        benchmark_senticoref_parse(num_docs=args.num_docs, repeats=args.repeats)
+    elif args.benchmark == "corpus_memory":
+        benchmark_corpus_memory(dataset=args.dataset, backend=args.backend)
+    elif args.benchmark == "baseline_pair_features":
+        benchmark_baseline_pair_features(dataset=args.dataset, num_docs=args.num_docs, repeats=args.repeats,
+                                         candidate_window=args.candidate_window)
+    elif args.benchmark == "baseline_training":
+        benchmark_baseline_training(dataset=args.dataset, num_docs=args.num_docs, repeats=args.repeats)
+    elif args.benchmark == "baseline_inference":
+        benchmark_baseline_inference(dataset=args.dataset, num_docs=args.num_docs, repeats=args.repeats,
+                                     candidate_window=args.candidate_window)
+    elif args.benchmark == "antecedent_window":
+        if args.max_antecedents is not None or args.max_sentence_distance is not None:
+            benchmark_antecedent_window(dataset=args.dataset, num_docs=args.num_docs,
+                                        windows=((None, None), (args.max_antecedents, args.max_sentence_distance)))
+        else:
+            benchmark_antecedent_window(dataset=args.dataset, num_docs=args.num_docs)
+    elif args.benchmark == "pair_scorer":
+        benchmark_pair_scorer(num_mentions=args.num_mentions, repeats=args.repeats)
+    elif args.benchmark == "coarse_to_fine":
+        benchmark_coarse_to_fine(num_mentions=args.num_mentions, repeats=args.repeats)
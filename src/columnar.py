@@ -0,0 +1,232 @@
+""" Columnar on-disk corpus format.
+
+A corpus is stored as a directory of flat NumPy arrays (tokens, sentences, mentions and clusters of all documents,
+concatenated), which are opened with `np.load(..., mmap_mode="r")`. The arrays are therefore shared (read-only,
+zero-copy) between all processes that open the same corpus, e.g. parallel CV folds or data-parallel workers.
+`Document` objects are built from the arrays on demand.
+
+Strings (document/token/mention IDs, tokens, lemmas, MSD tags) are deduplicated into a single UTF-8 blob, and all
+other arrays refer to them by index.
+"""
+
+import json
+import mmap
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+from data import Corpus, Document, Mention, Token
+
+COLUMNAR_FORMAT_VERSION = 2
+NO_STRING = -1  # e.g. tokens without a lemma
+
+# Offset arrays have (num_items + 1) elements: the elements of item `i` are at [offsets[i], offsets[i + 1])
+_ARRAY_NAMES = [
+    "string_offsets", "doc_ids", "doc_tagsets", "doc_token_offsets", "doc_sentence_offsets", "doc_mention_offsets",
+    "doc_cluster_offsets",
+    "token_ids", "token_raw_texts", "token_lemmas", "token_msds", "token_sentence_indices", "token_positions",
+    "sentence_token_offsets", "sentence_tokens",
+    "mention_ids", "mention_token_offsets", "mention_tokens", "mention_clusters",
+    "cluster_mention_offsets", "cluster_mentions"
+]
+
+
+class _StringTable:
+    def __init__(self):
+        self.str_to_idx = {}
+        self.strings = []
+
+    def add(self, s):
+        if s is None:
+            return NO_STRING
+
+        idx = self.str_to_idx.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.str_to_idx[s] = idx
+            self.strings.append(s)
+        return idx
+
+
+def export_columnar(documents, target_dir, metadata=None):
+    """ Stores `documents` into `target_dir` in columnar format. `metadata` (a JSON-serializable dict) is stored
+    alongside the arrays and can be used to describe the origin of the data. """
+    strings = _StringTable()
+    arrays = {name: [] for name in _ARRAY_NAMES if name != "string_offsets"}
+    for name in ["doc_token_offsets", "doc_sentence_offsets", "doc_mention_offsets", "doc_cluster_offsets",
+                 "sentence_token_offsets", "mention_token_offsets", "cluster_mention_offsets"]:
+        arrays[name].append(0)
+
+    for doc in documents:
+        arrays["doc_ids"].append(strings.add(doc.doc_id))
+        arrays["doc_tagsets"].append(strings.add(doc.tagset))
+
+        # Tokens, sentences and mentions refer to tokens by their position inside document
+        token_positions = {}
+        for idx_token, (token_id, token) in enumerate(doc.tokens.items()):
+            token_positions[token_id] = idx_token
+            arrays["token_ids"].append(strings.add(token_id))
+            arrays["token_raw_texts"].append(strings.add(token.raw_text))
+            arrays["token_lemmas"].append(strings.add(token.lemma))
+            arrays["token_msds"].append(strings.add(token.msd))
+            arrays["token_sentence_indices"].append(token.sentence_index)
+            arrays["token_positions"].append(token.position_in_sentence)
+
+        for curr_sent in doc.sents:
+            arrays["sentence_tokens"].extend(token_positions[token_id] for token_id in curr_sent)
+            arrays["sentence_token_offsets"].append(len(arrays["sentence_tokens"]))
+
+        mention_positions = {mention_id: idx_mention for idx_mention, mention_id in enumerate(doc.mentions.keys())}
+        mention_to_cluster = {mention_id: idx_cluster
+                              for idx_cluster, curr_cluster in enumerate(doc.clusters)
+                              for mention_id in curr_cluster}
+        for mention_id, mention in doc.mentions.items():
+            arrays["mention_ids"].append(strings.add(mention_id))
+            arrays["mention_tokens"].extend(token_positions[token.token_id] for token in mention.tokens)
+            arrays["mention_token_offsets"].append(len(arrays["mention_tokens"]))
+            arrays["mention_clusters"].append(mention_to_cluster.get(mention_id, -1))
+
+        for curr_cluster in doc.clusters:
+            arrays["cluster_mentions"].extend(mention_positions[mention_id] for mention_id in curr_cluster)
+            arrays["cluster_mention_offsets"].append(len(arrays["cluster_mentions"]))
+
+        arrays["doc_token_offsets"].append(len(arrays["token_ids"]))
+        arrays["doc_sentence_offsets"].append(len(arrays["sentence_token_offsets"]) - 1)
+        arrays["doc_mention_offsets"].append(len(arrays["mention_ids"]))
+        arrays["doc_cluster_offsets"].append(len(arrays["cluster_mention_offsets"]) - 1)
+
+    encoded_strings = [s.encode("utf-8") for s in strings.strings]
+    arrays["string_offsets"] = np.cumsum([0] + [len(s) for s in encoded_strings], dtype=np.int64)
+
+    # Write into a temporary directory first, so that an interrupted export never leaves behind a partial corpus
+    tmp_dir = f"{target_dir.rstrip(os.path.sep)}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    with open(os.path.join(tmp_dir, "strings.bin"), "wb") as f:
+        f.write(b"".join(encoded_strings))
+    for name in _ARRAY_NAMES:
+        dtype = np.int64 if name.endswith("_offsets") else np.int32
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.array(arrays[name], dtype=dtype))
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": COLUMNAR_FORMAT_VERSION,
+            "num_documents": len(arrays["doc_ids"]),
+            "metadata": metadata if metadata is not None else {}
+        }, fp=f, indent=4)
+
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+    os.replace(tmp_dir, target_dir)
+
+
+class ColumnarCorpusReader:
+    """ Opens a corpus, stored with `export_columnar()`, as read-only memory-mapped arrays and builds `Document`
+    objects from them on demand. """
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        with open(os.path.join(source_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["version"] != COLUMNAR_FORMAT_VERSION:
+            raise ValueError(f"Unsupported columnar corpus version ({meta['version']}), "
+                             f"expected {COLUMNAR_FORMAT_VERSION}")
+        self.metadata = meta["metadata"]
+
+        with open(os.path.join(source_dir, "strings.bin"), "rb") as f:
+            self._strings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.fstat(f.fileno()).st_size > 0 else b""
+        # Plain ndarray views of the memory maps: same (shared) buffer, but much cheaper element access
+        self.arrays = {name: np.load(os.path.join(source_dir, f"{name}.npy"), mmap_mode="r").view(np.ndarray)
+                       for name in _ARRAY_NAMES}
+        # Decoded strings are memoized, since the same tokens, lemmas and tags reoccur often
+        self._decoded = {}
+
+        self.doc_ids = [self.string(idx) for idx in self.arrays["doc_ids"]]
+        self._id_to_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+
+    def __getstate__(self):
+        # Memory maps can not be pickled: worker processes reopen the (shared) store instead
+        return {"source_dir": self.source_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["source_dir"])
+
+    def string(self, idx):
+        if idx == NO_STRING:
+            return None
+
+        decoded = self._decoded.get(idx)
+        if decoded is None:
+            offsets = self.arrays["string_offsets"]
+            decoded = self._strings[int(offsets[idx]): int(offsets[idx + 1])].decode("utf-8")
+            self._decoded[idx] = decoded
+        return decoded
+
+    def _strings_of(self, name, start, end):
+        return [self.string(idx) for idx in self.arrays[name][start: end].tolist()]
+
+    def _ranges(self, offsets_name, start, end):
+        """ Returns [start, end) boundaries of items `start`, ..., `end - 1`, described by `offsets_name`. """
+        offsets = self.arrays[offsets_name][start: end + 1].tolist()
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    def document(self, doc_id):
+        a = self.arrays
+        idx_doc = self._id_to_index[doc_id]
+        # Read all rows belonging to the document at once, since indexing memory-mapped arrays elementwise is slow
+        (tok_start, tok_end), = self._ranges("doc_token_offsets", idx_doc, idx_doc + 1)
+        (sent_start, sent_end), = self._ranges("doc_sentence_offsets", idx_doc, idx_doc + 1)
+        (mention_start, mention_end), = self._ranges("doc_mention_offsets", idx_doc, idx_doc + 1)
+        (cluster_start, cluster_end), = self._ranges("doc_cluster_offsets", idx_doc, idx_doc + 1)
+
+        tokens = OrderedDict()
+        token_objs = []
+        for idx_local, token_data in enumerate(zip(self._strings_of("token_ids", tok_start, tok_end),
+                                                   self._strings_of("token_raw_texts", tok_start, tok_end),
+                                                   self._strings_of("token_lemmas", tok_start, tok_end),
+                                                   self._strings_of("token_msds", tok_start, tok_end),
+                                                   a["token_sentence_indices"][tok_start: tok_end].tolist(),
+                                                   a["token_positions"][tok_start: tok_end].tolist())):
+            token = Token(*token_data, idx_local)
+            tokens[token.token_id] = token
+            token_objs.append(token)
+
+        sents = []
+        sent_ranges = self._ranges("sentence_token_offsets", sent_start, sent_end)
+        if sent_ranges:
+            sent_tokens = a["sentence_tokens"][sent_ranges[0][0]: sent_ranges[-1][1]].tolist()
+            for s, e in sent_ranges:
+                base = sent_ranges[0][0]
+                sents.append([token_objs[idx_local].token_id for idx_local in sent_tokens[s - base: e - base]])
+
+        mentions = {}
+        mention_ids = self._strings_of("mention_ids", mention_start, mention_end)
+        mention_ranges = self._ranges("mention_token_offsets", mention_start, mention_end)
+        if mention_ranges:
+            base = mention_ranges[0][0]
+            mention_tokens = a["mention_tokens"][base: mention_ranges[-1][1]].tolist()
+            for mention_id, (s, e) in zip(mention_ids, mention_ranges):
+                mentions[mention_id] = Mention(mention_id,
+                                               [token_objs[idx_local] for idx_local in mention_tokens[s - base: e - base]])
+
+        clusters = []
+        cluster_ranges = self._ranges("cluster_mention_offsets", cluster_start, cluster_end)
+        if cluster_ranges:
+            base = cluster_ranges[0][0]
+            cluster_mentions = a["cluster_mentions"][base: cluster_ranges[-1][1]].tolist()
+            for s, e in cluster_ranges:
+                clusters.append([mention_ids[idx_local] for idx_local in cluster_mentions[s - base: e - base]])
+
+        return Document(doc_id, tokens, sents, mentions, clusters, tagset=self.string(int(a["doc_tagsets"][idx_doc])))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+def read_columnar_corpus(source_dir):
+    """ Returns a lazy `Corpus`, serving documents from a columnar corpus stored in `source_dir`. """
+    reader = ColumnarCorpusReader(source_dir)
+    return Corpus(reader.doc_ids, load_fn=reader.document)
@@ -1,9 +1,13 @@
+import hashlib
+import json
 import logging
 import os
 import time
+from collections import OrderedDict
 
 from tqdm import tqdm
 
+import mention_spans
 import metrics
 import torch
 import torch.nn as nn
@@ -15,6 +19,191 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+def config_fingerprint(config):
+    """ Returns a stable hash of a JSON-serializable configuration `config` (values that are not serializable are
+    converted to strings). """
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class PreparedDocumentCache:
+    """ Cache of preprocessed documents (see `ControllerBase._get_prepared_doc()`), keyed by (document fingerprint,
+    preprocessing fingerprint of controller).
+
+    At most `max_documents` entries are kept in memory, least recently used ones are evicted first. If `store_dir` is
+    set, prepared documents are also written there and loaded back on a miss, so the preprocessing is reused across
+    processes and restarts.
+    """
+    def __init__(self, max_documents=1024, store_dir=None):
+        self.max_documents = max_documents
+        self.store_dir = store_dir
+        self._documents = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def _store_path(self, key):
+        return os.path.join(self.store_dir, f"{key[0]}_{key[1]}.pt")
+
+    def get(self, key):
+        """ Returns the prepared document stored under `key`, or None if it is neither in memory nor in the store. """
+        prepared = self._documents.get(key)
+        if prepared is None and self.store_dir is not None and os.path.isfile(self._store_path(key)):
+            prepared = torch.load(self._store_path(key), map_location="cpu")
+            self._put_in_memory(key, prepared)
+
+        if prepared is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._documents.move_to_end(key)
+        return prepared
+
+    def put(self, key, prepared):
+        self._put_in_memory(key, prepared)
+        if self.store_dir is not None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            tmp_path = f"{self._store_path(key)}.tmp{os.getpid()}"
+            torch.save(prepared, tmp_path)
+            os.replace(tmp_path, self._store_path(key))
+
+    def _put_in_memory(self, key, prepared):
+        self._documents[key] = prepared
+        self._documents.move_to_end(key)
+        while len(self._documents) > self.max_documents:
+            self._documents.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._documents.clear()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __str__(self):
+        return f"PreparedDocumentCache({len(self._documents)}/{self.max_documents} documents, " \
+               f"store_dir={self.store_dir}, {self.hits} hits, {self.misses} misses, {self.evictions} evictions)"
+
+
+# Shared by all controller instances, so that e.g. models in different CV folds reuse the preprocessing of the same
+# documents
+prepared_doc_cache = PreparedDocumentCache()
+
+
+def configure_prepared_doc_cache(args):
+    """ Applies the `--prepared_doc_cache_size` and `--prepared_doc_store_dir` arguments of neural model scripts. """
+    prepared_doc_cache.max_documents = args.prepared_doc_cache_size
+    prepared_doc_cache.store_dir = args.prepared_doc_store_dir
+
+
+# Maximum number of (head, candidate) pairs that are scored at once in `rank_antecedents_batched()`
+PAIR_BATCH_SIZE = 16384
+
+
+class PruningRecall:
+    """ Counts correct antecedents among candidates and the ones of them kept by coarse-to-fine pruning (see
+    `rank_antecedents_batched()`). """
+    def __init__(self):
+        self.num_correct, self.num_kept = 0, 0
+
+    def update(self, num_correct, num_kept):
+        self.num_correct += num_correct
+        self.num_kept += num_kept
+
+    def recall(self):
+        """ Returns the fraction of correct antecedents kept by pruning, or None if nothing was counted. """
+        return self.num_kept / self.num_correct if self.num_correct > 0 else None
+
+    def __str__(self):
+        if self.num_correct == 0:
+            return "n/a"
+        return f"{100 * self.recall():.2f}% ({self.num_kept}/{self.num_correct})"
+
+
+def rank_antecedents_batched(scorer, cache, span_repr, candidate_proj=None, head_proj=None, top_k=None,
+                             pruning_recall=None):
+    """ Scores all (head, candidate) pairs of a prepared document (`cache`, see `mention_spans`) with the pair scorer
+    in a single batched pass (split into chunks of at most `PAIR_BATCH_SIZE` pairs) instead of once per head.
+    If projections of spans are given (see `NeuralCoreferencePairScorer.project_spans()`), the first layer of the pair
+    scorer is factorized, otherwise pairs are scored from concatenated span representations.
+    If `top_k` is set, candidates are first scored with the coarse scorer of `scorer` and only the `top_k` best ones
+    of each head are scored with the pair scorer (coarse-to-fine pruning); the final score of a pair is the sum of both.
+    Correct antecedents kept by pruning are counted into `pruning_recall` (a `PruningRecall`), if given.
+    Returns predictions ({antecedent: [mention(s)]}), probabilities of predictions ({mention: probability}) and the
+    mention-ranking loss, summed over heads (a float if the document has no pairs). """
+    if "candidate_pairs" not in cache:
+        cache["candidate_pairs"] = mention_spans.candidate_pairs(cache["steps"])
+
+    pairs = cache["candidate_pairs"]
+    device = span_repr.device
+    idx_heads = torch.from_numpy(pairs["idx_heads"]).to(device)
+    idx_cands = torch.from_numpy(pairs["idx_cands"]).to(device)
+    is_antecedent = torch.from_numpy(pairs["is_antecedent"]).to(device)
+
+    # Padded candidate scores: [num_mentions (heads), 1 + max_candidates (dummy + candidates)]
+    # Dummy antecedent has a fixed score of 0, columns without a candidate are masked out with -inf
+    cand_scores = torch.full(is_antecedent.shape, -float("inf"), device=device)
+    cand_scores[:, 0] = 0.0
+
+    doc_loss = 0.0
+    if idx_heads.shape[0] > 0:
+        columns = torch.from_numpy(pairs["columns"]).to(device)
+        coarse_scores = None
+        if top_k is not None:
+            coarse_scores = scorer.coarse_scorer(span_repr, idx_heads, idx_cands)
+            coarse_matrix = torch.full(is_antecedent.shape, -float("inf"), device=device)
+            coarse_matrix[idx_heads, columns] = coarse_scores.detach()
+            pair_index = torch.full(is_antecedent.shape, -1, dtype=torch.long, device=device)
+            pair_index[idx_heads, columns] = torch.arange(idx_heads.shape[0], device=device)
+
+            # Heads with less than `top_k` candidates also get some padding columns (-inf), which are dropped
+            top_scores, top_columns = torch.topk(coarse_matrix[:, 1:], k=min(top_k, coarse_matrix.shape[1] - 1), dim=1)
+            kept_pairs = torch.gather(pair_index[:, 1:], 1, top_columns)[torch.isfinite(top_scores)]
+            idx_heads, idx_cands, columns = idx_heads[kept_pairs], idx_cands[kept_pairs], columns[kept_pairs]
+            coarse_scores = coarse_scores[kept_pairs]
+
+        pair_scores = []
+        is_factorized = candidate_proj is not None and head_proj is not None
+        for idx_start in range(0, idx_heads.shape[0], PAIR_BATCH_SIZE):
+            curr_heads = idx_heads[idx_start: idx_start + PAIR_BATCH_SIZE]
+            curr_cands = idx_cands[idx_start: idx_start + PAIR_BATCH_SIZE]
+            pair_scores.append(scorer.score_pairs(span_repr[curr_cands], span_repr[curr_heads],
+                                                  candidate_proj=candidate_proj[curr_cands] if is_factorized else None,
+                                                  head_proj=head_proj[curr_heads] if is_factorized else None))
+
+        pair_scores = torch.cat(pair_scores).flatten()
+        cand_scores[idx_heads, columns] = (pair_scores + coarse_scores) if coarse_scores is not None else pair_scores
+
+        if top_k is not None:
+            num_correct = int(torch.sum(is_antecedent[:, 1:]))
+            # Pruned correct antecedents are not scored, so heads without any remaining ones get the dummy antecedent
+            is_antecedent = torch.logical_and(is_antecedent, torch.isfinite(cand_scores))
+            if pruning_recall is not None:
+                pruning_recall.update(num_correct, int(torch.sum(is_antecedent[:, 1:])))
+            is_antecedent[:, 0] = torch.logical_not(torch.any(is_antecedent[:, 1:], dim=1))
+
+        # Loss of each head is averaged over all its correct antecedents (as in the per-head computation)
+        log_probas = torch.log_softmax(cand_scores, dim=-1)
+        head_losses = -torch.sum(log_probas.masked_fill(torch.logical_not(is_antecedent), 0.0), dim=-1) / \
+            torch.sum(is_antecedent, dim=-1)
+        doc_loss = torch.sum(head_losses)
+
+    pred_probas, pred_columns = torch.max(torch.softmax(cand_scores, dim=-1), dim=-1)
+
+    preds, probs = {}, {}
+    mention_ids = cache["mention_ids"]
+    for curr_step, curr_pred, curr_pred_prob in zip(cache["steps"], pred_columns.tolist(), pred_probas.tolist()):
+        antecedent_id = mention_ids[curr_step["candidate_positions"][curr_pred - 1]] if curr_pred > 0 else None
+
+        # { antecedent: [mention(s)] } pair
+        existing_refs = preds.get(antecedent_id, [])
+        existing_refs.append(curr_step["head_id"])
+        preds[antecedent_id] = existing_refs
+
+        # { mention: probability } pair
+        probs[curr_step["head_id"]] = curr_pred_prob
+
+    return preds, probs, doc_loss
+
+
 class ControllerBase:
     def __init__(self, learning_rate, dataset_name, early_stopping_rounds=5, model_name=None):
         self.model_name = time.strftime("%Y%m%d_%H%M%S") if model_name is None else model_name
@@ -31,6 +220,8 @@ class ControllerBase:
         self.path_pred_clusters = os.path.join(self.path_model_dir, "pred_clusters.txt")
         self.path_pred_scores = os.path.join(self.path_model_dir, "pred_scores.txt")
         self.path_log = os.path.join(self.path_model_dir, "log.txt")
+        # Only updated by models using coarse-to-fine pruning
+        self.pruning_recall = PruningRecall()
 
         self.loaded_from_file = False
         # self._prepare()
@@ -63,6 +254,27 @@ class ControllerBase:
         """ Should save weights and other checkpoint-related data for underlying model of controller. """
         pass
 
+    def preprocessing_config(self):
+        """ Should return a (JSON-serializable) dict of settings that affect the output of `_prepare_doc()`, e.g. the
+        tokenizer and segment size. """
+        raise NotImplementedError
+
+    def _prepare_doc(self, curr_doc):
+        """ Should return a cache dictionary with preprocessed data of document. """
+        raise NotImplementedError
+
+    def _get_prepared_doc(self, curr_doc):
+        """ Returns preprocessed data of `curr_doc`, computing it only if the same document has not yet been
+        preprocessed with the same preprocessing settings. """
+        preprocessing_key = config_fingerprint({"controller": type(self).__name__, **self.preprocessing_config()})
+        cache_key = (curr_doc.fingerprint(), preprocessing_key)
+        prepared = prepared_doc_cache.get(cache_key)
+        if prepared is None:
+            prepared = self._prepare_doc(curr_doc)
+            prepared_doc_cache.put(cache_key, prepared)
+
+        return prepared
+
     def _train_doc(self, curr_doc, eval_mode=False):
         """ Trains/evaluates (if `eval_mode` is True) model on specific document. Returns predictions, loss and number
             of examples evaluated. """
@@ -86,6 +298,7 @@ class ControllerBase:
             shuffle_indices = torch.randperm(len(train_docs))
 
             self.train_mode()
+            self.pruning_recall = PruningRecall()
             train_loss, train_examples = 0.0, 0
             for idx_doc in tqdm(shuffle_indices):
                 curr_doc = train_docs[idx_doc]
@@ -95,6 +308,8 @@ class ControllerBase:
                 train_loss += doc_loss
                 train_examples += n_examples
 
+            train_pruning, self.pruning_recall = self.pruning_recall, PruningRecall()
+
             self.eval_mode()
             dev_loss, dev_examples = 0.0, 0
             for curr_doc in dev_docs:
@@ -109,6 +324,9 @@ class ControllerBase:
             logging.info(f"[Epoch #{1 + idx_epoch}] "
                          f"training loss: {train_loss: .4f}, dev loss: {dev_loss: .4f} "
                          f"[took {time.time() - t_epoch_start:.2f}s]")
+            if train_pruning.num_correct > 0 or self.pruning_recall.num_correct > 0:
+                logging.info(f"[Epoch #{1 + idx_epoch}] correct antecedents kept by coarse-to-fine pruning: "
+                             f"{train_pruning} (training), {self.pruning_recall} (dev)")
 
             if dev_loss < best_dev_loss:
                 self.save_checkpoint()
@@ -230,9 +448,43 @@ class ControllerBase:
         build_and_display(self.path_pred_clusters, self.path_pred_scores, self.path_model_dir, display=False)
 
 
+class CoarseAntecedentScorer(nn.Module):
+    # Semi-logarithmic buckets of mention distance: [1, 2, 3, 4, 5-7, 8-15, 16-31, 32-63, 64+]
+    DISTANCE_BUCKETS = (2, 3, 4, 5, 8, 16, 32, 64)
+
+    def __init__(self, repr_size, dropout=0.2):
+        """ Cheap antecedent scorer, used to select candidates that get scored by the (more expensive) pair scorer:
+        a bilinear score of span representations (see `NeuralCoreferencePairScorer.encode_spans()`) plus a learned
+        score of the distance (in mentions) between the head and the candidate. """
+        super().__init__()
+        self.bilinear = nn.Linear(in_features=repr_size, out_features=repr_size, bias=False)
+        self.distance_scores = nn.Embedding(num_embeddings=(len(self.DISTANCE_BUCKETS) + 1), embedding_dim=1)
+        self.dropout = nn.Dropout(p=dropout)
+        self.register_buffer("distance_boundaries", torch.tensor(self.DISTANCE_BUCKETS), persistent=False)
+
+    def forward(self, span_repr, idx_heads, idx_cands):
+        """
+
+        Args:
+            span_repr: [num_mentions, repr_size]
+            idx_heads: [num_pairs] positions of head mentions
+            idx_cands: [num_pairs] positions of candidate mentions
+
+        Returns:
+            [num_pairs] coarse scores
+        """
+        span_repr = self.dropout(span_repr)
+        # [num_mentions (heads), num_mentions (candidates)], cheaper than projecting each pair separately
+        bilinear_scores = torch.matmul(span_repr, self.bilinear(span_repr).t())
+        distance_buckets = torch.bucketize(idx_heads - idx_cands, self.distance_boundaries, right=True)
+        return bilinear_scores[idx_heads, idx_cands] + self.distance_scores(distance_buckets).squeeze(1)
+
+
 class NeuralCoreferencePairScorer(nn.Module):
-    def __init__(self, num_features, hidden_size=150, dropout=0.2):
+    def __init__(self, num_features, hidden_size=150, dropout=0.2, coarse_scorer=False):
         # Note: num_features is either hidden_size of a LSTM or 2*hidden_size if using biLSTM
+        # If `coarse_scorer` is True, a coarse scorer for pruning of candidates is trained along (see
+        # `CoarseAntecedentScorer`)
         super().__init__()
 
         # Attempts to model head word (root) in a mention, e.g. "model" in "my amazing model"
@@ -250,6 +502,68 @@ class NeuralCoreferencePairScorer(nn.Module):
             nn.Dropout(p=dropout),
             nn.Linear(in_features=hidden_size, out_features=1)
         )
+        self.coarse_scorer = CoarseAntecedentScorer(repr_size=(3 * num_features), dropout=dropout) \
+            if coarse_scorer else None
+
+    def encode_spans(self, span_features, attention_mask=None):
+        """ Computes span representations [first word, last word, attention-weighted words]. Meant to be called once
+        for all mentions in a document, after which pairs are scored with `score_pairs()`.
+
+        Args:
+            span_features: [B, num_tokens, num_features]
+            attention_mask: [B, num_tokens]
+
+        Returns:
+            [B, 3 * num_features]
+        """
+        eff_attn = attention_mask.bool() if attention_mask is not None \
+            else torch.ones(span_features.shape[:2], dtype=torch.bool, device=span_features.device)
+
+        span_features = span_features.masked_fill(torch.logical_not(eff_attn).unsqueeze(2), 0.0)
+        span_lengths = torch.sum(eff_attn, dim=1)
+        batch_index = torch.arange(span_features.shape[0], device=span_features.device)
+
+        attn_weights = F.softmax(self.attention_projector(self.dropout(span_features)), dim=1)
+        attended_features = torch.sum(attn_weights * span_features, dim=1)
+        return torch.cat((span_features[:, 0],  # first word of mention
+                          span_features[batch_index, span_lengths - 1],  # last word of mention
+                          attended_features), dim=1)
+
+    def project_spans(self, span_repr):
+        """ Computes the candidate and head parts of the first scoring layer for all spans. As the layer is linear in
+        its input [candidate_repr, head_repr, candidate_repr * head_repr], only the last part needs to be computed
+        for each pair (see `score_pairs()`).
+
+        Args:
+            span_repr: [B, 3 * num_features]
+
+        Returns:
+            candidate part and head part (including bias) of the first layer, both [B, hidden_size]
+        """
+        repr_size = span_repr.shape[1]
+        first_layer = self.fc[0]
+        span_repr = self.dropout(span_repr)
+        return (F.linear(span_repr, first_layer.weight[:, :repr_size]),
+                F.linear(span_repr, first_layer.weight[:, repr_size: 2 * repr_size], first_layer.bias))
+
+    def score_pairs(self, candidate_repr, head_repr, candidate_proj=None, head_proj=None):
+        """ Scores pairs of span representations (see `encode_spans()`). If projections of spans are given (see
+        `project_spans()`), the first layer is computed without concatenating the pair representation, which gives the
+        same scores (up to floating point) in evaluation mode.
+
+        Args:
+            candidate_repr: [B, 3 * num_features]
+            head_repr: [B, 3 * num_features] or [1, 3 * num_features] (broadcast to all candidates)
+            candidate_proj: [B, hidden_size]
+            head_proj: [B, hidden_size] or [1, hidden_size]
+        """
+        head_repr = head_repr.expand_as(candidate_repr)
+        if candidate_proj is None or head_proj is None:
+            return self.fc(self.dropout(torch.cat((candidate_repr, head_repr, candidate_repr * head_repr), dim=1)))
+
+        repr_size = candidate_repr.shape[1]
+        product_proj = F.linear(self.dropout(candidate_repr * head_repr), self.fc[0].weight[:, 2 * repr_size:])
+        return self.fc[1:](candidate_proj + head_proj + product_proj)
 
     def forward(self, candidate_features, head_features,
                 candidate_attention_mask=None,
@@ -260,37 +574,5 @@ class NeuralCoreferencePairScorer(nn.Module):
             candidate_features: [B, num_tokens_cand, num_features]
             head_features: [B, num_tokens_head, num_features]
         """
-        eff_cand_attn = candidate_attention_mask.bool() if candidate_attention_mask is not None \
-            else torch.ones(candidate_features.shape[:2], dtype=torch.bool)
-        eff_head_attn = head_attention_mask.bool() if head_attention_mask is not None \
-            else torch.ones(head_features.shape[:2], dtype=torch.bool)
-
-        candidate_features[torch.logical_not(eff_cand_attn)] = 0.0
-        head_features[torch.logical_not(eff_head_attn)] = 0.0
-
-        candidate_lengths = torch.sum(eff_cand_attn, dim=1)
-        head_lengths = torch.sum(eff_head_attn, dim=1)
-
-        batch_index = torch.arange(candidate_features.shape[0], device=candidate_features.device)
-
-        # Create candidate representation
-        candidate_attn_weights = F.softmax(self.attention_projector(self.dropout(candidate_features)),
-                                           dim=1)
-        cand_attended_features = torch.sum(candidate_attn_weights * candidate_features, dim=1)
-        candidate_repr = torch.cat((candidate_features[:, 0],  # first word of mention
-                                    candidate_features[batch_index, candidate_lengths - 1],  # last word of mention
-                                    cand_attended_features), dim=1)
-
-        # Create head mention representation
-        head_attn_weights = F.softmax(self.attention_projector(self.dropout(head_features)),
-                                      dim=1)
-        head_attended_features = torch.sum(head_attn_weights * head_features, dim=1)
-        head_repr = torch.cat((head_features[:, 0],  # first word of mention
-                               head_features[batch_index, head_lengths - 1],  # last word of mention
-                               head_attended_features), dim=1)
-
-        # Combine representations and compute a score
-        pair_score = self.fc(self.dropout(torch.cat((candidate_repr,
-                                                     head_repr,
-                                                     candidate_repr * head_repr), dim=1)))
-        return pair_score
+        return self.score_pairs(self.encode_spans(candidate_features, candidate_attention_mask),
+                                self.encode_spans(head_features, head_attention_mask))
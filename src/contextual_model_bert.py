@@ -12,7 +12,9 @@ import torch.optim as optim
 from sklearn.model_selection import KFold
 from transformers import BertModel, BertTokenizer
 
-from common import ControllerBase, NeuralCoreferencePairScorer
+import mention_spans
+from common import configure_prepared_doc_cache, ControllerBase, NeuralCoreferencePairScorer, \
+    rank_antecedents_batched
 from data import read_corpus, Document
 from utils import split_into_sets, fixed_split, KFoldStateCache
 
@@ -27,11 +29,27 @@ parser.add_argument("--combine_layers", action="store_true",
                     help="Flag to determine if the sequence embeddings should be a learned combination of all "
                          "BERT hidden layers")
 parser.add_argument("--dataset", type=str, default="coref149")
+parser.add_argument("--max_antecedents", type=int, default=None,
+                    help="Maximum number of closest preceding mentions considered as antecedent candidates")
+parser.add_argument("--max_sentence_distance", type=int, default=None,
+                    help="Maximum distance (in sentences) between a mention and its antecedent candidates")
 parser.add_argument("--pretrained_model_name_or_path", type=str, default="EMBEDDIA/crosloengual-bert")
 parser.add_argument("--freeze_pretrained", action="store_true", help="If set, disable updates to BERT layers")
 parser.add_argument("--random_seed", type=int, default=13)
 parser.add_argument("--fixed_split", action="store_true")
 parser.add_argument("--kfold_state_cache_path", type=str, default=None)
+parser.add_argument("--prepared_doc_cache_size", type=int, default=1024,
+                    help="Maximum number of preprocessed documents kept in memory")
+parser.add_argument("--prepared_doc_store_dir", type=str, default=None,
+                    help="If set, preprocessed documents are stored in (and reused from) this directory")
+parser.add_argument("--batched", action="store_true",
+                    help="Score all mention pairs of a document in a single batched pass instead of once per mention")
+parser.add_argument("--coarse_top_k", type=int, default=None,
+                    help="If set, only this many best candidates of each mention (according to a jointly trained "
+                         "coarse scorer) are scored with the full pair scorer")
+parser.add_argument("--factorized", action="store_true",
+                    help="Compute the first layer of the pair scorer from per-mention projections instead of "
+                         "concatenated pair representations (faster, but dropout is then applied per mention)")
 
 
 DEVICE = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -82,14 +100,24 @@ class ContextualControllerBERT(ControllerBase):
                  layer_learning_rate: Optional[Dict[str, float]] = None,
                  max_segment_size=512,
                  max_span_size=10,
+                 max_antecedents=None,
+                 max_sentence_distance=None,
                  combine_layers=False,
+                 batched=False,
+                 coarse_top_k=None,
+                 factorized=False,
                  model_name=None):
         self.dropout = dropout
         self.fc_hidden_size = fc_hidden_size
         self.freeze_pretrained = freeze_pretrained
         self.max_segment_size = max_segment_size - 3  # CLS, SEP, >= 1 PAD at the end (convention, for batching)
         self.max_span_size = max_span_size
+        self.max_antecedents = max_antecedents
+        self.max_sentence_distance = max_sentence_distance
         self.combine_layers = combine_layers
+        self.batched = batched
+        self.coarse_top_k = coarse_top_k
+        self.factorized = factorized
         self.learning_rate = learning_rate
         self.layer_learning_rate = layer_learning_rate if layer_learning_rate is not None else {}
 
@@ -106,7 +134,8 @@ class ContextualControllerBERT(ControllerBase):
             if self.combine_layers else None
         self.scorer = NeuralCoreferencePairScorer(num_features=embedding_size,
                                                   dropout=dropout,
-                                                  hidden_size=fc_hidden_size).to(DEVICE)
+                                                  hidden_size=fc_hidden_size,
+                                                  coarse_scorer=(coarse_top_k is not None)).to(DEVICE)
 
         params_to_update = [{
                 "params": self.scorer.parameters(),
@@ -179,7 +208,12 @@ class ContextualControllerBERT(ControllerBase):
                 "layer_learning_rate": self.layer_learning_rate,
                 "max_segment_size": self.max_segment_size,
                 "max_span_size": self.max_span_size,
+                "max_antecedents": self.max_antecedents,
+                "max_sentence_distance": self.max_sentence_distance,
                 "combine_layers": self.combine_layers,
+                "batched": self.batched,
+                "coarse_top_k": self.coarse_top_k,
+                "factorized": self.factorized,
                 "model_name": self.model_name
             }, fp=f_config, indent=4)
 
@@ -207,6 +241,15 @@ class ContextualControllerBERT(ControllerBase):
         logging.warning("save_checkpoint() is deprecated. Use save_pretrained() instead")
         self.save_pretrained(self.path_model_dir)
 
+    def preprocessing_config(self):
+        return {
+            "tokenizer": self.pretrained_model_name_or_path,
+            "max_segment_size": self.max_segment_size,
+            "max_span_size": self.max_span_size,
+            "max_antecedents": self.max_antecedents,
+            "max_sentence_distance": self.max_sentence_distance
+        }
+
     def _prepare_doc(self, curr_doc: Document) -> Dict:
         """ Returns a cache dictionary with preprocessed data. This should only be called once per document, since
         data inside same document does not get shuffled. """
@@ -239,93 +282,24 @@ class ContextualControllerBERT(ControllerBase):
         segments["token_type_ids"] = torch.tensor(segments["token_type_ids"])
         segments["attention_mask"] = torch.tensor(segments["attention_mask"])
 
-        cluster_sets = []
-        mention_to_cluster_id = {}
-        for i, curr_cluster in enumerate(curr_doc.clusters):
-            cluster_sets.append(set(curr_cluster))
-            for mid in curr_cluster:
-                mention_to_cluster_id[mid] = i
-
-        all_candidate_data = []
-        for idx_head, (head_id, head_mention) in enumerate(curr_doc.mentions.items(), start=1):
-            gt_antecedent_ids = cluster_sets[mention_to_cluster_id[head_id]]
-
-            # Note: no data for dummy antecedent (len(`features`) is one less than `candidates`)
-            candidates, candidate_data = [None], []
-            candidate_attention = []
-            correct_antecedents = []
-
-            curr_head_data = [[], []]
-            num_head_subwords = 0
-            for curr_token in head_mention.tokens:
+        # Maps tokens to positions inside segments (idx_seg, idx_inside_seg) for efficient indexing later
+        positions = []
+        for curr_mention in curr_doc.mentions.values():
+            curr_positions = []
+            for curr_token in curr_mention.tokens:
                 indices_inside_document = mapping[(curr_token.sentence_index, curr_token.position_in_sentence)]
-                for _idx in indices_inside_document:
-                    idx_segment, idx_inside_segment = idx_token_to_segment[_idx]
-                    curr_head_data[0].append(idx_segment)
-                    curr_head_data[1].append(idx_inside_segment)
-                    num_head_subwords += 1
-
-            if num_head_subwords > self.max_span_size:
-                curr_head_data[0] = curr_head_data[0][:self.max_span_size]
-                curr_head_data[1] = curr_head_data[1][:self.max_span_size]
-            else:
-                # padding tokens index into the PAD token of the last segment
-                curr_head_data[0] += [curr_head_data[0][-1]] * (self.max_span_size - num_head_subwords)
-                curr_head_data[1] += [-1] * (self.max_span_size - num_head_subwords)
-
-            head_attention = torch.ones((1, self.max_span_size), dtype=torch.bool)
-            head_attention[0, num_head_subwords:] = False
-
-            for idx_candidate, (cand_id, cand_mention) in enumerate(curr_doc.mentions.items(), start=1):
-                if idx_candidate >= idx_head:
-                    break
-
-                candidates.append(cand_id)
-
-                # Maps tokens to positions inside segments (idx_seg, idx_inside_seg) for efficient indexing later
-                curr_candidate_data = [[], []]
-                num_candidate_subwords = 0
-                for curr_token in cand_mention.tokens:
-                    indices_inside_document = mapping[(curr_token.sentence_index, curr_token.position_in_sentence)]
-                    for _idx in indices_inside_document:
-                        idx_segment, idx_inside_segment = idx_token_to_segment[_idx]
-                        curr_candidate_data[0].append(idx_segment)
-                        curr_candidate_data[1].append(idx_inside_segment)
-                        num_candidate_subwords += 1
-
-                if num_candidate_subwords > self.max_span_size:
-                    curr_candidate_data[0] = curr_candidate_data[0][:self.max_span_size]
-                    curr_candidate_data[1] = curr_candidate_data[1][:self.max_span_size]
-                else:
-                    # padding tokens index into the PAD token of the last segment
-                    curr_candidate_data[0] += [curr_candidate_data[0][-1]] * (self.max_span_size - num_candidate_subwords)
-                    curr_candidate_data[1] += [-1] * (self.max_span_size - num_candidate_subwords)
-
-                candidate_data.append(curr_candidate_data)
-                curr_attention = torch.ones((1, self.max_span_size), dtype=torch.bool)
-                curr_attention[0, num_candidate_subwords:] = False
-                candidate_attention.append(curr_attention)
-
-                is_coreferent = cand_id in gt_antecedent_ids
-                if is_coreferent:
-                    correct_antecedents.append(idx_candidate)
-
-            if len(correct_antecedents) == 0:
-                correct_antecedents.append(0)
-
-            candidate_attention = torch.cat(candidate_attention) if len(candidate_attention) > 0 else []
-            all_candidate_data.append({
-                "head_id": head_id,
-                "head_data": torch.tensor([curr_head_data]),
-                "head_attention": head_attention,
-                "candidates": candidates,
-                "candidate_data": torch.tensor(candidate_data),
-                "candidate_attention": candidate_attention,
-                "correct_antecedents": correct_antecedents
-            })
+                curr_positions.extend(idx_token_to_segment[_idx] for _idx in indices_inside_document)
+            positions.append(curr_positions)
 
+        span_indices, span_mask = mention_spans.span_indices(positions, max_span_size=self.max_span_size)
         ret["preprocessed_segments"] = segments
-        ret["steps"] = all_candidate_data
+        ret["mention_ids"] = list(curr_doc.mentions.keys())
+        # Shapes: [num_mentions, 2, max_span_size] and [num_mentions, max_span_size]
+        ret["span_indices"] = torch.from_numpy(span_indices)
+        ret["span_mask"] = torch.from_numpy(span_mask)
+        ret["steps"] = mention_spans.candidate_steps(curr_doc,
+                                                     max_antecedents=self.max_antecedents,
+                                                     max_sentence_distance=self.max_sentence_distance)
 
         return ret
 
@@ -336,9 +310,7 @@ class ContextualControllerBERT(ControllerBase):
         if len(curr_doc.mentions) == 0:
             return {}, (0.0, 0)
 
-        if not hasattr(curr_doc, "_cache_bert"):
-            curr_doc._cache_bert = self._prepare_doc(curr_doc)
-        cache = curr_doc._cache_bert  # type: Dict
+        cache = self._get_prepared_doc(curr_doc)  # type: Dict
 
         encoded_segments = cache["preprocessed_segments"]
         if self.freeze_pretrained:
@@ -358,32 +330,46 @@ class ContextualControllerBERT(ControllerBase):
         preds = {}
         probs = {}
 
+        mention_ids = cache["mention_ids"]
+        span_indices = cache["span_indices"]
+        # Representations of all mentions are computed once and shared by all (head, candidate) pairs
+        # [num_mentions, max_span_size, embedding_size]
+        span_features = embedded_segments[span_indices[:, 0, :], span_indices[:, 1, :]]
+        # [num_mentions, 3 * embedding_size]
+        span_repr = self.scorer.encode_spans(span_features, cache["span_mask"].to(DEVICE))
+        # [num_mentions, fc_hidden_size] each, if the first layer of the pair scorer is factorized
+        candidate_proj, head_proj = self.scorer.project_spans(span_repr) if self.factorized else (None, None)
+
+        # Coarse-to-fine pruning is only implemented for the batched scoring
+        if self.batched or self.coarse_top_k is not None:
+            preds, probs, doc_loss = rank_antecedents_batched(self.scorer, cache, span_repr, candidate_proj, head_proj,
+                                                              top_k=self.coarse_top_k,
+                                                              pruning_recall=self.pruning_recall)
+            if not eval_mode and torch.is_tensor(doc_loss):
+                doc_loss.backward()
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+
+            return preds, (float(doc_loss), n_examples), probs
+
         for curr_step in cache["steps"]:
             head_id = curr_step["head_id"]
-            head_data = curr_step["head_data"]
-
-            candidates = curr_step["candidates"]
-            candidate_data = curr_step["candidate_data"]
+            idx_head = curr_step["idx_head"]
+            candidate_positions = curr_step["candidate_positions"]
             correct_antecedents = curr_step["correct_antecedents"]
 
             # Note: num_candidates includes dummy antecedent + actual candidates
-            num_candidates = len(candidates)
+            num_candidates = 1 + len(candidate_positions)
             if num_candidates == 1:
                 curr_pred = 0
                 curr_pred_prob = 1
             else:
-                idx_segment = candidate_data[:, 0, :]
-                idx_in_segment = candidate_data[:, 1, :]
-
-                # [num_candidates, max_span_size, embedding_size]
-                candidate_data = embedded_segments[idx_segment, idx_in_segment]
-                # [1, head_size, embedding_size]
-                head_data = embedded_segments[head_data[:, 0, :], head_data[:, 1, :]]
-                head_data = head_data.repeat((num_candidates - 1, 1, 1))
-
-                candidate_scores = self.scorer(candidate_data, head_data,
-                                               curr_step["candidate_attention"],
-                                               curr_step["head_attention"].repeat((num_candidates - 1, 1)))
+                candidate_scores = self.scorer.score_pairs(
+                    mention_spans.take_spans(span_repr, candidate_positions), span_repr[idx_head: idx_head + 1],
+                    candidate_proj=(mention_spans.take_spans(candidate_proj, candidate_positions)
+                                    if self.factorized else None),
+                    head_proj=(head_proj[idx_head: idx_head + 1] if self.factorized else None)
+                )
 
                 # [1, num_candidates]
                 candidate_scores = torch.cat((torch.tensor([0.0], device=DEVICE),
@@ -397,14 +383,17 @@ class ContextualControllerBERT(ControllerBase):
                                       torch.tensor(correct_antecedents, device=DEVICE))
 
             # { antecedent: [mention(s)] } pair
-            existing_refs = preds.get(candidates[int(curr_pred)], [])
+            curr_pred = int(curr_pred)
+            antecedent_id = mention_ids[candidate_positions[curr_pred - 1]] if curr_pred > 0 else None
+            existing_refs = preds.get(antecedent_id, [])
             existing_refs.append(head_id)
-            preds[candidates[int(curr_pred)]] = existing_refs
+            preds[antecedent_id] = existing_refs
 
             # { mention: probability } pair
             probs[head_id] = curr_pred_prob
 
-        if not eval_mode:
+        # Note: `doc_loss` stays a float if no mention has any antecedent candidates (e.g. due to the window)
+        if not eval_mode and torch.is_tensor(doc_loss):
             doc_loss.backward()
             self.optimizer.step()
             self.optimizer.zero_grad()
@@ -418,6 +407,7 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
 
     args = parser.parse_args()
+    configure_prepared_doc_cache(args)
     documents = read_corpus(args.dataset)
 
     def create_model_instance(model_name, **override_kwargs):
@@ -425,11 +415,17 @@ if __name__ == "__main__":
                                         fc_hidden_size=override_kwargs.get("fc_hidden_size", args.fc_hidden_size),
                                         dropout=override_kwargs.get("dropout", args.dropout),
                                         combine_layers=override_kwargs.get("combine_layers", args.combine_layers),
+                                        batched=override_kwargs.get("batched", args.batched),
+                                        coarse_top_k=override_kwargs.get("coarse_top_k", args.coarse_top_k),
+                                        factorized=override_kwargs.get("factorized", args.factorized),
                                         pretrained_model_name_or_path=override_kwargs.get("pretrained_model_name_or_path",
                                                                                           args.pretrained_model_name_or_path),
                                         learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
                                         layer_learning_rate={"lr_embedder": 2e-5} if not args.freeze_pretrained else None,
                                         max_segment_size=override_kwargs.get("max_segment_size", args.max_segment_size),
+                                        max_antecedents=override_kwargs.get("max_antecedents", args.max_antecedents),
+                                        max_sentence_distance=override_kwargs.get("max_sentence_distance",
+                                                                                   args.max_sentence_distance),
                                         dataset_name=override_kwargs.get("dataset", args.dataset),
                                         freeze_pretrained=override_kwargs.get("freeze_pretrained", args.freeze_pretrained))
 
@@ -455,8 +451,8 @@ if __name__ == "__main__":
             OUTER_K = fold_cache.num_folds
 
         for curr_fold_data in fold_cache.get_next_unfinished():
-            curr_train_dev_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["train_docs"]), documents))
-            curr_test_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["test_docs"]), documents))
+            curr_train_dev_docs = documents.subset(curr_fold_data["train_docs"])
+            curr_test_docs = documents.subset(curr_fold_data["test_docs"])
             logging.info(f"Fold#{curr_fold_data['idx_fold']}...")
 
             best_metric, best_name = float("inf"), None
@@ -14,7 +14,9 @@ from allennlp.data.token_indexers.elmo_indexer import ELMoCharacterMapper
 from allennlp.modules.elmo import Elmo, batch_to_ids
 from sklearn.model_selection import KFold
 
-from common import ControllerBase, NeuralCoreferencePairScorer
+import mention_spans
+from common import configure_prepared_doc_cache, ControllerBase, NeuralCoreferencePairScorer, \
+    rank_antecedents_batched
 from utils import split_into_sets, fixed_split, KFoldStateCache
 
 from data import read_corpus, Document
@@ -30,10 +32,26 @@ parser.add_argument("--max_segment_size", type=int, default=None,
                     help="Size of nonoverlapping segments into which a document will be split, with each segment being "
                          "processed independently. By default, a segment corresponds to a single sentence.")
 parser.add_argument("--dataset", type=str, default="coref149")
+parser.add_argument("--max_antecedents", type=int, default=None,
+                    help="Maximum number of closest preceding mentions considered as antecedent candidates")
+parser.add_argument("--max_sentence_distance", type=int, default=None,
+                    help="Maximum distance (in sentences) between a mention and its antecedent candidates")
 parser.add_argument("--random_seed", type=int, default=13)
 parser.add_argument("--freeze_pretrained", action="store_true")
 parser.add_argument("--fixed_split", action="store_true")
 parser.add_argument("--kfold_state_cache_path", type=str, default=None)
+parser.add_argument("--prepared_doc_cache_size", type=int, default=1024,
+                    help="Maximum number of preprocessed documents kept in memory")
+parser.add_argument("--prepared_doc_store_dir", type=str, default=None,
+                    help="If set, preprocessed documents are stored in (and reused from) this directory")
+parser.add_argument("--batched", action="store_true",
+                    help="Score all mention pairs of a document in a single batched pass instead of once per mention")
+parser.add_argument("--coarse_top_k", type=int, default=None,
+                    help="If set, only this many best candidates of each mention (according to a jointly trained "
+                         "coarse scorer) are scored with the full pair scorer")
+parser.add_argument("--factorized", action="store_true",
+                    help="Compute the first layer of the pair scorer from per-mention projections instead of "
+                         "concatenated pair representations (faster, but dropout is then applied per mention)")
 
 
 DEVICE = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -51,6 +69,11 @@ class ContextualControllerELMo(ControllerBase):
                  layer_learning_rate: Optional[Dict[str, float]] = None,
                  max_segment_size=None,  # if None, process sentences independently
                  max_span_size=10,
+                 max_antecedents=None,
+                 max_sentence_distance=None,
+                 batched=False,
+                 coarse_top_k=None,
+                 factorized=False,
                  model_name=None):
         self.hidden_size = hidden_size
         self.dropout = dropout
@@ -58,6 +81,11 @@ class ContextualControllerELMo(ControllerBase):
         self.fc_hidden_size = fc_hidden_size
         self.max_span_size = max_span_size
         self.max_segment_size = max_segment_size
+        self.max_antecedents = max_antecedents
+        self.max_sentence_distance = max_sentence_distance
+        self.batched = batched
+        self.coarse_top_k = coarse_top_k
+        self.factorized = factorized
         self.learning_rate = learning_rate
         self.layer_learning_rate = layer_learning_rate if layer_learning_rate is not None else {}
 
@@ -73,7 +101,8 @@ class ContextualControllerELMo(ControllerBase):
                                        batch_first=True, bidirectional=True).to(DEVICE)
         self.scorer = NeuralCoreferencePairScorer(num_features=(2 * hidden_size),
                                                   hidden_size=fc_hidden_size,
-                                                  dropout=dropout).to(DEVICE)
+                                                  dropout=dropout,
+                                                  coarse_scorer=(coarse_top_k is not None)).to(DEVICE)
         params_to_update = [
             {
                 "params": self.scorer.parameters(),
@@ -151,6 +180,11 @@ class ContextualControllerELMo(ControllerBase):
                 "layer_learning_rate": self.layer_learning_rate,
                 "max_segment_size": self.max_segment_size,
                 "max_span_size": self.max_span_size,
+                "max_antecedents": self.max_antecedents,
+                "max_sentence_distance": self.max_sentence_distance,
+                "batched": self.batched,
+                "coarse_top_k": self.coarse_top_k,
+                "factorized": self.factorized,
                 "model_name": self.model_name
             }, fp=f_config, indent=4)
 
@@ -165,6 +199,14 @@ class ContextualControllerELMo(ControllerBase):
         logging.warning("save_checkpoint() is deprecated. Use save_pretrained() instead")
         self.save_pretrained(self.path_model_dir)
 
+    def preprocessing_config(self):
+        return {
+            "max_segment_size": self.max_segment_size,
+            "max_span_size": self.max_span_size,
+            "max_antecedents": self.max_antecedents,
+            "max_sentence_distance": self.max_sentence_distance
+        }
+
     def _prepare_doc(self, curr_doc: Document) -> Dict:
         """ Returns a cache dictionary with preprocessed data. This should only be called once per document, since
         data inside same document does not get shuffled. """
@@ -196,88 +238,19 @@ class ContextualControllerELMo(ControllerBase):
             )
         encoded_segments = torch.stack(encoded_segments)
 
-        cluster_sets = []
-        mention_to_cluster_id = {}
-        for i, curr_cluster in enumerate(curr_doc.clusters):
-            cluster_sets.append(set(curr_cluster))
-            for mid in curr_cluster:
-                mention_to_cluster_id[mid] = i
-
-        all_candidate_data = []
-        for idx_head, (head_id, head_mention) in enumerate(curr_doc.mentions.items(), 1):
-            gt_antecedent_ids = cluster_sets[mention_to_cluster_id[head_id]]
-
-            # Note: no data for dummy antecedent (len(`features`) is one less than `candidates`)
-            candidates, candidate_data = [None], []
-            candidate_attention = []
-            correct_antecedents = []
-
-            curr_head_data = [[], []]
-            num_head_words = 0
-            for curr_token in head_mention.tokens:
-                idx_segment, idx_inside_segment = get_position(curr_token)
-                curr_head_data[0].append(idx_segment)
-                curr_head_data[1].append(idx_inside_segment)
-                num_head_words += 1
-
-            if num_head_words > self.max_span_size:
-                curr_head_data[0] = curr_head_data[0][:self.max_span_size]
-                curr_head_data[1] = curr_head_data[1][:self.max_span_size]
-            else:
-                curr_head_data[0] += [curr_head_data[0][-1]] * (self.max_span_size - num_head_words)
-                curr_head_data[1] += [-1] * (self.max_span_size - num_head_words)
-
-            head_attention = torch.ones((1, self.max_span_size), dtype=torch.bool)
-            head_attention[0, num_head_words:] = False
-
-            for idx_candidate, (cand_id, cand_mention) in enumerate(curr_doc.mentions.items(), start=1):
-                if idx_candidate >= idx_head:
-                    break
-
-                candidates.append(cand_id)
-
-                # Maps tokens to positions inside segments (idx_seg, idx_inside_seg) for efficient indexing later
-                curr_candidate_data = [[], []]
-                num_candidate_words = 0
-                for curr_token in cand_mention.tokens:
-                    idx_segment, idx_inside_segment = get_position(curr_token)
-                    curr_candidate_data[0].append(idx_segment)
-                    curr_candidate_data[1].append(idx_inside_segment)
-                    num_candidate_words += 1
-
-                if num_candidate_words > self.max_span_size:
-                    curr_candidate_data[0] = curr_candidate_data[0][:self.max_span_size]
-                    curr_candidate_data[1] = curr_candidate_data[1][:self.max_span_size]
-                else:
-                    # padding tokens index into the PAD token of the last segment
-                    curr_candidate_data[0] += [curr_candidate_data[0][-1]] * (self.max_span_size - num_candidate_words)
-                    curr_candidate_data[1] += [-1] * (self.max_span_size - num_candidate_words)
-
-                candidate_data.append(curr_candidate_data)
-                curr_attention = torch.ones((1, self.max_span_size), dtype=torch.bool)
-                curr_attention[0, num_candidate_words:] = False
-                candidate_attention.append(curr_attention)
-
-                is_coreferent = cand_id in gt_antecedent_ids
-                if is_coreferent:
-                    correct_antecedents.append(idx_candidate)
-
-            if len(correct_antecedents) == 0:
-                correct_antecedents.append(0)
-
-            candidate_attention = torch.cat(candidate_attention) if len(candidate_attention) > 0 else []
-            all_candidate_data.append({
-                "head_id": head_id,
-                "head_data": torch.tensor([curr_head_data]),
-                "head_attention": head_attention,
-                "candidates": candidates,
-                "candidate_data": torch.tensor(candidate_data),
-                "candidate_attention": candidate_attention,
-                "correct_antecedents": correct_antecedents
-            })
+        # Maps tokens to positions inside segments (idx_seg, idx_inside_seg) for efficient indexing later
+        positions = [[get_position(curr_token) for curr_token in curr_mention.tokens]
+                     for curr_mention in curr_doc.mentions.values()]
 
+        span_indices, span_mask = mention_spans.span_indices(positions, max_span_size=self.max_span_size)
         ret["preprocessed_segments"] = encoded_segments
-        ret["steps"] = all_candidate_data
+        ret["mention_ids"] = list(curr_doc.mentions.keys())
+        # Shapes: [num_mentions, 2, max_span_size] and [num_mentions, max_span_size]
+        ret["span_indices"] = torch.from_numpy(span_indices)
+        ret["span_mask"] = torch.from_numpy(span_mask)
+        ret["steps"] = mention_spans.candidate_steps(curr_doc,
+                                                     max_antecedents=self.max_antecedents,
+                                                     max_sentence_distance=self.max_sentence_distance)
 
         return ret
 
@@ -288,9 +261,7 @@ class ContextualControllerELMo(ControllerBase):
         if len(curr_doc.mentions) == 0:
             return {}, (0.0, 0)
 
-        if not hasattr(curr_doc, "_cache_elmo"):
-            curr_doc._cache_elmo = self._prepare_doc(curr_doc)
-        cache = curr_doc._cache_elmo  # type: Dict
+        cache = self._get_prepared_doc(curr_doc)  # type: Dict
 
         encoded_segments = cache["preprocessed_segments"]
         if self.freeze_pretrained:
@@ -306,31 +277,45 @@ class ContextualControllerELMo(ControllerBase):
         doc_loss, n_examples = 0.0, len(cache["steps"])
         preds = {}
 
+        mention_ids = cache["mention_ids"]
+        span_indices = cache["span_indices"]
+        # Representations of all mentions are computed once and shared by all (head, candidate) pairs
+        # [num_mentions, max_span_size, embedding_size]
+        span_features = lstm_segments[span_indices[:, 0, :], span_indices[:, 1, :]]
+        # [num_mentions, 3 * embedding_size]
+        span_repr = self.scorer.encode_spans(span_features, cache["span_mask"].to(DEVICE))
+        # [num_mentions, fc_hidden_size] each, if the first layer of the pair scorer is factorized
+        candidate_proj, head_proj = self.scorer.project_spans(span_repr) if self.factorized else (None, None)
+
+        # Coarse-to-fine pruning is only implemented for the batched scoring
+        if self.batched or self.coarse_top_k is not None:
+            preds, probs, doc_loss = rank_antecedents_batched(self.scorer, cache, span_repr, candidate_proj, head_proj,
+                                                              top_k=self.coarse_top_k,
+                                                              pruning_recall=self.pruning_recall)
+            if not eval_mode and torch.is_tensor(doc_loss):
+                doc_loss.backward()
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+
+            return preds, (float(doc_loss), n_examples)
+
         for curr_step in cache["steps"]:
             head_id = curr_step["head_id"]
-            head_data = curr_step["head_data"]
-
-            candidates = curr_step["candidates"]
-            candidate_data = curr_step["candidate_data"]
+            idx_head = curr_step["idx_head"]
+            candidate_positions = curr_step["candidate_positions"]
             correct_antecedents = curr_step["correct_antecedents"]
 
             # Note: num_candidates includes dummy antecedent + actual candidates
-            num_candidates = len(candidates)
+            num_candidates = 1 + len(candidate_positions)
             if num_candidates == 1:
                 curr_pred = 0
             else:
-                idx_segment = candidate_data[:, 0, :]
-                idx_in_segment = candidate_data[:, 1, :]
-
-                # [num_candidates, max_span_size, embedding_size]
-                candidate_data = lstm_segments[idx_segment, idx_in_segment]
-                # [1, head_size, embedding_size]
-                head_data = lstm_segments[head_data[:, 0, :], head_data[:, 1, :]]
-                head_data = head_data.repeat((num_candidates - 1, 1, 1))
-
-                candidate_scores = self.scorer(candidate_data, head_data,
-                                               curr_step["candidate_attention"],
-                                               curr_step["head_attention"].repeat((num_candidates - 1, 1)))
+                candidate_scores = self.scorer.score_pairs(
+                    mention_spans.take_spans(span_repr, candidate_positions), span_repr[idx_head: idx_head + 1],
+                    candidate_proj=(mention_spans.take_spans(candidate_proj, candidate_positions)
+                                    if self.factorized else None),
+                    head_proj=(head_proj[idx_head: idx_head + 1] if self.factorized else None)
+                )
 
                 # [1, num_candidates]
                 candidate_scores = torch.cat((torch.tensor([0.0], device=DEVICE),
@@ -341,11 +326,14 @@ class ContextualControllerELMo(ControllerBase):
                                       torch.tensor(correct_antecedents, device=DEVICE))
 
             # { antecedent: [mention(s)] } pair
-            existing_refs = preds.get(candidates[int(curr_pred)], [])
+            curr_pred = int(curr_pred)
+            antecedent_id = mention_ids[candidate_positions[curr_pred - 1]] if curr_pred > 0 else None
+            existing_refs = preds.get(antecedent_id, [])
             existing_refs.append(head_id)
-            preds[candidates[int(curr_pred)]] = existing_refs
+            preds[antecedent_id] = existing_refs
 
-        if not eval_mode:
+        # Note: `doc_loss` stays a float if no mention has any antecedent candidates (e.g. due to the window)
+        if not eval_mode and torch.is_tensor(doc_loss):
             doc_loss.backward()
             self.optimizer.step()
             self.optimizer.zero_grad()
@@ -359,6 +347,7 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
 
     args = parser.parse_args()
+    configure_prepared_doc_cache(args)
     if args.random_seed:
         np.random.seed(args.random_seed)
         torch.random.manual_seed(args.random_seed)
@@ -369,11 +358,17 @@ if __name__ == "__main__":
         return ContextualControllerELMo(model_name=model_name,
                                         fc_hidden_size=override_kwargs.get("fc_hidden_size", args.fc_hidden_size),
                                         hidden_size=override_kwargs.get("hidden_size", args.hidden_size),
+                                        batched=override_kwargs.get("batched", args.batched),
+                                        coarse_top_k=override_kwargs.get("coarse_top_k", args.coarse_top_k),
+                                        factorized=override_kwargs.get("factorized", args.factorized),
                                         dropout=override_kwargs.get("dropout", args.dropout),
                                         pretrained_embeddings_dir="../data/slovenian-elmo",
                                         freeze_pretrained=override_kwargs.get("freeze_pretrained", args.freeze_pretrained),
                                         learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
                                         max_segment_size=override_kwargs.get("max_segment_size", args.max_segment_size),
+                                        max_antecedents=override_kwargs.get("max_antecedents", args.max_antecedents),
+                                        max_sentence_distance=override_kwargs.get("max_sentence_distance",
+                                                                                   args.max_sentence_distance),
                                         layer_learning_rate={
                                             "lr_embedder": 10e-5} if not args.freeze_pretrained else None,
                                         dataset_name=override_kwargs.get("dataset", args.dataset))
@@ -400,8 +395,8 @@ if __name__ == "__main__":
             OUTER_K = fold_cache.num_folds
 
         for curr_fold_data in fold_cache.get_next_unfinished():
-            curr_train_dev_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["train_docs"]), documents))
-            curr_test_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["test_docs"]), documents))
+            curr_train_dev_docs = documents.subset(curr_fold_data["train_docs"])
+            curr_test_docs = documents.subset(curr_fold_data["test_docs"])
             logging.info(f"Fold#{curr_fold_data['idx_fold']}...")
 
             best_metric, best_name = float("inf"), None
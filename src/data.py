@@ -1,12 +1,21 @@
 import os
 import logging
 import csv
-import pandas as pd
+import hashlib
+import operator
+import pickle
+import sys
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, zip_longest
 
 from bs4 import BeautifulSoup
+from lxml import etree
+
+from msd import MsdInfo, TAGSET_EN, TAGSET_SL, decode_msd
 
 DUMMY_ANTECEDENT = None
+XML_NS = "http://www.w3.org/XML/1998/namespace"
 
 #####################
 # GLOBAL PARAMETERS
@@ -17,6 +26,12 @@ COREF149_DIR = os.environ.get("COREF149_DIR", "../data/coref149")
 SENTICOREF_DIR = os.environ.get("SENTICOREF149_DIR", "../data/senticoref1_0")
 SENTICOREF_METADATA_DIR = "../data/senticoref_pos_stanza"
 SSJ_PATH = os.environ.get("SSJ_PATH", "../data/ssj500k-sl.TEI/ssj500k-sl.body.reduced.xml")
+# Parsed corpora are pickled here, so that subsequent reads skip parsing the source files
+CORPUS_CACHE_DIR = os.environ.get("CORPUS_CACHE_DIR", "../data/.corpus_cache")
+# Bump this whenever the parsing logic or the structure of Token/Mention/Document changes (invalidates old caches)
+CORPUS_CACHE_VERSION = 7
+# If the number of parsing processes is not given, at least this many documents must be parsed to use a process pool
+PARALLEL_PARSE_MIN_DOCS = 256
 
 
 def _read_tokens(corpus_soup):
@@ -84,6 +99,74 @@ def _read_coreference(corpus_soup):
     return mentions, clusters
 
 
+def _ssj_attrs(el):
+    """ Converts attributes of an lxml element into a dict, naming them as BeautifulSoup does (e.g. "xml:id"). """
+    attrs = {}
+    for attr_name, attr_value in el.attrib.items():
+        qname = etree.QName(attr_name)
+        if qname.namespace == XML_NS:
+            attrs[f"xml:{qname.localname}"] = attr_value
+        else:
+            attrs[qname.localname.lower()] = attr_value
+    return attrs
+
+
+def _read_ssj_paragraph(p_el):
+    """ Extracts the data, used by `read_coref149_doc`, from a single SSJ500k paragraph (<p ...> element).
+
+    Returns
+    -------
+    dict:
+        "sentences": list[list[tuple(str, str)]]
+            (token ID, stripped raw token) pairs of <w> and <pc> elements, organized into sentences
+        "tokens": dict[str, dict]
+            token ID to token attributes (+ raw token under "text") for all <w>, <c> and <pc> elements with an ID
+    """
+    sentences, tokens = [], {}
+    for s_el in p_el.iter("{*}s"):
+        curr_sent = []
+        for tok_el in s_el.iter("{*}w", "{*}pc"):
+            curr_sent.append((tok_el.get(f"{{{XML_NS}}}id"), "".join(tok_el.itertext()).strip()))
+        sentences.append(curr_sent)
+
+    for tok_el in p_el.iter("{*}w", "{*}c", "{*}pc"):
+        token_id = tok_el.get(f"{{{XML_NS}}}id")
+        if token_id:
+            tokens[token_id] = _ssj_attrs(tok_el)
+            tokens[token_id]["text"] = "".join(tok_el.itertext())
+
+    return {"sentences": sentences, "tokens": tokens}
+
+
+def read_ssj_documents(ssj_path, doc_ids):
+    """ Streams through the SSJ500k TEI file and extracts paragraphs whose `xml:id` is in `doc_ids`.
+    Elements are discarded as soon as they are processed, so memory usage does not grow with the size of the file
+    (i.e. the untrimmed SSJ500k can be used directly).
+
+    Returns
+    -------
+    dict[str, dict]:
+        Mapping of document (paragraph) IDs to their data, see `_read_ssj_paragraph()`
+    """
+    doc_ids = set(doc_ids)
+    ssj_docs = {}
+    for _, p_el in etree.iterparse(ssj_path, events=("end",), tag="{*}p", huge_tree=True):
+        doc_id = p_el.get(f"{{{XML_NS}}}id")
+        if doc_id in doc_ids:
+            ssj_docs[doc_id] = _read_ssj_paragraph(p_el)
+
+        # Free the processed paragraph along with the already processed elements preceding it
+        p_el.clear()
+        for curr_el in chain([p_el], p_el.iterancestors()):
+            while curr_el.getprevious() is not None:
+                del curr_el.getparent()[0]
+
+        if len(ssj_docs) == len(doc_ids):
+            break
+
+    return ssj_docs
+
+
 # Create a dictionary where each mention points to its antecedent (or the dummy antecedent)
 def _coreference_chain(clusters_list):
     mapped_clusters = {}
@@ -93,51 +176,51 @@ def _coreference_chain(clusters_list):
     return mapped_clusters
 
 
+def _intern(s):
+    return sys.intern(s) if s is not None else None
+
+
 class Token:
+    # Corpora contain hundreds of thousands of tokens, so avoid the overhead of a per-instance __dict__
+    __slots__ = ("token_id", "raw_text", "lemma", "msd", "msd_info",
+                 "sentence_index", "position_in_sentence", "position_in_document", "start_char")
+
     def __init__(self, token_id, raw_text, lemma, msd, sentence_index, position_in_sentence, position_in_document):
         self.token_id = token_id
 
-        self.raw_text = raw_text
-        self.lemma = lemma
-        self.msd = msd
+        # Interned, so that repeated word forms, lemmas and tags are stored only once
+        self.raw_text = _intern(raw_text)
+        self.lemma = _intern(lemma)
+        self.msd = _intern(msd)
+        # Decoded morphosyntactic attributes, shared by all tokens with the same tag
+        self.msd_info = decode_msd(self.msd)  # type: MsdInfo
 
         self.sentence_index = sentence_index
         self.position_in_sentence = position_in_sentence
         self.position_in_document = position_in_document
 
-        self.gender = self._extract_gender(msd)
-        self.number = self._extract_number(msd)
-        self.category = msd[0]
+        # Character offset of token in the original text, if known
+        self.start_char = None
 
-    def __str__(self):
-        return f"Token(\"{self.raw_text}\")"
+    @property
+    def gender(self):
+        return self.msd_info.gender
 
-    def _extract_number(self, msd_string):
-        number = None
-        if msd_string[0] == "S" and len(msd_string) >= 4:  # noun/samostalnik
-            number = msd_string[3]
-        elif msd_string[0] == "G" and len(msd_string) >= 6:  # verb/glagol
-            number = msd_string[5]
-        # P = adjective (pridevnik), Z = pronoun (zaimek), K = numeral (števnik)
-        elif msd_string[0] in {"P", "Z", "K"} and len(msd_string) >= 5:
-            number = msd_string[4]
+    @property
+    def number(self):
+        return self.msd_info.number
 
-        return number
+    @property
+    def category(self):
+        return self.msd_info.category
 
-    def _extract_gender(self, msd_string):
-        gender = None
-        if msd_string[0] == "S" and len(msd_string) >= 3:  # noun/samostalnik
-            gender = msd_string[2]
-        elif msd_string[0] == "G" and len(msd_string) >= 7:  # verb/glagol
-            gender = msd_string[6]
-        # P = adjective (pridevnik), Z = pronoun (zaimek), K = numeral (števnik)
-        elif msd_string[0] in {"P", "Z", "K"} and len(msd_string) >= 4:
-            gender = msd_string[3]
-
-        return gender
+    def __str__(self):
+        return f"Token(\"{self.raw_text}\")"
 
 
 class Mention:
+    __slots__ = ("mention_id", "tokens")
+
     def __init__(self, mention_id, tokens):
         self.mention_id = mention_id
         self.tokens = tokens
@@ -154,7 +237,7 @@ class Mention:
 
 class Document:
     def __init__(self, doc_id, tokens, sentences, mentions, clusters,
-                 metadata=None):
+                 metadata=None, tagset=TAGSET_SL):
         self.doc_id = doc_id  # type: str
         self.tokens = tokens  # type: dict
         self.sents = sentences  # type: list
@@ -162,6 +245,36 @@ class Document:
         self.clusters = clusters  # type: list
         self.mapped_clusters = _coreference_chain(self.clusters)
         self.metadata = metadata
+        # Tagset of token MSD tags (`msd.TAGSET_SL` or `msd.TAGSET_EN`)
+        self.tagset = tagset  # type: str
+
+        # Position of each mention in `mentions` (i.e. in order of appearance, if mentions are sorted)
+        self.mention_positions = {mention_id: idx for idx, mention_id in enumerate(self.mentions)}  # type: dict
+        # (sentence index, position in sentence, position in document) of the first token of each mention
+        self.mention_offsets = {mention_id: (mention.tokens[0].sentence_index,
+                                             mention.tokens[0].position_in_sentence,
+                                             mention.tokens[0].position_in_document)
+                                for mention_id, mention in self.mentions.items()}  # type: dict
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """ Returns a stable hash of document content (tokens, sentences, mentions and clusters), which does not depend
+        on object identity, process or run. Combine it with a fingerprint of the model configuration to key caches of
+        preprocessed data. """
+        if self._fingerprint is None:
+            sha1 = hashlib.sha1()
+            for tok in self.tokens.values():
+                sha1.update(repr(("T", tok.token_id, tok.raw_text, tok.lemma, tok.msd, tok.sentence_index,
+                                  tok.position_in_sentence, tok.position_in_document)).encode("utf-8"))
+            for curr_sent in self.sents:
+                sha1.update(repr(("S", curr_sent)).encode("utf-8"))
+            for mention_id, mention in self.mentions.items():
+                sha1.update(repr(("M", mention_id, [tok.token_id for tok in mention.tokens])).encode("utf-8"))
+            for curr_cluster in self.clusters:
+                sha1.update(repr(("C", curr_cluster)).encode("utf-8"))
+            self._fingerprint = sha1.hexdigest()
+
+        return self._fingerprint
 
     def raw_sentences(self):
         """ Returns list of sentences in document. """
@@ -174,6 +287,87 @@ class Document:
         return f"Document('{self.doc_id}', {len(self.tokens)} tokens)"
 
 
+class Corpus:
+    """ An ordered collection of documents, indexable by position (`corpus[i]`) and by document ID
+    (`corpus.get(doc_id)`).
+
+    Documents that were not provided upfront are parsed lazily with `load_fn(doc_id)` on first access. Subsets
+    (`corpus.subset(doc_ids)`) are cheap views that share parsed documents with the corpus they were created from.
+    """
+    def __init__(self, doc_ids, documents=None, load_fn=None):
+        self.doc_ids = list(doc_ids)  # type: list
+        self._id_to_position = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self._documents = documents if documents is not None else {}  # type: dict
+        self._load_fn = load_fn
+
+    def get(self, doc_id):
+        if doc_id not in self._id_to_position:
+            raise KeyError(f"Document '{doc_id}' is not part of the corpus")
+
+        doc = self._documents.get(doc_id)
+        if doc is None:
+            doc = self._load_fn(doc_id)
+            self._documents[doc_id] = doc
+
+        return doc
+
+    def subset(self, doc_ids):
+        """ Returns a view of documents with IDs in `doc_ids`, keeping their order in this corpus. """
+        doc_ids = set(doc_ids)
+        return Corpus([doc_id for doc_id in self.doc_ids if doc_id in doc_ids],
+                      documents=self._documents, load_fn=self._load_fn)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return Corpus(self.doc_ids[idx], documents=self._documents, load_fn=self._load_fn)
+        return self.get(self.doc_ids[operator.index(idx)])
+
+    def __iter__(self):
+        for doc_id in self.doc_ids:
+            yield self.get(doc_id)
+
+    def __contains__(self, doc_or_id):
+        doc_id = doc_or_id.doc_id if isinstance(doc_or_id, Document) else doc_or_id
+        return doc_id in self._id_to_position
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @staticmethod
+    def _as_corpus(documents):
+        if isinstance(documents, Corpus):
+            return documents
+        documents = list(documents)
+        return Corpus([doc.doc_id for doc in documents], documents={doc.doc_id: doc for doc in documents})
+
+    def __add__(self, other):
+        """ Returns a corpus with documents of this corpus, followed by documents of `other` (a `Corpus` or an
+        iterable of documents). Documents are still parsed lazily, by the corpus they come from. If both contain a
+        document with the same ID, only the first one (i.e. the one in this corpus) is kept. """
+        other = Corpus._as_corpus(other)
+        other_ids = [doc_id for doc_id in other.doc_ids if doc_id not in self._id_to_position]
+
+        source = {doc_id: self for doc_id in self.doc_ids}
+        source.update({doc_id: other for doc_id in other_ids})
+        return Corpus(self.doc_ids + other_ids, load_fn=_CombinedLoader(source))
+
+    def __radd__(self, other):
+        return Corpus._as_corpus(other) + self
+
+    def __str__(self):
+        return f"Corpus({len(self.doc_ids)} documents, {sum(doc_id in self._documents for doc_id in self.doc_ids)} loaded)"
+
+
+class _CombinedLoader:
+    """ Loads documents of a combined corpus (see `Corpus.__add__()`) from the corpus each of them comes from. Unlike
+    a closure, it can be pickled along with the corpus, e.g. when passing it to worker processes. """
+    def __init__(self, source):
+        self.source = source  # type: dict
+
+    def __call__(self, doc_id):
+        return self.source[doc_id].get(doc_id)
+
+
 def sorted_mentions_dict(mentions):
     # sorted() produces an array of (key, value) tuples, which we turn back into dictionary
     sorted_mentions = dict(sorted(mentions.items(),
@@ -184,7 +378,18 @@ def sorted_mentions_dict(mentions):
     return sorted_mentions
 
 
-def read_senticoref_doc(file_path):
+def _read_tsv_rows(f, skip_comments=False):
+    """ Yields tab-separated fields of non-empty lines (optionally also skipping comment lines, starting with "#"). """
+    # Note: `quoting=csv.QUOTE_NONE` is required as otherwise some documents can't be read
+    for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+        if len(row) == 0 or (skip_comments and row[0].startswith("#")):
+            continue
+        yield row
+
+
+def read_senticoref_doc(file_path, metadata_path=None):
+    """ Reads a SentiCoref document from its annotations (`file_path`) and POS metadata (`metadata_path`, by default
+    the file with the same name in `SENTICOREF_METADATA_DIR`). """
     # Temporary cluster representation:
     # {cluster1 index: { mention1_idx: ['mention1', 'tokens'], mention2_idx: [...] }, cluster2_idx: {...} }
     _clusters = {}
@@ -198,45 +403,54 @@ def read_senticoref_doc(file_path):
     mentions, clusters = {}, []
 
     doc_id = file_path.split(os.path.sep)[-1][:-4]  # = file name without ".tsv"
-    # Note: `quoting=csv.QUOTE_NONE` is required as otherwise some documents can't be read
-    # Note: `keep_default_na=False` is required as there's a typo in corpus ("NA"), interpreted as <missing>
-    curr_annotations = pd.read_table(file_path, comment="#", sep="\t", index_col=False, quoting=csv.QUOTE_NONE,
-                                     names=["token_index", "start_end", "token", "NamedEntity", "Polarity",
-                                            "referenceRelation", "referenceType"], keep_default_na=False)
-    curr_metadata = pd.read_table(os.path.join(SENTICOREF_METADATA_DIR, f"{doc_id}.tsv"), sep="\t", index_col=False,
-                                  quoting=csv.QUOTE_NONE, header=0, keep_default_na=False)
-
-    metadata = {"tokens": {}}
-    for i, (tok_id, ref_info, token) in enumerate(curr_annotations[["token_index", "referenceRelation", "token"]].values):
-        # Token is part of some mention
-        if ref_info != "_":
-            # Token can be part of multiple mentions
-            ref_annotations = ref_info.split("|")
-
-            for mention_info in ref_annotations:
-                cluster_idx, mention_idx = list(map(int, mention_info[3:].split("-")))  # skip "*->"
-
-                curr_mentions = _clusters.get(cluster_idx, {})
-                curr_mention_tok_ids = curr_mentions.get(mention_idx, [])
-                curr_mention_tok_ids.append(tok_id)
-                curr_mentions[mention_idx] = curr_mention_tok_ids
-
-                _clusters[cluster_idx] = curr_mentions
-
-        _curr_sent.append(tok_id)
-        tok_to_position[tok_id] = [idx_sent, idx_inside_sent]
-        id_to_tok[tok_id] = token
-        idx_inside_sent += 1
-
-        text, pos_tag, lemma = curr_metadata.iloc[i].values
-        metadata["tokens"][tok_id] = {"ana": pos_tag, "lemma": lemma, "text": text}
-
-        # Segment sentences heuristically
-        if token in {".", "!", "?"}:
-            idx_sent += 1
-            idx_inside_sent = 0
-            sents.append(_curr_sent)
-            _curr_sent = []
+    if metadata_path is None:
+        metadata_path = os.path.join(SENTICOREF_METADATA_DIR, f"{doc_id}.tsv")
+    # token ID -> (lemma, MSD tag without the "mte:" prefix)
+    token_metadata = {}
+    # Annotations (WebAnno TSV) and POS metadata are aligned line by line, so both are read in a single pass.
+    # Annotation columns: token_index, start_end, token, NamedEntity, Polarity, referenceRelation, referenceType
+    # Metadata columns (after a header): token, tag, lemma
+    with open(file_path, encoding="utf8", newline="") as f_annotations, \
+            open(metadata_path, encoding="utf8", newline="") as f_metadata:
+        metadata_rows = _read_tsv_rows(f_metadata)
+        next(metadata_rows)  # header
+
+        for annotation_row, metadata_row in zip_longest(_read_tsv_rows(f_annotations, skip_comments=True),
+                                                        metadata_rows):
+            if annotation_row is None or metadata_row is None:
+                raise ValueError(f"Number of tokens in '{file_path}' does not match the number of tokens in its "
+                                 f"metadata file")
+
+            tok_id, token, ref_info = annotation_row[0], annotation_row[2], annotation_row[5]
+            # Token is part of some mention
+            if ref_info != "_":
+                # Token can be part of multiple mentions
+                ref_annotations = ref_info.split("|")
+
+                for mention_info in ref_annotations:
+                    cluster_idx, mention_idx = list(map(int, mention_info[3:].split("-")))  # skip "*->"
+
+                    curr_mentions = _clusters.get(cluster_idx, {})
+                    curr_mention_tok_ids = curr_mentions.get(mention_idx, [])
+                    curr_mention_tok_ids.append(tok_id)
+                    curr_mentions[mention_idx] = curr_mention_tok_ids
+
+                    _clusters[cluster_idx] = curr_mentions
+
+            _curr_sent.append(tok_id)
+            tok_to_position[tok_id] = [idx_sent, idx_inside_sent]
+            id_to_tok[tok_id] = token
+            idx_inside_sent += 1
+
+            _, pos_tag, lemma = metadata_row[:3]
+            token_metadata[tok_id] = (lemma, pos_tag.split(":")[1])
+
+            # Segment sentences heuristically
+            if token in {".", "!", "?"}:
+                idx_sent += 1
+                idx_inside_sent = 0
+                sents.append(_curr_sent)
+                _curr_sent = []
 
     # If the document doesn't end with proper punctuation
     if len(_curr_sent) > 0:
@@ -248,8 +462,8 @@ def read_senticoref_doc(file_path):
         final_tokens[tok_id] = Token(
             tok_id,
             tok_raw,
-            metadata["tokens"][tok_id]["lemma"] if "lemma" in metadata["tokens"][tok_id] else None,
-            metadata["tokens"][tok_id]["ana"].split(":")[1],
+            token_metadata[tok_id][0],
+            token_metadata[tok_id][1],
             tok_to_position[tok_id][0],
             tok_to_position[tok_id][1],
             index
@@ -269,10 +483,11 @@ def read_senticoref_doc(file_path):
             mention_counter += 1
         clusters.append(curr_cluster)
 
-    return Document(doc_id, final_tokens, sents, sorted_mentions_dict(mentions), clusters, metadata=metadata)
+    return Document(doc_id, final_tokens, sents, sorted_mentions_dict(mentions), clusters, tagset=TAGSET_EN)
 
 
 def read_coref149_doc(file_path, ssj_doc):
+    """ Reads a coref149 document and enriches it with SSJ500k data (`ssj_doc`, see `read_ssj_documents()`). """
     with open(file_path, encoding="utf8") as f:
         content = f.readlines()
         content = "".join(content)
@@ -288,14 +503,13 @@ def read_coref149_doc(file_path, ssj_doc):
     # Tokens have different IDs in ssj500k, so remap coref149 style to ssj500k style
     idx_sent_coref, idx_token_coref = 0, 0
     _coref_to_ssj = {} # mapping from coref ids to ssj ids
-    for curr_sent in ssj_doc.findAll("s"):
-        for curr_token in curr_sent.findAll(["w", "pc"]):
+    for curr_sent in ssj_doc["sentences"]:
+        for ssj_token_id, ssj_token in curr_sent:
             coref_token_id = sents[idx_sent_coref][idx_token_coref]
-            ssj_token_id = curr_token["xml:id"]
 
             # Warn in case tokenization is different between datasets (we are slightly screwed in that case)
-            if curr_token.text.strip() != tokens[coref_token_id]:
-                logging.warning(f"MISMATCH! '{curr_token.text.strip()}' (ssj500k ID: {ssj_token_id}) vs "
+            if ssj_token != tokens[coref_token_id]:
+                logging.warning(f"MISMATCH! '{ssj_token}' (ssj500k ID: {ssj_token_id}) vs "
                                 f"'{tokens[coref_token_id]}' (coref149 ID: {coref_token_id})")
 
             _coref_to_ssj[coref_token_id] = ssj_token_id
@@ -307,15 +521,8 @@ def read_coref149_doc(file_path, ssj_doc):
     # sentences are composed of ssj token IDs
     fixed_sents = [[_coref_to_ssj[curr_id] for curr_id in curr_sent] for curr_sent in sents]
 
-    # Write all metadata for tokens
-    # Note: currently not writing SRL/dependency metadata
-    metadata = {"tokens": {}}
-    for token in ssj_doc.findAll(["w", "c", "pc"]):
-        token_id = token.get("xml:id", None)
-
-        if token_id:
-            metadata["tokens"][token_id] = token.attrs
-            metadata["tokens"][token_id]["text"] = token.text
+    # Note: token metadata (lemma, MSD) is stored in Token objects; SRL/dependency metadata is currently not used
+    token_metadata = ssj_doc["tokens"]
 
     final_tokens = OrderedDict()
     for index, (coref_token_id, raw_text) in enumerate(tokens.items()):
@@ -323,8 +530,8 @@ def read_coref149_doc(file_path, ssj_doc):
         final_tokens[ssj_token_id] = Token(
             ssj_token_id,
             raw_text,
-            metadata["tokens"][ssj_token_id]["lemma"] if "lemma" in metadata["tokens"][ssj_token_id] else None,
-            metadata["tokens"][ssj_token_id]["ana"].split(":")[1],
+            token_metadata[ssj_token_id].get("lemma", None),
+            token_metadata[ssj_token_id]["ana"].split(":")[1],
             tok_to_position[coref_token_id][0],  # Note: tok_to_pos uses coref IDs, not ssj IDs
             tok_to_position[coref_token_id][1],
             index)
@@ -334,33 +541,276 @@ def read_coref149_doc(file_path, ssj_doc):
         token_objs = [final_tokens[_coref_to_ssj[tok_id]] for tok_id in mention_tokens]
         final_mentions[mention_id] = Mention(mention_id, token_objs)
 
-    # TODO: is metadata required here? metadata for tokens has been moved to token object
-    return Document(doc_id, final_tokens, fixed_sents, sorted_mentions_dict(final_mentions), clusters, metadata=metadata)
+    return Document(doc_id, final_tokens, fixed_sents, sorted_mentions_dict(final_mentions), clusters)
 
 
-def read_corpus(name):
-    SUPPORTED_DATASETS = {"coref149", "senticoref"}
-    if name not in SUPPORTED_DATASETS:
-        raise ValueError(f"Unsupported dataset (must be one of {SUPPORTED_DATASETS})")
-
+def _document_source_paths(name, doc_id):
+    """ Returns the paths of files that document `doc_id` of corpus `name` is built from. """
     if name == "coref149":
-        with open(SSJ_PATH, encoding="utf8") as ssj:
-            content = ssj.readlines()
-            content = "".join(content)
-            ssj_soup = BeautifulSoup(content, "lxml")
+        return [os.path.join(COREF149_DIR, f"{doc_id}.tcf")]
+    else:
+        return [os.path.join(SENTICOREF_DIR, f"{doc_id}.tsv"), os.path.join(SENTICOREF_METADATA_DIR, f"{doc_id}.tsv")]
+
 
-        doc_to_soup = {}
-        for curr_soup in ssj_soup.findAll("p"):
-            doc_to_soup[curr_soup["xml:id"]] = curr_soup
+def _shared_source_paths(name):
+    """ Returns the paths of files that all documents of corpus `name` are (partially) built from. """
+    return [SSJ_PATH] if name == "coref149" else []
 
+
+def _corpus_source_files(name):
+    """ Returns the IDs of documents in corpus `name` and the paths of all files these documents are built from. """
+    if name == "coref149":
         doc_ids = [f[:-4] for f in os.listdir(COREF149_DIR)
                    if os.path.isfile(os.path.join(COREF149_DIR, f)) and f.endswith(".tcf")]
-        return [read_coref149_doc(os.path.join(COREF149_DIR, f"{curr_id}.tcf"), doc_to_soup[curr_id]) for curr_id in doc_ids]
     else:
         doc_ids = [f[:-4] for f in os.listdir(SENTICOREF_DIR)
                    if os.path.isfile(os.path.join(SENTICOREF_DIR, f)) and f.endswith(".tsv")]
 
-        return [read_senticoref_doc(os.path.join(SENTICOREF_DIR, f"{curr_id}.tsv")) for curr_id in doc_ids]
+    source_paths = [curr_path for curr_id in doc_ids for curr_path in _document_source_paths(name, curr_id)] + \
+                   _shared_source_paths(name)
+    return doc_ids, source_paths
+
+
+def _fingerprint_files(paths):
+    """ Describes the state of source files with their (absolute path, size, modification time) triples. Any change
+    in the source files changes the fingerprint. """
+    fingerprint = []
+    for curr_path in sorted(paths):
+        file_stat = os.stat(curr_path)
+        fingerprint.append((os.path.abspath(curr_path), file_stat.st_size, file_stat.st_mtime_ns))
+
+    return fingerprint
+
+
+def _hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def _build_manifest(paths, previous_manifest=None):
+    """ Maps absolute paths of source files to their [size, modification time, SHA-1 of content]. Files whose size
+    and modification time are unchanged since `previous_manifest` are not hashed again. """
+    previous_manifest = previous_manifest if previous_manifest is not None else {}
+    manifest = {}
+    for curr_path in paths:
+        abs_path = os.path.abspath(curr_path)
+        file_stat = os.stat(abs_path)
+        prev_info = previous_manifest.get(abs_path)
+        if prev_info is not None and prev_info[0] == file_stat.st_size and prev_info[1] == file_stat.st_mtime_ns:
+            digest = prev_info[2]
+        else:
+            digest = _hash_file(abs_path)
+
+        manifest[abs_path] = [file_stat.st_size, file_stat.st_mtime_ns, digest]
+
+    return manifest
+
+
+def _refresh_documents(name, doc_ids, manifest, old_manifest, load_old_fn, workers=None):
+    """ Returns documents `doc_ids` of corpus `name`, re-parsing only the ones whose source files were added or
+    modified since `old_manifest`. The others are obtained with `load_old_fn(doc_id)`. Documents whose source files
+    were deleted are not in `doc_ids`, so they are dropped. """
+    def _is_unchanged(paths):
+        return all(old_manifest.get(os.path.abspath(curr_path), [None, None, None])[2] ==
+                   manifest[os.path.abspath(curr_path)][2] for curr_path in paths)
+
+    # A change in shared files (SSJ500k) can affect any document
+    shared_unchanged = _is_unchanged(_shared_source_paths(name))
+    changed_ids = [curr_id for curr_id in doc_ids
+                   if not (shared_unchanged and _is_unchanged(_document_source_paths(name, curr_id)))]
+    logging.info(f"Re-parsing {len(changed_ids)}/{len(doc_ids)} added or modified documents of '{name}'")
+
+    parsed_docs = {}
+    if len(changed_ids) > 0:
+        parsed_docs = dict(zip(changed_ids, _parse_corpus(name, changed_ids, workers=workers)))
+
+    return [parsed_docs[curr_id] if curr_id in parsed_docs else load_old_fn(curr_id) for curr_id in doc_ids]
+
+
+def _read_cache_file(cache_path):
+    """ Returns the contents of the corpus cache at `cache_path` if it exists and has the current format, otherwise
+    None. """
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+    except Exception as exc:
+        logging.warning(f"Could not read corpus cache at '{cache_path}' ({exc}), ignoring it")
+        return None
+
+    if cached.get("version") != CORPUS_CACHE_VERSION:
+        logging.info(f"Corpus cache at '{cache_path}' has an outdated format")
+        return None
+
+    return cached
+
+
+def _save_cached_corpus(cache_path, fingerprint, manifest, documents):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write into a temporary file first, so that an interrupted write never leaves behind a corrupted cache
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({
+            "version": CORPUS_CACHE_VERSION,
+            "fingerprint": fingerprint,
+            "manifest": manifest,
+            "documents": documents
+        }, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def _map_documents(read_fn, *read_args, workers=None):
+    """ Applies `read_fn` over (zipped) `read_args`, optionally spreading the work over a pool of `workers` processes.
+    If `workers` is None, a pool (of one process per CPU core) is only used for at least `PARALLEL_PARSE_MIN_DOCS`
+    documents. Documents are returned in the same order as the arguments.
+
+    Workers only receive the arguments, so all paths must be passed explicitly: module-level settings (e.g. directories
+    changed at runtime) are not visible in worker processes. """
+    num_docs = len(read_args[0])
+    if workers is None:
+        workers = (os.cpu_count() or 1) if num_docs >= PARALLEL_PARSE_MIN_DOCS else 1
+
+    if workers <= 1 or num_docs <= 1:
+        return list(map(read_fn, *read_args))
+
+    # Send documents to workers in batches to amortize the inter-process communication overhead
+    chunksize = max(1, num_docs // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_fn, *read_args, chunksize=chunksize))
+
+
+def _parse_corpus(name, doc_ids, workers=None):
+    if name == "coref149":
+        ssj_docs = read_ssj_documents(SSJ_PATH, doc_ids)
+        return _map_documents(read_coref149_doc,
+                              [os.path.join(COREF149_DIR, f"{curr_id}.tcf") for curr_id in doc_ids],
+                              [ssj_docs[curr_id] for curr_id in doc_ids],
+                              workers=workers)
+    else:
+        return _map_documents(read_senticoref_doc,
+                              [os.path.join(SENTICOREF_DIR, f"{curr_id}.tsv") for curr_id in doc_ids],
+                              [os.path.join(SENTICOREF_METADATA_DIR, f"{curr_id}.tsv") for curr_id in doc_ids],
+                              workers=workers)
+
+
+class _LazyCoref149Reader:
+    """ Reads single coref149 documents on demand. SSJ500k is streamed once, on first use. """
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self._ssj_docs = None
+
+    def __call__(self, doc_id):
+        if self._ssj_docs is None:
+            self._ssj_docs = read_ssj_documents(SSJ_PATH, self.doc_ids)
+        return read_coref149_doc(os.path.join(COREF149_DIR, f"{doc_id}.tcf"), self._ssj_docs[doc_id])
+
+
+def _read_senticoref_doc_by_id(doc_id):
+    return read_senticoref_doc(os.path.join(SENTICOREF_DIR, f"{doc_id}.tsv"))
+
+
+def _read_columnar_corpus(name, doc_ids, source_paths, rebuild=False, incremental=True, workers=None):
+    """ Serves the documents of corpus `name` from a memory-mapped columnar store in `CORPUS_CACHE_DIR`, (re)building
+    the store from source files if it does not exist or is stale. """
+    import columnar  # imported here as `columnar` itself depends on this module
+
+    store_dir = os.path.join(CORPUS_CACHE_DIR, f"{name}.columnar")
+    # Stored as JSON, so tuples come back as lists
+    fingerprint = [list(file_info) for file_info in _fingerprint_files(source_paths)]
+    old_reader = None
+    if not rebuild and os.path.isfile(os.path.join(store_dir, "meta.json")):
+        try:
+            old_reader = columnar.ColumnarCorpusReader(store_dir)
+            if old_reader.metadata.get("fingerprint") == fingerprint:
+                logging.info(f"Opened columnar store of '{name}' at '{store_dir}' ({len(old_reader)} documents)")
+                return Corpus(old_reader.doc_ids, load_fn=old_reader.document)
+            logging.info(f"Columnar store at '{store_dir}' is stale")
+        except Exception as exc:
+            logging.warning(f"Could not open columnar store at '{store_dir}' ({exc}), ignoring it")
+            old_reader = None
+
+    old_manifest = old_reader.metadata.get("manifest") if old_reader is not None and incremental else None
+    manifest = _build_manifest(source_paths, previous_manifest=old_manifest)
+    if old_manifest is not None:
+        documents = _refresh_documents(name, doc_ids, manifest, old_manifest, old_reader.document, workers=workers)
+    else:
+        documents = _parse_corpus(name, doc_ids, workers=workers)
+
+    os.makedirs(CORPUS_CACHE_DIR, exist_ok=True)
+    columnar.export_columnar(documents, store_dir,
+                             metadata={"name": name, "fingerprint": fingerprint, "manifest": manifest})
+    logging.info(f"Stored {len(documents)} documents of '{name}' to columnar store at '{store_dir}'")
+    return columnar.read_columnar_corpus(store_dir)
+
+
+def read_corpus(name, use_cache=True, workers=None, lazy=False, backend="pickle", incremental=True):
+    """ Reads all documents of corpus `name` into a `Corpus`.
+
+    If `use_cache` is True, the parsed documents are stored into (and on subsequent calls loaded from)
+    `CORPUS_CACHE_DIR`. The cache is refreshed automatically when any of the source files is added, removed or
+    modified. If `incremental` is True, the cache keeps a manifest of source file hashes and only the documents whose
+    files were added or modified are re-parsed (documents with deleted files are dropped), otherwise the whole corpus
+    is re-parsed.
+
+    Documents that need to be parsed are parsed in parallel by `workers` processes. By default, they are parsed in the
+    current process, unless there are at least `PARALLEL_PARSE_MIN_DOCS` of them (e.g. a large corpus without a
+    cache), in which case one process per CPU core is used. Use `workers=1` to always parse them in the current
+    process. The order of documents does not depend on the number of workers.
+
+    If `lazy` is True and there is no usable cache, documents are only parsed when they are first accessed
+    (e.g. when only the test set is used, the rest of the corpus is never parsed). Lazily read corpora are not cached.
+    A usable cache is always loaded instead, as that does not require parsing any document.
+
+    If `backend` is "columnar", documents are served from a columnar store of NumPy arrays in `CORPUS_CACHE_DIR`
+    (see `columnar.py`), which is memory-mapped read-only, so any number of processes reading the same corpus share
+    a single copy of it. Documents are built from the store when they are first accessed. The store is (re)built when
+    it is missing or stale, or when `use_cache` is False.
+    """
+    SUPPORTED_DATASETS = {"coref149", "senticoref"}
+    if name not in SUPPORTED_DATASETS:
+        raise ValueError(f"Unsupported dataset (must be one of {SUPPORTED_DATASETS})")
+    SUPPORTED_BACKENDS = {"pickle", "columnar"}
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(f"Unsupported backend (must be one of {SUPPORTED_BACKENDS})")
+
+    doc_ids, source_paths = _corpus_source_files(name)
+    if backend == "columnar":
+        return _read_columnar_corpus(name, doc_ids, source_paths, rebuild=not use_cache, incremental=incremental,
+                                     workers=workers)
+
+    load_fn = _LazyCoref149Reader(doc_ids) if name == "coref149" else _read_senticoref_doc_by_id
+
+    cache_path = os.path.join(CORPUS_CACHE_DIR, f"{name}.pkl")
+    cached = _read_cache_file(cache_path) if use_cache else None
+    fingerprint = _fingerprint_files(source_paths) if use_cache else None
+    if cached is not None and cached["fingerprint"] == fingerprint:
+        documents = cached["documents"]
+        logging.info(f"Loaded {len(documents)} cached documents of '{name}' from '{cache_path}'")
+    elif cached is not None and incremental:
+        logging.info(f"Corpus cache at '{cache_path}' is stale, refreshing it")
+        manifest = _build_manifest(source_paths, previous_manifest=cached["manifest"])
+        cached_docs = {doc.doc_id: doc for doc in cached["documents"]}
+        documents = _refresh_documents(name, doc_ids, manifest, cached["manifest"], cached_docs.__getitem__,
+                                       workers=workers)
+        _save_cached_corpus(cache_path, fingerprint, manifest, documents)
+        logging.info(f"Cached {len(documents)} documents of '{name}' to '{cache_path}'")
+    elif lazy:
+        return Corpus(doc_ids, load_fn=load_fn)
+    else:
+        documents = _parse_corpus(name, doc_ids, workers=workers)
+        if use_cache:
+            _save_cached_corpus(cache_path, fingerprint, _build_manifest(source_paths), documents)
+            logging.info(f"Cached {len(documents)} documents of '{name}' to '{cache_path}'")
+
+    return Corpus([doc.doc_id for doc in documents],
+                  documents={doc.doc_id: doc for doc in documents},
+                  load_fn=load_fn)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+""" Preprocessing of mention spans and antecedent candidates, shared by the neural controllers.
+
+Spans of all mentions in a document are stored once, in a [num_mentions, 2, max_span_size] index array (positions of
+span tokens in the embedded document) and a [num_mentions, max_span_size] mask, so candidates of a head mention are
+selected by (prefix) slicing instead of being copied for every head mention.
+"""
+
+import numpy as np
+
+
+def antecedent_candidates(document, mention_ids, idx_head, max_antecedents=None, max_sentence_distance=None):
+    """ Returns (0-based) positions of mentions in `mention_ids` that are considered as antecedent candidates for the
+    mention at position `idx_head`: preceding mentions, optionally limited to the `max_antecedents` closest ones and to
+    the ones at most `max_sentence_distance` sentences before the head mention. Contiguous candidates are returned
+    as a `range`. """
+    start = 0 if max_antecedents is None else max(0, idx_head - max_antecedents)
+    if max_sentence_distance is None:
+        return range(start, idx_head)
+
+    head_sentence = document.mention_offsets[mention_ids[idx_head]][0]
+    return [idx_cand for idx_cand in range(start, idx_head)
+            if head_sentence - document.mention_offsets[mention_ids[idx_cand]][0] <= max_sentence_distance]
+
+
+def span_indices(mention_positions, max_span_size):
+    """ Converts positions of mention tokens into a padded index array and a mask.
+
+    Args:
+        mention_positions: for each mention, a list of (idx_outer, idx_inner) positions of its (sub)words inside the
+            embedded document, e.g. (idx_segment, idx_inside_segment)
+        max_span_size: length, which all spans are padded/truncated to
+
+    Returns:
+        int64 array of shape [num_mentions, 2, max_span_size] and bool mask of shape [num_mentions, max_span_size].
+        Padding positions point to the last (PAD) token of the outer unit that contains the last token of the span.
+    """
+    num_mentions = len(mention_positions)
+    indices = np.full((num_mentions, 2, max_span_size), -1, dtype=np.int64)
+    if num_mentions == 0:
+        return indices, np.zeros((num_mentions, max_span_size), dtype=bool)
+
+    lengths = np.fromiter((min(len(positions), max_span_size) for positions in mention_positions),
+                          dtype=np.int64, count=num_mentions)
+    flat_positions = np.array([pos for positions in mention_positions for pos in positions[:max_span_size]],
+                              dtype=np.int64).reshape((-1, 2))
+
+    mask = np.arange(max_span_size)[np.newaxis, :] < lengths[:, np.newaxis]
+    indices[:, 0, :] = flat_positions[np.cumsum(lengths) - 1, 0][:, np.newaxis]
+    # np.nonzero() returns positions in row-major order, which matches the order of `flat_positions`
+    idx_rows, idx_cols = np.nonzero(mask)
+    indices[idx_rows, 0, idx_cols] = flat_positions[:, 0]
+    indices[idx_rows, 1, idx_cols] = flat_positions[:, 1]
+
+    return indices, mask
+
+
+def candidate_steps(document, max_antecedents=None, max_sentence_distance=None):
+    """ Returns one step per mention of `document`, containing the position of the head mention (`idx_head`),
+    positions of its antecedent candidates (`candidate_positions`) and indices of the correct antecedents among
+    [dummy antecedent, *candidates] (`correct_antecedents`, [0] if no correct antecedent is among the candidates). """
+    mention_ids = list(document.mentions.keys())
+    mention_to_cluster = {}
+    for curr_cluster in document.clusters:
+        for mention_id in curr_cluster:
+            mention_to_cluster[mention_id] = curr_cluster
+
+    steps = []
+    for idx_head, head_id in enumerate(mention_ids):
+        candidate_positions = antecedent_candidates(document, mention_ids, idx_head,
+                                                    max_antecedents=max_antecedents,
+                                                    max_sentence_distance=max_sentence_distance)
+
+        cluster_positions = [document.mention_positions[mention_id] for mention_id in mention_to_cluster[head_id]]
+        if isinstance(candidate_positions, range):
+            # Contiguous candidates: the column of a candidate follows from its position
+            correct_antecedents = [1 + idx_mention - candidate_positions.start for idx_mention in cluster_positions
+                                   if idx_mention in candidate_positions]
+        else:
+            column_of_candidate = {idx_cand: column for column, idx_cand in enumerate(candidate_positions, 1)}
+            correct_antecedents = [column_of_candidate[idx_mention] for idx_mention in cluster_positions
+                                   if idx_mention in column_of_candidate]
+
+        steps.append({
+            "head_id": head_id,
+            "idx_head": idx_head,
+            "candidate_positions": candidate_positions,
+            "correct_antecedents": sorted(correct_antecedents) if len(correct_antecedents) > 0 else [0]
+        })
+
+    return steps
+
+
+def candidate_pairs(steps):
+    """ Returns the data needed to score all steps (see `candidate_steps()`) at once: (head, candidate) positions of
+    all pairs, the column of each pair in the padded candidate score matrix, shape
+    [num_mentions (heads), 1 + max_candidates (dummy + candidates)], and the mask of correct antecedents in it. """
+    num_candidates = np.array([len(step["candidate_positions"]) for step in steps], dtype=np.int64)
+    num_pairs = int(np.sum(num_candidates))
+
+    idx_heads = np.repeat(np.array([step["idx_head"] for step in steps], dtype=np.int64), num_candidates)
+    idx_cands = np.concatenate([np.asarray(step["candidate_positions"], dtype=np.int64) for step in steps]) \
+        if num_pairs > 0 else np.zeros(0, dtype=np.int64)
+    # Candidate at k-th position of a step goes into column (1 + k), column 0 is reserved for the dummy antecedent
+    columns = 1 + np.arange(num_pairs) - np.repeat(np.cumsum(num_candidates) - num_candidates, num_candidates)
+
+    is_antecedent = np.zeros((len(steps), 1 + int(np.max(num_candidates, initial=0))), dtype=bool)
+    for step in steps:
+        is_antecedent[step["idx_head"], step["correct_antecedents"]] = True
+
+    return {
+        "idx_heads": idx_heads,
+        "idx_cands": idx_cands,
+        "columns": columns,
+        "is_antecedent": is_antecedent
+    }
+
+
+def take_spans(spans, positions):
+    """ Selects rows of `spans` (NumPy array or torch tensor) at `positions`, using a view for contiguous ones. """
+    if isinstance(positions, range) and positions.step == 1:
+        return spans[positions.start: positions.stop]
+
+    return spans[list(positions)]
@@ -0,0 +1,105 @@
+""" Decoding of morphosyntactic descriptions (MSD tags).
+
+There are only a few hundred distinct MSD tags in a corpus, so each tag is decoded once into an `MsdInfo` and the
+decoded attributes are shared by all tokens with that tag (see `decode_msd()`).
+
+Attribute values (single characters of the MSD tag) are also encoded as small integers, which are the same in all
+processes, so that decoded attributes can be used in vectorized (NumPy) feature code:
+`attribute_id(value) == 0` for `None` (attribute not present in tag).
+"""
+import string
+
+import numpy as np
+
+# http://nl.ijs.si/ME/Vault/V5/msd/html/msd-sl.html
+_ATTRIBUTE_VALUES = string.ascii_letters + string.digits + "-"
+_VALUE_TO_ID = {value: idx for idx, value in enumerate(_ATTRIBUTE_VALUES, start=1)}
+NONE_ID = 0
+UNKNOWN_ID = len(_ATTRIBUTE_VALUES) + 1
+# Tagsets of MSD tags: Slovene attribute codes (e.g. "Somei", coref149 and SSJ500k) or English attribute codes (e.g.
+# "Ncmsn", SentiCoref tagged with Stanza)
+TAGSET_SL = "sl"
+TAGSET_EN = "en"
+
+
+def attribute_id(value):
+    """ Encodes a (single-character) attribute value as a small integer. """
+    if value is None:
+        return NONE_ID
+    return _VALUE_TO_ID.get(value, UNKNOWN_ID)
+
+
+def _extract_number(msd_string):
+    number = None
+    if msd_string[0] == "S" and len(msd_string) >= 4:  # noun/samostalnik
+        number = msd_string[3]
+    elif msd_string[0] == "G" and len(msd_string) >= 6:  # verb/glagol
+        number = msd_string[5]
+    # P = adjective (pridevnik), Z = pronoun (zaimek), K = numeral (števnik)
+    elif msd_string[0] in {"P", "Z", "K"} and len(msd_string) >= 5:
+        number = msd_string[4]
+
+    return number
+
+
+def _extract_gender(msd_string):
+    gender = None
+    if msd_string[0] == "S" and len(msd_string) >= 3:  # noun/samostalnik
+        gender = msd_string[2]
+    elif msd_string[0] == "G" and len(msd_string) >= 7:  # verb/glagol
+        gender = msd_string[6]
+    # P = adjective (pridevnik), Z = pronoun (zaimek), K = numeral (števnik)
+    elif msd_string[0] in {"P", "Z", "K"} and len(msd_string) >= 4:
+        gender = msd_string[3]
+
+    return gender
+
+
+class MsdInfo:
+    """ Decoded MSD tag. Obtain instances with `decode_msd()`, which makes sure each tag is decoded only once. """
+    __slots__ = ("msd", "msd_id", "category", "subtype", "gender", "number",
+                 "category_id", "subtype_id", "gender_id", "number_id")
+
+    def __init__(self, msd, msd_id):
+        self.msd = msd
+        # Position of tag in the decoding table: only consistent inside a single process
+        self.msd_id = msd_id
+
+        self.category = msd[0]
+        # e.g. "p" (povratni, reflexive) for pronouns (category "Z")
+        self.subtype = msd[1] if len(msd) >= 2 else None
+        self.gender = _extract_gender(msd)
+        self.number = _extract_number(msd)
+
+        self.category_id = attribute_id(self.category)
+        self.subtype_id = attribute_id(self.subtype)
+        self.gender_id = attribute_id(self.gender)
+        self.number_id = attribute_id(self.number)
+
+    def __reduce__(self):
+        # Unpickled tags are looked up in the decoding table of the receiving process instead of being duplicated
+        return decode_msd, (self.msd,)
+
+    def __str__(self):
+        return f"MsdInfo(\"{self.msd}\")"
+
+
+_MSD_TABLE = {}  # type: dict
+
+
+def decode_msd(msd):
+    """ Returns the (shared) decoded `MsdInfo` for tag `msd`. """
+    info = _MSD_TABLE.get(msd)
+    if info is None:
+        info = MsdInfo(msd, msd_id=len(_MSD_TABLE))
+        _MSD_TABLE[msd] = info
+
+    return info
+
+
+def msd_attribute_ids(tokens):
+    """ Returns an int array of shape [len(tokens), 4], containing encoded category, subtype, gender and number of
+    each token. """
+    return np.array([(tok.msd_info.category_id, tok.msd_info.subtype_id,
+                      tok.msd_info.gender_id, tok.msd_info.number_id) for tok in tokens],
+                    dtype=np.int8).reshape((-1, 4))
@@ -12,7 +12,9 @@ import torch.nn as nn
 import torch.optim as optim
 from sklearn.model_selection import KFold
 
-from common import ControllerBase, NeuralCoreferencePairScorer
+import mention_spans
+from common import configure_prepared_doc_cache, ControllerBase, NeuralCoreferencePairScorer, \
+    rank_antecedents_batched
 from data import read_corpus, Document
 from utils import extract_vocab, split_into_sets, fixed_split
 
@@ -25,6 +27,10 @@ parser.add_argument("--learning_rate", type=float, default=0.001)
 parser.add_argument("--num_epochs", type=int, default=30)
 
 parser.add_argument("--dataset", type=str, default="senticoref")
+parser.add_argument("--max_antecedents", type=int, default=None,
+                    help="Maximum number of closest preceding mentions considered as antecedent candidates")
+parser.add_argument("--max_sentence_distance", type=int, default=None,
+                    help="Maximum distance (in sentences) between a mention and its antecedent candidates")
 parser.add_argument("--max_vocab_size", type=int, default=9_999_999,
                     help="Limit the maximum vocabulary size. Set to a high number if you don't want to limit it")
 parser.add_argument("--use_pretrained_embs", type=str, default="fastText", choices=["fastText", "word2vec", None],
@@ -36,6 +42,18 @@ parser.add_argument("--embedding_size", type=int, default=None,
 parser.add_argument("--freeze_pretrained", action="store_true")
 parser.add_argument("--random_seed", type=int, default=13)
 parser.add_argument("--fixed_split", action="store_true")
+parser.add_argument("--prepared_doc_cache_size", type=int, default=1024,
+                    help="Maximum number of preprocessed documents kept in memory")
+parser.add_argument("--prepared_doc_store_dir", type=str, default=None,
+                    help="If set, preprocessed documents are stored in (and reused from) this directory")
+parser.add_argument("--batched", action="store_true",
+                    help="Score all mention pairs of a document in a single batched pass instead of once per mention")
+parser.add_argument("--coarse_top_k", type=int, default=None,
+                    help="If set, only this many best candidates of each mention (according to a jointly trained "
+                         "coarse scorer) are scored with the full pair scorer")
+parser.add_argument("--factorized", action="store_true",
+                    help="Compute the first layer of the pair scorer from per-mention projections instead of "
+                         "concatenated pair representations (faster, but dropout is then applied per mention)")
 
 
 logging.basicConfig(level=logging.INFO)
@@ -98,6 +116,11 @@ class NoncontextualController(ControllerBase):
                  fc_hidden_size: int = 150,
                  learning_rate: float = 0.001,
                  max_span_size: int = 10,
+                 max_antecedents: Optional[int] = None,
+                 max_sentence_distance: Optional[int] = None,
+                 batched: bool = False,
+                 coarse_top_k: Optional[int] = None,
+                 factorized: bool = False,
                  num_embeddings: Optional[int] = None,
                  embedding_size: Optional[int] = None,
                  embedding_type: Optional[str] = None,
@@ -119,6 +142,22 @@ class NoncontextualController(ControllerBase):
             Learning rate used to train the model
         max_span_size:
             Span size, which all spans are padded/truncated to
+        max_antecedents:
+            Maximum number of closest preceding mentions considered as antecedent candidates. If None, all
+            preceding mentions are considered
+        max_sentence_distance:
+            Maximum distance (in sentences) between a mention and its antecedent candidates. If None, the
+            distance is not limited
+        batched:
+            Whether to score all mention pairs of a document in a single batched pass instead of once per head
+            mention
+        coarse_top_k:
+            If set, only this many best candidates of each head mention (according to a jointly trained coarse
+            scorer) are scored with the full pair scorer. Implies batched scoring
+        factorized:
+            Whether to compute the first layer of the pair scorer from projections of single mentions (see
+            `NeuralCoreferencePairScorer.project_spans()`) instead of concatenated pair representations. Scores are
+            the same in evaluation mode, but dropout is applied to mentions instead of pairs during training
         num_embeddings:
             The first dimension of embedding matrix. Set this explicitly if you want to initialize an embedding matrix
             larger than the vocabulary size
@@ -141,6 +180,11 @@ class NoncontextualController(ControllerBase):
         self.dropout = dropout
         self.fc_hidden_size = fc_hidden_size
         self.max_span_size = max_span_size
+        self.max_antecedents = max_antecedents
+        self.max_sentence_distance = max_sentence_distance
+        self.batched = batched
+        self.coarse_top_k = coarse_top_k
+        self.factorized = factorized
         self.embedding_type = embedding_type
         self.freeze_pretrained = freeze_pretrained
         self.embeddings_path = None  # None or points to pretrained fastText
@@ -178,7 +222,8 @@ class NoncontextualController(ControllerBase):
 
         self.scorer = NeuralCoreferencePairScorer(num_features=self.embedding_size,
                                                   hidden_size=fc_hidden_size,
-                                                  dropout=dropout).to(DEVICE)
+                                                  dropout=dropout,
+                                                  coarse_scorer=(coarse_top_k is not None)).to(DEVICE)
         self.optimizer = optim.Adam(self.scorer.parameters() if freeze_pretrained else
                                     (list(self.scorer.parameters()) + list(self.embedder.parameters())),
                                     lr=learning_rate)
@@ -229,6 +274,11 @@ class NoncontextualController(ControllerBase):
                 "fc_hidden_size": self.fc_hidden_size,
                 "learning_rate": self.learning_rate,
                 "max_span_size": self.max_span_size,
+                "max_antecedents": self.max_antecedents,
+                "max_sentence_distance": self.max_sentence_distance,
+                "batched": self.batched,
+                "coarse_top_k": self.coarse_top_k,
+                "factorized": self.factorized,
                 "freeze_pretrained": self.freeze_pretrained
             }, fp=f_config, indent=4)
 
@@ -265,6 +315,13 @@ class NoncontextualController(ControllerBase):
         logging.warning("save_checkpoint() is deprecated. Use save_pretrained() instead")
         self.save_pretrained(self.path_model_dir)
 
+    def preprocessing_config(self):
+        return {
+            "max_span_size": self.max_span_size,
+            "max_antecedents": self.max_antecedents,
+            "max_sentence_distance": self.max_sentence_distance
+        }
+
     def _prepare_doc(self, curr_doc: Document) -> Dict:
         """ Returns a cache dictionary with preprocessed data. This should only be called once per document, since
         data inside same document does not get shuffled. """
@@ -281,92 +338,20 @@ class NoncontextualController(ControllerBase):
         for i in range(len(preprocessed_sents)):
             preprocessed_sents[i].extend(["<PAD>"] * (max_len - len(preprocessed_sents[i])))
 
-        cluster_sets = []
-        mention_to_cluster_id = {}
-        for i, curr_cluster in enumerate(curr_doc.clusters):
-            cluster_sets.append(set(curr_cluster))
-            for mid in curr_cluster:
-                mention_to_cluster_id[mid] = i
-
-        all_candidate_data = []
-        for idx_head, (head_id, head_mention) in enumerate(curr_doc.mentions.items(), start=1):
-            gt_antecedent_ids = cluster_sets[mention_to_cluster_id[head_id]]
-
-            # Note: no data for dummy antecedent (len(`features`) is one less than `candidates`)
-            candidates, candidate_data = [None], []
-            starts, ends = [], []
-            candidate_attention = []
-            correct_antecedents = []
-
-            curr_head_data = [[], []]
-            for curr_token in head_mention.tokens:
-                curr_head_data[0].append(curr_token.sentence_index)
-                curr_head_data[1].append(curr_token.position_in_sentence)
-
-            num_tokens = len(head_mention.tokens)
-            if num_tokens > self.max_span_size:
-                curr_head_data[0] = curr_head_data[0][:self.max_span_size]
-                curr_head_data[1] = curr_head_data[1][:self.max_span_size]
-            else:
-                curr_head_data[0] += [head_mention.tokens[0].sentence_index] * (self.max_span_size - num_tokens)
-                curr_head_data[1] += [-1] * (self.max_span_size - num_tokens)
-
-            head_start = 0
-            head_end = num_tokens
-            head_attention = torch.ones((1, self.max_span_size), dtype=torch.bool)
-            head_attention[0, num_tokens:] = False
-
-            for idx_candidate, (cand_id, cand_mention) in enumerate(curr_doc.mentions.items(), start=1):
-                if idx_candidate >= idx_head:
-                    break
-
-                candidates.append(cand_id)
-
-                # Maps tokens to positions inside document (idx_sent, idx_inside_sent) for efficient indexing later
-                curr_candidate_data = [[], []]
-                for curr_token in cand_mention.tokens:
-                    curr_candidate_data[0].append(curr_token.sentence_index)
-                    curr_candidate_data[1].append(curr_token.position_in_sentence)
-
-                num_tokens = len(cand_mention.tokens)
-                if num_tokens > self.max_span_size:
-                    curr_candidate_data[0] = curr_candidate_data[0][:self.max_span_size]
-                    curr_candidate_data[1] = curr_candidate_data[1][:self.max_span_size]
-                else:
-                    curr_candidate_data[0] += [cand_mention.tokens[0].sentence_index] * (self.max_span_size - num_tokens)
-                    curr_candidate_data[1] += [-1] * (self.max_span_size - num_tokens)
-
-                candidate_data.append(curr_candidate_data)
-                starts.append(0)
-                ends.append(num_tokens)
-
-                curr_attention = torch.ones((1, self.max_span_size), dtype=torch.bool)
-                curr_attention[0, num_tokens:] = False
-                candidate_attention.append(curr_attention)
-
-                is_coreferent = cand_id in gt_antecedent_ids
-                if is_coreferent:
-                    correct_antecedents.append(idx_candidate)
-
-            if len(correct_antecedents) == 0:
-                correct_antecedents.append(0)
-
-            candidate_attention = torch.cat(candidate_attention) if len(candidate_attention) > 0 else []
-
-            all_candidate_data.append({
-                "head_id": head_id,
-                "head_data": torch.tensor([curr_head_data]),
-                "head_attention": head_attention,
-                "head_start": head_start,
-                "head_end": head_end,
-                "candidates": candidates,
-                "candidate_data": torch.tensor(candidate_data),
-                "candidate_attention": candidate_attention,
-                "correct_antecedents": correct_antecedents
-            })
+        # Maps tokens to positions inside document (idx_sent, idx_inside_sent) for efficient indexing later
+        positions = [[(curr_token.sentence_index, curr_token.position_in_sentence)
+                      for curr_token in curr_mention.tokens]
+                     for curr_mention in curr_doc.mentions.values()]
 
+        span_indices, span_mask = mention_spans.span_indices(positions, max_span_size=self.max_span_size)
         ret["preprocessed_sents"] = preprocessed_sents
-        ret["steps"] = all_candidate_data
+        ret["mention_ids"] = list(curr_doc.mentions.keys())
+        # Shapes: [num_mentions, 2, max_span_size] and [num_mentions, max_span_size]
+        ret["span_indices"] = torch.from_numpy(span_indices)
+        ret["span_mask"] = torch.from_numpy(span_mask)
+        ret["steps"] = mention_spans.candidate_steps(curr_doc,
+                                                     max_antecedents=self.max_antecedents,
+                                                     max_sentence_distance=self.max_sentence_distance)
 
         return ret
 
@@ -377,9 +362,7 @@ class NoncontextualController(ControllerBase):
         if len(curr_doc.mentions) == 0:
             return {}, (0.0, 0)
 
-        if not hasattr(curr_doc, "_cache_nc"):
-            curr_doc._cache_nc = self._prepare_doc(curr_doc)
-        cache = curr_doc._cache_nc  # type: dict
+        cache = self._get_prepared_doc(curr_doc)  # type: dict
 
         embedded_doc = []
         for curr_sent in cache["preprocessed_sents"]:
@@ -389,31 +372,45 @@ class NoncontextualController(ControllerBase):
         doc_loss, n_examples = 0.0, len(cache["steps"])
         preds = {}
 
+        mention_ids = cache["mention_ids"]
+        span_indices = cache["span_indices"]
+        # Representations of all mentions are computed once and shared by all (head, candidate) pairs
+        # [num_mentions, max_span_size, embedding_size]
+        span_features = embedded_doc[span_indices[:, 0, :], span_indices[:, 1, :]]
+        # [num_mentions, 3 * embedding_size]
+        span_repr = self.scorer.encode_spans(span_features, cache["span_mask"].to(DEVICE))
+        # [num_mentions, fc_hidden_size] each, if the first layer of the pair scorer is factorized
+        candidate_proj, head_proj = self.scorer.project_spans(span_repr) if self.factorized else (None, None)
+
+        # Coarse-to-fine pruning is only implemented for the batched scoring
+        if self.batched or self.coarse_top_k is not None:
+            preds, probs, doc_loss = rank_antecedents_batched(self.scorer, cache, span_repr, candidate_proj, head_proj,
+                                                              top_k=self.coarse_top_k,
+                                                              pruning_recall=self.pruning_recall)
+            if not eval_mode and torch.is_tensor(doc_loss):
+                doc_loss.backward()
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+
+            return preds, (float(doc_loss), n_examples)
+
         for curr_step in cache["steps"]:
             head_id = curr_step["head_id"]
-            head_data = curr_step["head_data"]
-
-            candidates = curr_step["candidates"]
-            candidate_data = curr_step["candidate_data"]
+            idx_head = curr_step["idx_head"]
+            candidate_positions = curr_step["candidate_positions"]
             correct_antecedents = curr_step["correct_antecedents"]
 
             # Note: num_candidates includes dummy antecedent + actual candidates
-            num_candidates = len(candidates)
+            num_candidates = 1 + len(candidate_positions)
             if num_candidates == 1:
                 curr_pred = 0
             else:
-                idx_sent = candidate_data[:, 0, :]
-                idx_in_sent = candidate_data[:, 1, :]
-
-                # [num_candidates, max_span_size, embedding_size]
-                candidate_data = embedded_doc[idx_sent, idx_in_sent]
-                # [1, head_size, embedding_size]
-                head_data = embedded_doc[head_data[:, 0, :], head_data[:, 1, :]]
-                head_data = head_data.repeat((num_candidates - 1, 1, 1))
-
-                candidate_scores = self.scorer(candidate_data, head_data,
-                                               curr_step["candidate_attention"],
-                                               curr_step["head_attention"].repeat((num_candidates - 1, 1)))
+                candidate_scores = self.scorer.score_pairs(
+                    mention_spans.take_spans(span_repr, candidate_positions), span_repr[idx_head: idx_head + 1],
+                    candidate_proj=(mention_spans.take_spans(candidate_proj, candidate_positions)
+                                    if self.factorized else None),
+                    head_proj=(head_proj[idx_head: idx_head + 1] if self.factorized else None)
+                )
                 # [1, num_candidates]
                 candidate_scores = torch.cat((torch.tensor([0.0], device=DEVICE),
                                               candidate_scores.flatten())).unsqueeze(0)
@@ -423,11 +420,14 @@ class NoncontextualController(ControllerBase):
                                       torch.tensor(correct_antecedents, device=DEVICE))
 
             # { antecedent: [mention(s)] } pair
-            existing_refs = preds.get(candidates[int(curr_pred)], [])
+            curr_pred = int(curr_pred)
+            antecedent_id = mention_ids[candidate_positions[curr_pred - 1]] if curr_pred > 0 else None
+            existing_refs = preds.get(antecedent_id, [])
             existing_refs.append(head_id)
-            preds[candidates[int(curr_pred)]] = existing_refs
+            preds[antecedent_id] = existing_refs
 
-        if not eval_mode:
+        # Note: `doc_loss` stays a float if no mention has any antecedent candidates (e.g. due to the window)
+        if not eval_mode and torch.is_tensor(doc_loss):
             doc_loss.backward()
             self.optimizer.step()
             self.optimizer.zero_grad()
@@ -437,6 +437,7 @@ class NoncontextualController(ControllerBase):
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    configure_prepared_doc_cache(args)
 
     if args.random_seed:
         torch.random.manual_seed(args.random_seed)
@@ -479,7 +480,13 @@ if __name__ == "__main__":
                                        embedding_size=override_kwargs.get("embedding_size", embedding_size),
                                        dropout=override_kwargs.get("dropout", args.dropout),
                                        fc_hidden_size=override_kwargs.get("fc_hidden_size", args.fc_hidden_size),
+                                       batched=override_kwargs.get("batched", args.batched),
+                                       coarse_top_k=override_kwargs.get("coarse_top_k", args.coarse_top_k),
+                                       factorized=override_kwargs.get("factorized", args.factorized),
                                        learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
+                                       max_antecedents=override_kwargs.get("max_antecedents", args.max_antecedents),
+                                       max_sentence_distance=override_kwargs.get("max_sentence_distance",
+                                                                                  args.max_sentence_distance),
                                        embedding_type=used_embedding_type,
                                        pretrained_embs=used_embs,
                                        freeze_pretrained=override_kwargs.get("freeze_pretrained", args.freeze_pretrained),
@@ -5,8 +5,10 @@ import classla
 from fastapi import Body, FastAPI
 from pydantic import BaseModel
 
+from common import prepared_doc_cache
 from contextual_model_bert import ContextualControllerBERT
 from data import Document, Token, Mention
+from msd import TAGSET_EN
 
 
 def classla_output_to_coref_input(classla_output):
@@ -65,7 +67,8 @@ def classla_output_to_coref_input(classla_output):
 
         output_sentences.append(output_sentence)
 
-    return Document(1, output_tokens, output_sentences, output_mentions, output_clusters)
+    # CLASSLA tags tokens with English MSD codes
+    return Document(1, output_tokens, output_sentences, output_mentions, output_clusters, tagset=TAGSET_EN)
 
 
 def init_classla():
@@ -90,6 +93,8 @@ def init_coref():
 
     instance = ContextualControllerBERT.from_pretrained(COREF_MODEL_PATH)
     instance.eval_mode()
+    # Every request is a new document, so there is nothing to reuse
+    prepared_doc_cache.max_documents = 0
     return instance
 
 
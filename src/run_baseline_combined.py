@@ -1,10 +1,12 @@
 import torch
 from sklearn.model_selection import KFold
 
-from baseline import BaselineController, MentionPairFeatures, parser
+from baseline import BaselineController, MentionPairFeatures, PairFeatureStore, configure_feature_cache, parser, \
+    use_feature_store
 from data import read_corpus
 from utils import fixed_split, KFoldStateCache, split_into_sets
 import logging
+import os
 import numpy as np
 
 parser.add_argument("--source_dataset", type=str, default="senticoref")  # {'senticoref', 'coref149'}
@@ -20,19 +22,34 @@ if __name__ == "__main__":
         torch.random.manual_seed(args.random_seed)
         np.random.seed(args.random_seed)
 
+    configure_feature_cache(args)
     baseline = BaselineController(MentionPairFeatures.num_features(),
                                   model_name=f"baseline_{args.source_dataset}_{args.target_dataset}_{args.learning_rate}",
                                   learning_rate=args.learning_rate,
-                                  dataset_name=args.target_dataset)
+                                  dataset_name=args.target_dataset,
+                                  batched=args.batched,
+                                  solver=args.solver,
+                                  candidate_window=args.candidate_window,
+                                  prune_candidates=args.prune_candidates)
 
     src_docs = read_corpus(args.source_dataset)
     tgt_docs = read_corpus(args.target_dataset)
+    if args.feature_store_dir is not None:
+        feature_store = PairFeatureStore(args.feature_store_dir)
+        feature_store.precompute(src_docs + tgt_docs, workers=(os.cpu_count() or 1),
+                                 candidate_window=args.candidate_window,
+                                 prune_candidates=args.prune_candidates)
+        use_feature_store(feature_store)
 
     def create_model_instance(model_name, **override_kwargs):
         return BaselineController(MentionPairFeatures.num_features(),
                                   model_name=model_name,
                                   learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
-                                  dataset_name=override_kwargs.get("dataset", args.target_dataset))
+                                  dataset_name=override_kwargs.get("dataset", args.target_dataset),
+                                  batched=args.batched,
+                                  solver=args.solver,
+                                  candidate_window=args.candidate_window,
+                                  prune_candidates=args.prune_candidates)
 
 
     if args.target_dataset == "coref149":
@@ -57,8 +74,8 @@ if __name__ == "__main__":
             OUTER_K = fold_cache.num_folds
 
         for curr_fold_data in fold_cache.get_next_unfinished():
-            curr_train_dev_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["train_docs"]), tgt_docs))
-            curr_test_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["test_docs"]), tgt_docs))
+            curr_train_dev_docs = tgt_docs.subset(curr_fold_data["train_docs"])
+            curr_test_docs = tgt_docs.subset(curr_fold_data["test_docs"])
 
             logging.info(f"Fold#{curr_fold_data['idx_fold']}")
             best_metric, best_name = float("inf"), None
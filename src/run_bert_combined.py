@@ -6,6 +6,7 @@ import sys
 import torch
 from sklearn.model_selection import KFold
 
+from common import configure_prepared_doc_cache
 from contextual_model_bert import ContextualControllerBERT, parser
 from utils import fixed_split, KFoldStateCache, split_into_sets
 import numpy as np
@@ -21,6 +22,7 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     logger.addHandler(logging.StreamHandler(sys.stdout))
     args = parser.parse_args()
+    configure_prepared_doc_cache(args)
 
     if args.random_seed:
         torch.random.manual_seed(args.random_seed)
@@ -34,11 +36,17 @@ if __name__ == "__main__":
                                         fc_hidden_size=override_kwargs.get("fc_hidden_size", args.fc_hidden_size),
                                         dropout=override_kwargs.get("dropout", args.dropout),
                                         combine_layers=override_kwargs.get("combine_layers", args.combine_layers),
+                                        batched=override_kwargs.get("batched", args.batched),
+                                        coarse_top_k=override_kwargs.get("coarse_top_k", args.coarse_top_k),
+                                        factorized=override_kwargs.get("factorized", args.factorized),
                                         pretrained_model_name_or_path=override_kwargs.get("pretrained_model_name_or_path",
                                                                                           args.pretrained_model_name_or_path),
                                         learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
                                         layer_learning_rate={"lr_embedder": 2e-5} if not args.freeze_pretrained else None,
                                         max_segment_size=override_kwargs.get("max_segment_size", args.max_segment_size),
+                                        max_antecedents=override_kwargs.get("max_antecedents", args.max_antecedents),
+                                        max_sentence_distance=override_kwargs.get("max_sentence_distance",
+                                                                                   args.max_sentence_distance),
                                         dataset_name=override_kwargs.get("dataset", args.target_dataset),
                                         freeze_pretrained=override_kwargs.get("freeze_pretrained", args.freeze_pretrained))
 
@@ -64,8 +72,8 @@ if __name__ == "__main__":
             OUTER_K = fold_cache.num_folds
 
         for curr_fold_data in fold_cache.get_next_unfinished():
-            curr_train_dev_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["train_docs"]), tgt_docs))
-            curr_test_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["test_docs"]), tgt_docs))
+            curr_train_dev_docs = tgt_docs.subset(curr_fold_data["train_docs"])
+            curr_test_docs = tgt_docs.subset(curr_fold_data["test_docs"])
             logging.info(f"Fold#{curr_fold_data['idx_fold']}...")
 
             best_metric, best_name = float("inf"), None
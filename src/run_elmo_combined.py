@@ -5,6 +5,7 @@ import numpy as np
 import torch
 from sklearn.model_selection import KFold
 
+from common import configure_prepared_doc_cache
 from contextual_model_elmo import ContextualControllerELMo, parser
 from data import read_corpus
 from utils import fixed_split, split_into_sets, KFoldStateCache
@@ -19,6 +20,7 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     logger.addHandler(logging.StreamHandler(sys.stdout))
     args = parser.parse_args()
+    configure_prepared_doc_cache(args)
 
     if args.random_seed:
         torch.random.manual_seed(args.random_seed)
@@ -31,11 +33,17 @@ if __name__ == "__main__":
         _model = ContextualControllerELMo(model_name=model_name,
                                           fc_hidden_size=override_kwargs.get("fc_hidden_size", args.fc_hidden_size),
                                           hidden_size=override_kwargs.get("hidden_size", args.hidden_size),
+                                          batched=override_kwargs.get("batched", args.batched),
+                                          coarse_top_k=override_kwargs.get("coarse_top_k", args.coarse_top_k),
+                                          factorized=override_kwargs.get("factorized", args.factorized),
                                           dropout=override_kwargs.get("dropout", args.dropout),
                                           pretrained_embeddings_dir="../data/slovenian-elmo",
                                           freeze_pretrained=override_kwargs.get("freeze_pretrained", args.freeze_pretrained),
                                           learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
                                           max_segment_size=override_kwargs.get("max_segment_size", args.max_segment_size),
+                                          max_antecedents=override_kwargs.get("max_antecedents", args.max_antecedents),
+                                          max_sentence_distance=override_kwargs.get("max_sentence_distance",
+                                                                                     args.max_sentence_distance),
                                           layer_learning_rate={"lr_embedder": 10e-4} if not args.freeze_pretrained else None,
                                           dataset_name=args.target_dataset)
         return _model
@@ -62,8 +70,8 @@ if __name__ == "__main__":
             OUTER_K = fold_cache.num_folds
 
         for curr_fold_data in fold_cache.get_next_unfinished():
-            curr_train_dev_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["train_docs"]), tgt_docs))
-            curr_test_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["test_docs"]), tgt_docs))
+            curr_train_dev_docs = tgt_docs.subset(curr_fold_data["train_docs"])
+            curr_test_docs = tgt_docs.subset(curr_fold_data["test_docs"])
             logging.info(f"Fold#{curr_fold_data['idx_fold']}...")
 
             best_metric, best_name = float("inf"), None
@@ -6,6 +6,7 @@ import numpy as np
 import torch
 from sklearn.model_selection import KFold
 
+from common import configure_prepared_doc_cache
 from data import read_corpus
 from noncontextual_model import NoncontextualController, parser
 from utils import fixed_split, extract_vocab, split_into_sets, KFoldStateCache
@@ -21,6 +22,7 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     logger.addHandler(logging.StreamHandler(sys.stdout))
     args = parser.parse_args()
+    configure_prepared_doc_cache(args)
 
     if args.random_seed:
         torch.random.manual_seed(args.random_seed)
@@ -65,7 +67,13 @@ if __name__ == "__main__":
                                        embedding_size=override_kwargs.get("embedding_size", embedding_size),
                                        dropout=override_kwargs.get("dropout", args.dropout),
                                        fc_hidden_size=override_kwargs.get("fc_hidden_size", args.fc_hidden_size),
+                                       batched=override_kwargs.get("batched", args.batched),
+                                       coarse_top_k=override_kwargs.get("coarse_top_k", args.coarse_top_k),
+                                       factorized=override_kwargs.get("factorized", args.factorized),
                                        learning_rate=override_kwargs.get("learning_rate", args.learning_rate),
+                                       max_antecedents=override_kwargs.get("max_antecedents", args.max_antecedents),
+                                       max_sentence_distance=override_kwargs.get("max_sentence_distance",
+                                                                                  args.max_sentence_distance),
                                        embedding_type=used_embedding_type,
                                        pretrained_embs=used_embs,
                                        freeze_pretrained=override_kwargs.get("freeze_pretrained", args.freeze_pretrained),
@@ -93,8 +101,8 @@ if __name__ == "__main__":
             OUTER_K = fold_cache.num_folds
 
         for curr_fold_data in fold_cache.get_next_unfinished():
-            curr_train_dev_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["train_docs"]), tgt_docs))
-            curr_test_docs = list(filter(lambda doc: doc.doc_id in set(curr_fold_data["test_docs"]), tgt_docs))
+            curr_train_dev_docs = tgt_docs.subset(curr_fold_data["train_docs"])
+            curr_test_docs = tgt_docs.subset(curr_fold_data["test_docs"])
 
             curr_tok2id, _ = extract_vocab(src_docs + curr_train_dev_docs, lowercase=True, top_n=args.max_vocab_size)
             curr_tok2id = {tok: all_tok2id[tok] for tok in curr_tok2id}
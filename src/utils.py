@@ -4,8 +4,6 @@ import logging
 import os
 from typing import List, Optional, Mapping
 
-from sklearn.model_selection import train_test_split
-
 
 PAD_TOKEN, PAD_ID = "<PAD>", 0
 BOS_TOKEN, BOS_ID = "<BOS>", 1
@@ -125,6 +123,9 @@ def split_into_sets(documents, train_prop=0.7, dev_prop=0.15, test_prop=0.15):
     Splits documents array into three sets: learning, validation & testing.
     If random seed is given, documents selected for each set are randomly picked (but do not overlap, of course).
     """
+    # Imported here, so that modules only using the lightweight utilities (e.g. `get_clusters()`) do not load sklearn
+    from sklearn.model_selection import train_test_split
+
     # Note: test_prop is redundant, but it's left in to make it clear this is a split into 3 parts
     test_prop = 1.0 - train_prop - dev_prop
 
@@ -142,6 +143,14 @@ def fixed_split(documents, dataset):
     tr, dev, te = read_splits(os.path.join("..", "data", "seeded_split", f"{dataset}.txt"))
     assert (len(tr) + len(dev) + len(te)) == len(documents)
 
+    # Imported here, so that modules only using the lightweight utilities (e.g. `get_clusters()`) do not load the
+    # corpus readers
+    from data import Corpus
+
+    # Views into the corpus: documents of a split are only parsed if the split is used (when read lazily)
+    if isinstance(documents, Corpus):
+        return documents.subset(tr), documents.subset(dev), documents.subset(te)
+
     train_docs = list(filter(lambda doc: doc.doc_id in tr, documents))
     dev_docs = list(filter(lambda doc: doc.doc_id in dev, documents))
     te_docs = list(filter(lambda doc: doc.doc_id in te, documents))